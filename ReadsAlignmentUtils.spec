@@ -18,6 +18,36 @@ module ReadsAlignmentUtils {
    typedef string ws_bowtieIndex_id;
    typedef string ws_Sampleset_ref;
 
+   /** Resource use of an external process (samtools, Picard) run during a stage.
+       cpu_time is user + system time in seconds. peak_rss_kb is null if the
+       process did not raise the peak RSS of the child processes run so far. **/
+
+   typedef structure {
+        string name;
+        float  wall_time;
+        float  cpu_time;
+        int    peak_rss_kb;
+   } ProcessTiming;
+
+   /** Wall and CPU time (in seconds) of a stage of a method call, e.g.
+       resolve_params, validate, convert, upload, stats, save, download or index.
+       cpu_time is the CPU time of the thread running the stage, process_cpu_time
+       that of the service process during the stage, including other threads
+       such as concurrent stages. peak_rss_kb is the peak RSS of the service
+       process so far at the end of the stage. child_cpu_time and
+       child_peak_rss_kb cover the external processes run during the stage. **/
+
+   typedef structure {
+        string stage;
+        float  wall_time;
+        float  cpu_time;
+        float  process_cpu_time;
+        int    peak_rss_kb;
+        float  child_cpu_time;
+        int    child_peak_rss_kb;
+        list<ProcessTiming> processes;
+   } StageTiming;
+
    /** Input parameters for validating a reads alignment. For validation errors to ignore,
        see http://broadinstitute.github.io/picard/command-line-overview.html#ValidateSamFile */
 
@@ -39,6 +69,90 @@ module ReadsAlignmentUtils {
             returns (ValidateAlignmentOutput)
             authentication required;
 
+   /** Input parameters for estimating the alignment stats of a BAM file from a
+       random sample of its compressed blocks. The BAI index next to the file
+       (file.bam.bai or file.bai) is used if there is one. **/
+
+   typedef structure {
+        string  file_path;     /* path to the bam file */
+        int     sample_blocks; /* Optional. Number of blocks to sample. Files of no more
+                                   blocks are read in full. Default: 256 */
+        float   confidence;    /* Optional. Level of the confidence intervals.
+                                   Default: 0.95 */
+        int     seed;          /* Optional. Seed of the sample, for repeatable estimates */
+   }  EstimateAlignmentStatsParams;
+
+   /** Estimated alignment stats. alignment_rate is the percentage of primary
+       records that are mapped. Each estimate comes with a [low, high]
+       confidence interval. exact is true if the file was read in full. **/
+
+   typedef structure {
+        float       alignment_rate;
+        list<float> alignment_rate_ci;
+        int         properly_paired;
+        list<int>   properly_paired_ci;
+        int         estimated_records;
+        list<int>   estimated_records_ci;
+        int         sampled_blocks;
+        int         sampled_records;
+        boolean     exact;
+        boolean     used_index;
+        float       confidence;
+   } EstimateAlignmentStatsOutput;
+
+   /** Estimates alignment_rate and properly_paired in seconds, for dashboards
+       and pre-flight checks of large files. **/
+
+   funcdef  estimate_alignment_stats(EstimateAlignmentStatsParams params)
+            returns (EstimateAlignmentStatsOutput)
+            authentication required;
+
+     typedef structure {
+         int    properly_paired;
+         int    multiple_alignments;
+         int    singletons;
+         float  alignment_rate;
+         int    unmapped_reads;
+         int    mapped_reads;
+         int    total_reads;
+     } AlignmentStats;
+
+   /** Mapped and unmapped record counts of a reference of a BAM file, read from
+       its BAI index as by samtools idxstats. The last entry, contig '*', counts
+       the unmapped records without a position. **/
+
+     typedef structure {
+         string contig;
+         int    length;
+         int    mapped;
+         int    unmapped;
+     } ContigStats;
+
+   /** Summary of the QC histograms collected with extended_stats: the mean MAPQ,
+       median insert size of proper pairs, mean NM edit distance and the
+       fraction of soft clipped bases, over the primary mapped records. The
+       histograms are saved with the alignment as the qc_stats companion file,
+       a .npz of fixed-size arrays mapq (256 bins), insert_size (10001 bins) and
+       nm (65 bins), the last bin counting the larger values. **/
+
+     typedef structure {
+         float  mean_mapq;
+         int    median_insert_size;
+         float  mean_nm;
+         float  soft_clip_fraction;
+     } QCStatsSummary;
+
+   /** Numbers of reads counted per feature with count_features: all of them, and
+       the ones overlapping no feature or several features. The counts per
+       feature are saved with the alignment as the feature_counts companion
+       file, a tab separated file of feature id and count as by htseq-count. **/
+
+     typedef structure {
+         int    counted_reads;
+         int    no_feature;
+         int    ambiguous;
+     } FeatureCountsSummary;
+
    /**
       Required input parameters for uploading a reads alignment
 
@@ -51,6 +165,11 @@ module ReadsAlignmentUtils {
                                   If a sam file is provided, it will be converted to the sorted
                                   bam format before being saved
 
+        file_paths             -  Instead of file_path, the paths of several sam or bam files
+                                  of the same library, e.g. one per lane. They are sorted in
+                                  parallel and merged into one coordinate sorted bam file, and
+                                  the stats of the parts are combined rather than computed again
+
         read_library_ref       -  workspace object ref of the read sample used to make
                                   the alignment file
         condition              -
@@ -62,6 +181,7 @@ module ReadsAlignmentUtils {
 
         string destination_ref;
         string file_path;
+        list<string> file_paths;
         string read_library_ref;
         string condition;
         string assembly_or_genome_ref;
@@ -82,12 +202,44 @@ module ReadsAlignmentUtils {
         list<string> ignore; /* Optional. List of validation errors to ignore.
                                  Default: ['MATE_NOT_FOUND','MISSING_READ_GROUP',
                                            'INVALID_MAPPING_QUALITY']   */
+        boolean report_timings; /* Optional. Set to true to return the per-stage
+                                    timings. Default: False */
+        string stats_mode;   /* Optional. 'exact' or 'approximate'. Approximate stats
+                                 estimate the distinct read counts with HyperLogLog
+                                 sketches, in a few KB of memory. Default: 'exact' */
+        boolean extended_stats; /* Optional. Set to true to collect the QC histograms
+                                    in the stats pass and save them with the
+                                    alignment. Default: False */
+        boolean coverage_tiles; /* Optional. Set to true to compute the read depth in
+                                    the stats pass and save it with the alignment as
+                                    the coverage companion file, a .npz of the 1 bp
+                                    depth (run-length encoded) and the mean depth
+                                    of 1 kb, 10 kb and 100 kb bins. Default: False */
+        boolean count_features; /* Optional. Set to true to count the reads per feature
+                                    of assembly_or_genome_ref, which must be a
+                                    KBaseGenomes.Genome, and save the counts with the
+                                    alignment. Default: False */
+        boolean mergeable_stats; /* Optional. Set to true to save the counters and
+                                     read id sets of the stats with the alignment,
+                                     as the stats_state companion file, so
+                                     merge_alignment_stats can combine them with the
+                                     stats of other alignments. Default: False */
    }  UploadAlignmentParams;
 
    /**  Output from uploading a reads alignment  **/
 
     typedef structure {
         string obj_ref;
+        list<StageTiming> timings;  /* Only if report_timings was set */
+        AlignmentStats stats_error_bounds;  /* Only if stats_mode was 'approximate'.
+                                               The ~95% error bound of each saved stat */
+        list<ContigStats> contig_stats;  /* Only if the bam file has a BAI index next
+                                            to it (file.bam.bai or file.bai) */
+        boolean stats_match_index;  /* Only with contig_stats and exact stats. False if
+                                       unmapped_reads or mapped_reads disagree with the
+                                       index counts */
+        QCStatsSummary qc_stats;  /* Only if extended_stats was set */
+        FeatureCountsSummary feature_counts;  /* Only if count_features was set */
     } UploadAlignmentOutput;
 
 
@@ -166,23 +318,53 @@ module ReadsAlignmentUtils {
         list<string> ignore;   /* Optional. List of validation errors to ignore.
                                    Default: ['MATE_NOT_FOUND','MISSING_READ_GROUP',
                                              'INVALID_MAPPING_QUALITY']  */
+        boolean report_timings; /* Optional. Set to true to return the per-stage
+                                    timings. Default: False */
+        boolean downloadCompanions; /* Optional. Set to true to also download the
+                                        companion files saved with the alignment,
+                                        e.g. qc_stats. Default: False */
+        boolean downloadParquet; /* Optional. Set to true to also write the records
+                                     of the bam file to a .parquet file, with the
+                                     read name hash, flag, ref id, pos, mapq, cigar,
+                                     tlen and tags columns. Default: False */
+        list<string> parquet_fields; /* Optional. The columns of the .parquet file,
+                                         some of qname_hash, flag, ref_id, pos, mapq,
+                                         cigar, tlen and tags. cigar and tags are the
+                                         slowest to write. Default: all */
+        boolean split_by_contig; /* Optional. Set to true to also split the bam file
+                                     into a bam file and index per reference, in
+                                     parallel from the indexed bam file. Default: False */
      } DownloadAlignmentParams;
 
+    /**
+      A bam file of the records of some of the references of an alignment,
+      written with split_by_contig, and its BAI index. A reference of at least
+      contig_split_group_bases has a shard of its own and the smaller ones are
+      grouped. The unplaced unmapped records are in the shard of contig '*'.
+    **/
+
      typedef structure {
-         int    properly_paired;
-         int    multiple_alignments;
-         int    singletons;
-         float  alignment_rate;
-         int    unmapped_reads;
-         int    mapped_reads;
-         int    total_reads;
-     } AlignmentStats;
+         list<string> contigs;
+         string bam_file;
+         string bai_file;
+     } ContigShard;
 
     /**  The output of the download method.  **/
 
      typedef structure {
          string     destination_dir;
          AlignmentStats stats;
+         list<StageTiming> timings;  /* Only if report_timings was set */
+         list<ContigStats> contig_stats;  /* Only if every bam file has a BAI index,
+                                             e.g. with downloadBAI. Summed over the
+                                             bam files of the object */
+         boolean stats_match_index;  /* Only with contig_stats and exact stats. False
+                                        if the saved stats disagree with the index
+                                        counts */
+         mapping<string, string> companion_files;  /* Only if downloadCompanions was
+                                                      set. Path of each companion
+                                                      file by name */
+         list<ContigShard> contig_shards;  /* Only if split_by_contig was set */
      } DownloadAlignmentOutput;
 
      /** Downloads alignment files in .bam, .sam and .bai formats. Also downloads alignment stats **/
@@ -211,10 +393,18 @@ module ReadsAlignmentUtils {
          list<string> ignore;    /* Optional. List of validation errors to ignore.
                                      Default: ['MATE_NOT_FOUND','MISSING_READ_GROUP',
                                              'INVALID_MAPPING_QUALITY']   */
+         boolean report_timings; /* Optional. Set to true to return the per-stage
+                                     timings. Default: False */
+         boolean exportParquet;  /* Optional. Set to true to also export the records
+                                     as a .parquet file, see downloadParquet.
+                                     Default: False */
+         list<string> parquet_fields; /* Optional. The columns of the .parquet file,
+                                          see DownloadAlignmentParams. Default: all */
      } ExportParams;
 
      typedef structure {
          string     shock_id;    /* shock id of file to export */
+         list<StageTiming> timings;  /* Only if report_timings was set */
      } ExportOutput;
 
     /** Wrapper function for use by in-narrative downloaders to download alignments from shock **/
@@ -222,4 +412,67 @@ module ReadsAlignmentUtils {
      funcdef export_alignment(ExportParams params)
                      returns (ExportOutput output)
                      authentication required;
+
+    /**
+      Required input parameters for counting the reads of an alignment per feature
+
+      string source_ref -  object reference of the alignment
+      string genome_ref -  Optional. Object reference of the KBaseGenomes.Genome
+                           with the features to count. Default: the genome_id of
+                           the alignment
+    **/
+
+     typedef structure {
+         string     source_ref;
+         string     genome_ref;
+         boolean    report_timings; /* Optional. Set to true to return the per-stage
+                                        timings. Default: False */
+     } CountFeaturesParams;
+
+     typedef structure {
+         mapping<string feature_id, int count> counts;
+         int        no_feature;
+         int        ambiguous;
+         int        counted_reads;
+         list<StageTiming> timings;  /* Only if report_timings was set */
+     } CountFeaturesOutput;
+
+    /** Counts the reads of an alignment per feature of its genome, as htseq-count in
+        union mode: primary mapped reads, pairs counted once, reads overlapping
+        several features counted as ambiguous. Contigs are counted in parallel. **/
+
+     funcdef count_features(CountFeaturesParams params)
+                     returns (CountFeaturesOutput)
+                     authentication required;
+
+    /**
+      Required input parameters for merging the stats of alignments
+
+      list<string> alignment_refs -  object references of the alignments, uploaded
+                                     with mergeable_stats
+    **/
+
+     typedef structure {
+         list<string> alignment_refs;
+         boolean    report_timings; /* Optional. Set to true to return the per-stage
+                                        timings. Default: False */
+     } MergeAlignmentStatsParams;
+
+     typedef structure {
+         AlignmentStats stats;
+         string     stats_mode;  /* 'approximate' if any of the alignments has
+                                    approximate stats, else 'exact' */
+         AlignmentStats stats_error_bounds;  /* Only if stats_mode is 'approximate' */
+         list<StageTiming> timings;  /* Only if report_timings was set */
+     } MergeAlignmentStatsOutput;
+
+    /** Combines the stats of alignments uploaded with mergeable_stats, e.g. the
+        lanes or technical replicates of a sample, from their saved counters and
+        read id sets, without reading the alignments again. The stats are those of
+        the alignments merged into one, as long as they are all paired or all
+        single end. **/
+
+     funcdef merge_alignment_stats(MergeAlignmentStatsParams params)
+                     returns (MergeAlignmentStatsOutput)
+                     authentication required;
 };
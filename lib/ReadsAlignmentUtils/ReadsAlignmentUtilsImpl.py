@@ -1,26 +1,31 @@
 # -*- coding: utf-8 -*-
 #BEGIN_HEADER
+import contextvars
 import errno
 import glob
 import logging
 import os
 import re
+import shutil
 import sys
 import time
 import uuid
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 #from collections import Counter
 from pprint import pformat
 from pprint import pprint
 
-import pysam
-
-from ReadsAlignmentUtils.core import script_utils
+from ReadsAlignmentUtils.core import contig_split, script_utils
+from ReadsAlignmentUtils.core.metrics import BYTES_PROCESSED
 from ReadsAlignmentUtils.core.sam_tools import SamTools
+from ReadsAlignmentUtils.core.stage_timer import StageTimer, current_timer
 from installed_clients.DataFileUtilClient import DataFileUtil
-from installed_clients.WorkspaceClient import Workspace
 from installed_clients.baseclient import ServerError as DFUError
 from installed_clients.baseclient import ServerError as WorkspaceError
+# pysam, numpy and the Workspace client are slow to import and only needed by
+# some methods, so they are imported where they are used. Every async job is a
+# fresh process, so this keeps calls such as status() cheap.
 #END_HEADER
 
 
@@ -52,6 +57,7 @@ stored alignment.
     #BEGIN_CLASS_HEADER
 
     PARAM_IN_FILE = 'file_path'
+    PARAM_IN_FILES = 'file_paths'
     PARAM_IN_SRC_REF = 'source_ref'
     PARAM_IN_DST_REF = 'destination_ref'
     PARAM_IN_CONDITION = 'condition'
@@ -70,6 +76,26 @@ stored alignment.
     PARAM_IN_DOWNLOAD_SAM = 'downloadSAM'
     PARAM_IN_DOWNLOAD_BAI = 'downloadBAI'
     PARAM_IN_VALIDATE = 'validate'
+    PARAM_IN_REPORT_TIMINGS = 'report_timings'
+    PARAM_IN_STATS_MODE = 'stats_mode'
+    PARAM_IN_EXTENDED_STATS = 'extended_stats'
+    PARAM_IN_COVERAGE_TILES = 'coverage_tiles'
+    PARAM_IN_COUNT_FEATURES = 'count_features'
+    PARAM_IN_GENOME_REF = 'genome_ref'
+    PARAM_IN_DOWNLOAD_COMPANIONS = 'downloadCompanions'
+    PARAM_IN_DOWNLOAD_PARQUET = 'downloadParquet'
+    PARAM_IN_PARQUET_FIELDS = 'parquet_fields'
+    PARAM_IN_SPLIT_BY_CONTIG = 'split_by_contig'
+    PARAM_IN_MERGEABLE_STATS = 'mergeable_stats'
+    PARAM_IN_ALIGNMENT_REFS = 'alignment_refs'
+
+    STATS_MODE_EXACT = 'exact'
+    STATS_MODE_APPROXIMATE = 'approximate'
+
+    # object metadata keys of the shock ids of files saved with an alignment
+    COMPANION_META_PREFIX = 'companion_'
+    # the companion file of the counters and read id sets of the stats
+    STATS_STATE_COMPANION = 'stats_state'
 
     INVALID_WS_OBJ_NAME_RE = re.compile('[^\\w\\|._-]')
     INVALID_WS_NAME_RE = re.compile('[^\\w:._-]')
@@ -132,6 +158,7 @@ stored alignment.
         return ws_name_id, obj_name_id
 
     def _get_ws_info(self, obj_ref):
+        from installed_clients.WorkspaceClient import Workspace
 
         ws = Workspace(self.ws_url)
         try:
@@ -146,19 +173,33 @@ stored alignment.
         """
         Checks the presence and validity of upload alignment params
         """
-        self._check_required_param(params, [self.PARAM_IN_DST_REF,
-                                            self.PARAM_IN_FILE,
-                                            self.PARAM_IN_CONDITION,
-                                            self.PARAM_IN_READ_LIB_REF,
-                                            self.PARAM_IN_ASM_GEN_REF
-                                            ])
+        required = [self.PARAM_IN_DST_REF,
+                    self.PARAM_IN_FILE,
+                    self.PARAM_IN_CONDITION,
+                    self.PARAM_IN_READ_LIB_REF,
+                    self.PARAM_IN_ASM_GEN_REF
+                    ]
+        # the files of the lanes or parts of one library may be given instead
+        if params.get(self.PARAM_IN_FILES):
+            if params.get(self.PARAM_IN_FILE):
+                raise ValueError('Only one of {} and {} may be given'.format(
+                    self.PARAM_IN_FILE, self.PARAM_IN_FILES))
+            required.remove(self.PARAM_IN_FILE)
+        self._check_required_param(params, required)
 
         ws_name_id, obj_name_id = self._proc_ws_obj_params(ctx, params)
 
+        stats_mode = params.get(self.PARAM_IN_STATS_MODE) or self.STATS_MODE_EXACT
+        if stats_mode not in (self.STATS_MODE_EXACT, self.STATS_MODE_APPROXIMATE):
+            raise ValueError('{} must be {} or {}'.format(self.PARAM_IN_STATS_MODE,
+                                                          self.STATS_MODE_EXACT,
+                                                          self.STATS_MODE_APPROXIMATE))
+
         file_path = params.get(self.PARAM_IN_FILE)
 
-        if not (os.path.isfile(file_path)):
-            raise ValueError('File does not exist: ' + file_path)
+        for path in params.get(self.PARAM_IN_FILES) or [file_path]:
+            if not (os.path.isfile(path)):
+                raise ValueError('File does not exist: ' + path)
 
         lib_type = self._get_ws_info(params.get(self.PARAM_IN_READ_LIB_REF))[2]
         if lib_type.startswith('KBaseFile.SingleEndLibrary') or \
@@ -183,10 +224,21 @@ stored alignment.
                                                          ' KBaseGenomes.Genome or' +
                                                          ' KBaseGenomeAnnotations.Assembly or' +
                                                          ' KBaseGenomes.ContigSet')
+        if params.get(self.PARAM_IN_COUNT_FEATURES, False) and \
+           not obj_type.startswith('KBaseGenomes.Genome'):
+            raise ValueError(self.PARAM_IN_ASM_GEN_REF + ' parameter should be of type' +
+                                                         ' KBaseGenomes.Genome to count features')
         return ws_name_id, obj_name_id, file_path, lib_type
 
     def _get_aligner_stats(self, bam_file):
         """
+        Gets the exact aligner stats from BAM file, see _get_aligner_stats_and_error_bounds
+        """
+        return self._get_aligner_stats_and_error_bounds(bam_file)[0]
+
+    def _get_aligner_stats_and_error_bounds(self, bam_file, stats_mode=STATS_MODE_EXACT,
+                                            collectors=(), state_path=None):
+        """
         Gets the aligner stats from BAM file
 
         How we compute this stats:
@@ -199,118 +251,424 @@ stored alignment.
         secondary_alignments = all alignments that have is_secondary tag
         properly_paired = For paired end reads, all reads that map as proper pair
 
-        
+        In approximate mode, the distinct read counts are estimated with
+        HyperLogLog sketches.
+
+        The flags and read name hashes of the records are read in chunks and
+        counted with array operations. collectors, e.g. a QCStatsAccumulator
+        or CoverageAccumulator, need the decoded records, so they are given
+        each record with add_alignment(alignment) in a pass of their own.
+
+        If state_path is given, the counters and read id sets are saved to it,
+        to merge them with the stats of other alignments later.
+
+        :returns a tuple of the stats and their error bounds, None in exact mode
         """
+        import pysam
+
+        from ReadsAlignmentUtils.core.alignment_stats import (AlignmentStatsAccumulator,
+                                                              ExactReadIdSets)
+        from ReadsAlignmentUtils.core.hyperloglog import HyperLogLogSets
+        from ReadsAlignmentUtils.core.record_chunks import iter_chunks
+
         path, file = os.path.split(bam_file)
 
         self.__LOGGER.info('Start to generate aligner stats')
         start_time = time.time()
 
-        infile = pysam.AlignmentFile(bam_file, 'r')
-
-        total_alignment_count = 0
-        unmapped_reads_count = 0
-        secondary_alignment_count = 0
-        properly_paired = 0
-        alignment_rate = 0
-
-        secondary_alignment_left_reads_ids = []
-        secondary_alignment_right_reads_ids = []
-        secondary_alignment_single_end_reads_ids = []
-
-        mapped_left_reads_ids = []
-        mapped_right_reads_ids = []
-        mapped_single_end_reads_ids = []
-
-        paired = False
-        for alignment in infile:
-            reads_id = alignment.query_name
-            total_alignment_count += 1
-            if alignment.is_paired:
-                paired = True
-
-            if paired:  # process paired end sequence
-
-                if alignment.is_read1:  # first sequence of a pair
-                    if alignment.is_unmapped:
-                        unmapped_reads_count += 1
-                    else:
-                        mapped_left_reads_ids.append(reads_id)
-                        if alignment.is_secondary:
-                            secondary_alignment_count += 1
-                            secondary_alignment_left_reads_ids.append(reads_id)
-                        else:
-                            if alignment.is_proper_pair: #counter increase when proper pair and primary alignment
-                                properly_paired += 1
- 
-                if alignment.is_read2:  # second sequence of a pair
-                    if alignment.is_unmapped:
-                        unmapped_reads_count += 1
-                    else:
-                        mapped_right_reads_ids.append(reads_id)
-                        if alignment.is_secondary:
-                            secondary_alignment_count += 1
-                            secondary_alignment_right_reads_ids.append(reads_id)
-                        else:
-                            if alignment.is_proper_pair: #counter increase when proper pair and primary alignment
-                                properly_paired += 1
- 
-            else: #process single end sequences
-                if alignment.is_unmapped:
-                    unmapped_reads_count += 1
-                else:
-                    mapped_single_end_reads_ids.append(reads_id)
-                    if alignment.is_secondary:
-                        secondary_alignment_count += 1
-                        secondary_alignment_single_end_reads_ids.append(reads_id)
+        if stats_mode == self.STATS_MODE_APPROXIMATE:
+            id_sets = HyperLogLogSets()
+        else:
+            # read names are kept as hashes, spilled to scratch past the memory budget
+            id_sets = ExactReadIdSets(self.stats_memory_mb, self.scratch)
+        with id_sets:
+            stats = AlignmentStatsAccumulator(id_sets)
+            for chunk in iter_chunks(bam_file):
+                stats.add_chunk(chunk['flag'], chunk['qname_hash'])
+            if collectors:
+                with pysam.AlignmentFile(bam_file, 'r') as infile:
+                    for alignment in infile:
+                        for collector in collectors:
+                            collector.add_alignment(alignment)
+
+            stats_data = stats.result()
+            error_bounds = None
+            if stats_mode == self.STATS_MODE_APPROXIMATE:
+                error_bounds = stats.error_bounds()
+            if state_path is not None:
+                stats.save(state_path)
+        if id_sets.spills:
+            self.__LOGGER.info('Spilled read ids to scratch {} times'.format(id_sets.spills))
 
-        infile.close()
+        elapsed_time = time.time() - start_time
+        self.__LOGGER.info('Used: {}'.format(time.strftime("%H:%M:%S", time.gmtime(elapsed_time))))
 
+        # Secondary alignment and total alignment for debugging.
+        # Need to update https://ci.kbase.us/#spec/type/KBaseRNASeq.AlignmentStatsResults-5.0 for them to be included
+        self.__LOGGER.info("secondary_alignments " +  str(stats.secondary_alignments))
+        self.__LOGGER.info("total_alignments " +  str(stats.total_alignments))
+        self.__LOGGER.info(stats_data)
+        if error_bounds:
+            self.__LOGGER.info('approximate stats error bounds: {}'.format(error_bounds))
+
+        return stats_data, error_bounds
 
-        #prepare  summary
-        mapped_left_reads_count = len(set(mapped_left_reads_ids))
-        mapped_right_reads_count = len(set(mapped_right_reads_ids))
-        both_pair_mapcount = len(set(mapped_left_reads_ids) & set(mapped_right_reads_ids))
-        singletons = mapped_left_reads_count + mapped_right_reads_count - both_pair_mapcount*2
+    def _get_index_stats(self, bam_files, stats, check=True):
+        """
+        Reads the per-contig record counts of bam files from their BAI indexes
+        and, if check is set, checks stats against them
+
+        :returns a dict of contig_stats and stats_match_index for the method
+        output, empty if a bam file has no index with counts or a stale one
+        """
+        from ReadsAlignmentUtils.core import index_stats
 
-        mapped_reads_count = mapped_left_reads_count + \
-                                 mapped_right_reads_count + \
-                                 len(set(mapped_single_end_reads_ids))
+        contig_stats_list = []
+        for bam_file in bam_files:
+            try:
+                contig_stats = index_stats.read_index_stats(bam_file)
+            except ValueError as e:
+                # e.g. an old index packaged with another file in a legacy zip
+                self.__LOGGER.warning('Ignoring the index counts of {}: {}'.format(bam_file, e))
+                return {}
+            if contig_stats is None:
+                self.__LOGGER.info('No index counts for {}'.format(bam_file))
+                return {}
+            contig_stats_list.append(contig_stats)
+        contig_stats = index_stats.merge_index_stats(contig_stats_list)
+
+        index_output = {'contig_stats': contig_stats}
+        if check:
+            errors = index_stats.check_stats(stats, contig_stats)
+            for error in errors:
+                self.__LOGGER.warning('Alignment stats do not match the index: ' + error)
+            index_output['stats_match_index'] = not errors
+        return index_output
+
+    def _get_coverage_accumulator(self, bam_file):
+        """
+        Returns a CoverageAccumulator for the references of a sam or bam file
+        """
+        import pysam
 
+        from ReadsAlignmentUtils.core.coverage import CoverageAccumulator
 
-        total_reads_count = mapped_reads_count + unmapped_reads_count
+        with pysam.AlignmentFile(bam_file, 'r') as infile:
+            sort_order = infile.header.to_dict().get('HD', {}).get('SO')
+            return CoverageAccumulator(infile.references, infile.lengths,
+                                       coordinate_sorted=sort_order == 'coordinate')
 
-        #count for reads that are aligned in multiple places
-        multiple_alignments = len(set(secondary_alignment_left_reads_ids)) + \
-                              len(set(secondary_alignment_right_reads_ids)) + \
-                              len(set(secondary_alignment_single_end_reads_ids))
+    def _get_genome_features(self, genome_ref):
+        """
+        Returns the id and location of the features of a genome
+        """
+        from installed_clients.WorkspaceClient import Workspace
 
+        ws = Workspace(self.ws_url)
         try:
-            alignment_rate = round(float(mapped_reads_count) / total_reads_count * 100, 3)
-        except ZeroDivisionError:
-            alignment_rate = 0
+            genome = ws.get_objects2({'objects': [{
+                'ref': genome_ref,
+                'included': ['features/[*]/id', 'features/[*]/location']}]})['data'][0]
+        except WorkspaceError as wse:
+            self.__LOGGER.error('Logging workspace exception')
+            self.__LOGGER.error(str(wse))
+            raise
+        if not genome['info'][2].startswith('KBaseGenomes.Genome'):
+            raise ValueError('{} is not a KBaseGenomes.Genome, features can not be '
+                             'counted'.format(genome_ref))
+        return genome['data'].get('features') or []
 
-        elapsed_time = time.time() - start_time
-        self.__LOGGER.info('Used: {}'.format(time.strftime("%H:%M:%S", time.gmtime(elapsed_time))))
+    def _count_features(self, bam_files, genome_ref):
+        """
+        Counts the reads of sam or bam files per feature of a genome, in
+        parallel by contig for the indexed bam files
+        """
+        from ReadsAlignmentUtils.core.bgzf import find_bai
+        from ReadsAlignmentUtils.core.feature_counts import (FeatureIndex, count_features,
+                                                             merge_feature_counts)
+
+        feature_index = FeatureIndex.from_genome_features(self._get_genome_features(genome_ref))
+        self.__LOGGER.info('Counting reads for {} features'.format(
+            len(feature_index.feature_ids)))
+        results = []
+        for bam_file in bam_files:
+            indexed = bam_file.lower().endswith('.bam') and find_bai(bam_file) is not None
+            results.append(count_features(bam_file, feature_index,
+                                          workers=self.feature_count_workers, indexed=indexed,
+                                          config=self.config))
+        return merge_feature_counts(results)
+
+    def _run_tasks(self, tasks, workers):
+        """
+        Runs tasks, tuples of a function and its arguments, in a pool of at most
+        workers threads. Each task runs in a copy of the calling context, so
+        the processes it runs are recorded on the stage open in the caller, or
+        on the stages it opens itself.
 
+        :returns the results of the tasks, in order
+        """
+        if not tasks:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(tasks), workers)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, *task) for task in tasks]
+            return [future.result() for future in futures]
 
-        stats_data = {
-            "alignment_rate": alignment_rate,
-            "mapped_reads": mapped_reads_count,
-            "multiple_alignments": multiple_alignments,
-            "singletons": singletons,
-            "total_reads": total_reads_count,
-            "properly_paired": properly_paired,
-            "unmapped_reads": unmapped_reads_count
-        }
+    def _merge_stats_states(self, state_paths, state_path=None):
+        """
+        Combines the stats saved by _get_aligner_stats_and_error_bounds to
+        state_paths, approximate if any of them is, and saves the combined
+        state to state_path if given
 
-        # Secondary alignment and total alignment for debugging.
-        # Need to update https://ci.kbase.us/#spec/type/KBaseRNASeq.AlignmentStatsResults-5.0 for them to be included
-        self.__LOGGER.info("secondary_alignments " +  str(secondary_alignment_count))
-        self.__LOGGER.info("total_alignments " +  str(total_alignment_count))
-        self.__LOGGER.info(stats_data)
+        :returns a tuple of the stats mode, the stats and their error bounds,
+        None in exact mode
+        """
+        from ReadsAlignmentUtils.core.alignment_stats import (AlignmentStatsAccumulator,
+                                                              ExactReadIdSets)
+        from ReadsAlignmentUtils.core.hyperloglog import HyperLogLogSets
+
+        modes = set(AlignmentStatsAccumulator.saved_mode(path) for path in state_paths)
+        # the parts with exact sets are added to the sketches of the others
+        if self.STATS_MODE_APPROXIMATE in modes:
+            stats_mode = self.STATS_MODE_APPROXIMATE
+            id_sets = HyperLogLogSets()
+        else:
+            stats_mode = self.STATS_MODE_EXACT
+            id_sets = ExactReadIdSets(self.stats_memory_mb, self.scratch)
+        with id_sets:
+            stats = AlignmentStatsAccumulator(id_sets)
+            for path in state_paths:
+                stats.merge_saved(path)
+            error_bounds = None
+            if stats_mode == self.STATS_MODE_APPROXIMATE:
+                error_bounds = stats.error_bounds()
+            if state_path is not None:
+                stats.save(state_path)
+            return stats_mode, stats.result(), error_bounds
+
+    def _prepare_part(self, index, file_path, part_dir, stats_mode, with_stats):
+        """
+        Sorts a part of a multi-file upload by coordinate into part_dir, unless
+        it is a coordinate sorted bam file already, and saves its stats state
+        if with_stats
+
+        :returns the path of the sorted bam file and of the stats state, or None
+        """
+        import pysam
+
+        dir, file_name, file_base, file_ext = self._get_file_path_info(file_path)
+        with pysam.AlignmentFile(file_path, 'r', check_sq=False) as infile:
+            sort_order = infile.header.to_dict().get('HD', {}).get('SO')
+        sorted_file = file_path
+        if file_ext.lower() != '.bam' or sort_order != 'coordinate':
+            sorted_file = os.path.join(part_dir, '{}_{}.bam'.format(index, file_base))
+            if self.samtools.sort_bam(ifile=file_name, ipath=dir,
+                                      ofile=os.path.basename(sorted_file),
+                                      opath=part_dir) == 1 or not os.path.isfile(sorted_file):
+                raise ValueError('Error sorting {}'.format(file_path))
+        state_path = None
+        if with_stats:
+            state_path = os.path.join(part_dir, '{}_{}.{}.npz'.format(
+                index, file_base, self.STATS_STATE_COMPANION))
+            self._get_aligner_stats_and_error_bounds(sorted_file, stats_mode,
+                                                     state_path=state_path)
+        return sorted_file, state_path
+
+    def _merge_parts(self, file_paths, stats_mode, with_stats, timer):
+        """
+        Sorts the sam or bam files of a multi-file upload in parallel, then
+        merges them into one indexed, coordinate sorted bam file
+
+        :returns the path of the merged bam file and the stats states of the
+        parts if with_stats, else None, in a scratch directory of their own the
+        caller removes
+        """
+        merge_dir = os.path.join(self.scratch, 'merge_' + str(uuid.uuid4()))
+        self._mkdir_p(merge_dir)
 
-        return stats_data
+        try:
+            with timer.stage('sort'):
+                parts = self._run_tasks([(self._prepare_part, index, file_path, merge_dir,
+                                          stats_mode, with_stats)
+                                         for index, file_path in enumerate(file_paths)],
+                                        self.merge_workers)
+
+            file_base = self._get_file_path_info(file_paths[0])[2]
+            merged_file = os.path.join(merge_dir, file_base + '_merged.bam')
+            with timer.stage('merge'):
+                if self.samtools.merge_bams([sorted_file for sorted_file, _ in parts],
+                                            merged_file) == 1 or not os.path.isfile(merged_file):
+                    raise ValueError('Error merging {}'.format(', '.join(file_paths)))
+
+            # the index gives the per-contig counts of the merged file
+            with timer.stage('index'):
+                self.samtools.create_bai_from_bam(ifile=os.path.basename(merged_file),
+                                                  ipath=merge_dir,
+                                                  ofile=file_base + '_merged.bai')
+
+            return merged_file, [state_path for _, state_path in parts] if with_stats else None
+        except Exception:
+            shutil.rmtree(merge_dir, ignore_errors=True)
+            raise
+
+    def _validate_bam(self, bam_file_path, timer):
+        with timer.stage('validate'):
+            if self._validate({'file_path': bam_file_path}) == 1:
+                raise Exception('{0} failed validation'.format(bam_file_path))
+
+    def _create_bai(self, bam_file_path, timer):
+        dir, file_name, file_base, file_ext = self._get_file_path_info(bam_file_path)
+        bai_file_path = os.path.join(dir, file_base + '.bai')
+        with timer.stage('index'):
+            self.samtools.create_bai_from_bam(ifile=file_name, ipath=dir,
+                                              ofile=file_base + '.bai')
+        if not os.path.isfile(bai_file_path):
+            raise ValueError('Error creating {}'.format(bai_file_path))
+
+    def _create_sam(self, bam_file_path, timer):
+        dir, file_name, file_base, file_ext = self._get_file_path_info(bam_file_path)
+        sam_file_path = os.path.join(dir, file_base + '.sam')
+        with timer.stage('convert'):
+            self.samtools.convert_bam_to_sam(ifile=file_name, ipath=dir,
+                                             ofile=file_base + '.sam')
+        if not os.path.isfile(sam_file_path):
+            raise ValueError('Error creating {}'.format(sam_file_path))
+
+    def _get_parquet_fields(self, params):
+        """
+        Returns the Parquet columns selected in params, all by default
+        """
+        from ReadsAlignmentUtils.core.columnar import FIELDS
+
+        fields = params.get(self.PARAM_IN_PARQUET_FIELDS)
+        if fields is None:
+            return FIELDS
+        if not isinstance(fields, list) or not fields:
+            raise ValueError('{} must be a non-empty list of some of {}'.format(
+                self.PARAM_IN_PARQUET_FIELDS, ', '.join(FIELDS)))
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            raise ValueError('Unknown {}: {}, expected some of {}'.format(
+                self.PARAM_IN_PARQUET_FIELDS, ', '.join(map(str, unknown)), ', '.join(FIELDS)))
+        return tuple(fields)
+
+    def _create_parquet(self, bam_file_path, fields, timer):
+        from ReadsAlignmentUtils.core.columnar import write_parquet
+
+        dir, file_name, file_base, file_ext = self._get_file_path_info(bam_file_path)
+        parquet_file_path = os.path.join(dir, file_base + '.parquet')
+        with timer.stage('columnar'):
+            records = write_parquet(bam_file_path, parquet_file_path, fields=fields)
+        self.__LOGGER.info('Wrote {} records to {}'.format(records, parquet_file_path))
+
+    def _extract_shard(self, bam_file_path, shard_dir, index, contigs, lengths):
+        """
+        Writes the records of the references of a shard of a bam file, and
+        their index, to shard_dir
+
+        :returns the ContigShard of the method output
+        """
+        dir, file_name, file_base, file_ext = self._get_file_path_info(bam_file_path)
+        shard_base = contig_split.shard_file_base(file_base, index, contigs)
+        shard_file_path = os.path.join(shard_dir, shard_base + '.bam')
+        if self.samtools.extract_regions(ifile=file_name, ipath=dir,
+                                         regions=contig_split.shard_regions(contigs, lengths),
+                                         ofile=shard_base + '.bam', opath=shard_dir) == 1 or \
+                not os.path.isfile(shard_file_path):
+            raise ValueError('Error creating {}'.format(shard_file_path))
+
+        shard_bai_path = os.path.join(shard_dir, shard_base + '.bai')
+        self.samtools.create_bai_from_bam(ifile=shard_base + '.bam', ipath=shard_dir,
+                                          ofile=shard_base + '.bai')
+        if not os.path.isfile(shard_bai_path):
+            raise ValueError('Error creating {}'.format(shard_bai_path))
+
+        return {'contigs': contigs,
+                'bam_file': shard_file_path,
+                'bai_file': shard_bai_path}
+
+    def _split_by_contig(self, bam_file_path, timer):
+        """
+        Splits a coordinate sorted bam file into a bam file and index per
+        reference, or per group of small references, in a directory next to
+        it. The shards are extracted in parallel from the indexed bam file,
+        which is indexed first if needed.
+
+        :returns the ContigShards of the method output
+        """
+        from ReadsAlignmentUtils.core import index_stats
+        from ReadsAlignmentUtils.core.bgzf import BaiIndex, BamHeader, BgzfReader, find_bai
+
+        dir, file_name, file_base, file_ext = self._get_file_path_info(bam_file_path)
+        if not find_bai(bam_file_path):
+            with timer.stage('index'):
+                self.samtools.create_bai_from_bam(ifile=file_name, ipath=dir,
+                                                  ofile=file_base + '.bai')
+            if not find_bai(bam_file_path):
+                raise ValueError('Error creating the index of {}'.format(bam_file_path))
+
+        contig_stats = index_stats.read_index_stats(bam_file_path)
+        if contig_stats is None:
+            # without index counts, only the references without records are
+            # known, from their empty bins, and the others all get a shard
+            index = BaiIndex.read(find_bai(bam_file_path))
+            with BgzfReader(bam_file_path) as bgzf:
+                header = BamHeader.read(bgzf)
+            contig_stats = [{'contig': name, 'length': length,
+                             'mapped': ref.mapped, 'unmapped': ref.unmapped}
+                            for name, length, ref in zip(header.names, header.lengths,
+                                                         index.references)]
+            contig_stats.append({'contig': index_stats.UNPLACED_CONTIG, 'length': 0,
+                                 'mapped': 0, 'unmapped': index.no_coordinate})
+        shards = contig_split.plan_shards(contig_stats, self.split_group_bases)
+        lengths = {entry['contig']: entry['length'] for entry in contig_stats}
+
+        shard_dir = os.path.join(dir, file_base + '_contigs')
+        self._mkdir_p(shard_dir)
+        with timer.stage('split'):
+            return self._run_tasks([(self._extract_shard, bam_file_path, shard_dir, index,
+                                     contigs, lengths)
+                                    for index, contigs in enumerate(shards)],
+                                   self.split_workers)
+
+    def _upload_companions(self, companions):
+        """
+        Uploads companion files, given by name, to shock
+
+        :returns the object metadata to save with the alignment, the shock id
+        of each file under COMPANION_META_PREFIX + name
+        """
+        meta = {}
+        for name, path in companions.items():
+            shock_id = self.dfu.file_to_shock({'file_path': path})['shock_id']
+            BYTES_PROCESSED.inc(os.path.getsize(path), method='upload_alignment')
+            meta[self.COMPANION_META_PREFIX + name] = shock_id
+        return meta
+
+    def _download_companions(self, meta, output_dir):
+        """
+        Downloads the companion files listed in the metadata of an alignment
+
+        :returns the path of each file by name
+        """
+        companion_files = {}
+        for key, shock_id in sorted((meta or {}).items()):
+            if key.startswith(self.COMPANION_META_PREFIX):
+                file_ret = self.dfu.shock_to_file({'shock_id': shock_id,
+                                                   'file_path': output_dir})
+                BYTES_PROCESSED.inc(file_ret.get('size') or 0, method='download_alignment')
+                companion_files[key[len(self.COMPANION_META_PREFIX):]] = file_ret['file_path']
+        return companion_files
+
+    def _get_stage_timer(self, method):
+        """
+        Returns the stage timer of the calling method if this method was called
+        from inside one of its stages (e.g. download_alignment from
+        export_alignment), else a new timer for this method
+        """
+        timer = current_timer()
+        if timer is None:
+            timer = StageTimer(method, self.__LOGGER)
+        return timer
 
     def _validate(self, params):
         samt = SamTools(self.config, self.__LOGGER)
@@ -351,6 +709,14 @@ stored alignment.
         self.ws_url = config['workspace-url']
         self.dfu = DataFileUtil(self.callback_url)
         self.samtools = SamTools(config)
+        self.stats_memory_mb = config.get('aligner_stats_memory_mb') or None
+        self.feature_count_workers = int(config.get('feature_count_workers') or
+                                         os.cpu_count() or 1)
+        self.merge_workers = int(config.get('upload_merge_workers') or os.cpu_count() or 1)
+        self.download_workers = int(config.get('download_workers') or os.cpu_count() or 1)
+        self.split_workers = int(config.get('contig_split_workers') or os.cpu_count() or 1)
+        self.split_group_bases = int(config.get('contig_split_group_bases') or
+                                     contig_split.GROUP_BASES)
         #END_CONSTRUCTOR
         pass
 
@@ -387,6 +753,60 @@ stored alignment.
         # return the results
         return [returnVal]
 
+    def estimate_alignment_stats(self, ctx, params):
+        """
+        Estimates alignment_rate and properly_paired in seconds, for dashboards
+               and pre-flight checks of large files. *
+        :param params: instance of type "EstimateAlignmentStatsParams" (*
+           Input parameters for estimating the alignment stats of a BAM file
+           from a random sample of its compressed blocks. The BAI index next
+           to the file (file.bam.bai or file.bai) is used if there is one. *)
+           -> structure: parameter "file_path" of String, parameter
+           "sample_blocks" of Long, parameter "confidence" of Double,
+           parameter "seed" of Long
+        :returns: instance of type "EstimateAlignmentStatsOutput" (*
+           Estimated alignment stats. alignment_rate is the percentage of
+           primary records that are mapped. Each estimate comes with a [low,
+           high] confidence interval. exact is true if the file was read in
+           full. *) -> structure: parameter "alignment_rate" of Double,
+           parameter "alignment_rate_ci" of list of Double, parameter
+           "properly_paired" of Long, parameter "properly_paired_ci" of list
+           of Long, parameter "estimated_records" of Long, parameter
+           "estimated_records_ci" of list of Long, parameter "sampled_blocks"
+           of Long, parameter "sampled_records" of Long, parameter "exact" of
+           type "boolean" (A boolean - 0 for false, 1 for true. @range (0,
+           1)), parameter "used_index" of type "boolean" (A boolean - 0 for
+           false, 1 for true. @range (0, 1)), parameter "confidence" of
+           Double
+        """
+        # ctx is the context object
+        # return variables are: returnVal
+        #BEGIN estimate_alignment_stats
+
+        self._check_required_param(params, [self.PARAM_IN_FILE])
+        file_path = params.get(self.PARAM_IN_FILE)
+        if not os.path.isfile(file_path):
+            raise ValueError('File does not exist: ' + file_path)
+        if not file_path.lower().endswith('.bam'):
+            raise ValueError('Stats can only be estimated for bam files: ' + file_path)
+
+        from ReadsAlignmentUtils.core import sampled_stats
+
+        returnVal = sampled_stats.estimate_alignment_stats(
+            file_path,
+            sample_blocks=params.get('sample_blocks') or sampled_stats.DEFAULT_SAMPLE_BLOCKS,
+            confidence=params.get('confidence') or sampled_stats.DEFAULT_CONFIDENCE,
+            seed=params.get('seed'))
+
+        #END estimate_alignment_stats
+
+        # At some point might do deeper type checking...
+        if not isinstance(returnVal, dict):
+            raise ValueError('Method estimate_alignment_stats return value ' +
+                             'returnVal is not type dict as required.')
+        # return the results
+        return [returnVal]
+
     def upload_alignment(self, ctx, params):
         """
         Validates and uploads the reads alignment
@@ -433,27 +853,88 @@ stored alignment.
            is the workspace name or id and obj_name_or_id is the object name
            or id file_path              -  File with the path of the sam or
            bam file to be uploaded. If a sam file is provided, it will be
-           converted to the sorted bam format before being saved
-           read_library_ref       -  workspace object ref of the read sample
-           used to make the alignment file condition              -
-           assembly_or_genome_ref -  workspace object ref of genome assembly
-           or genome object that was used to build the alignment *) ->
-           structure: parameter "destination_ref" of String, parameter
-           "file_path" of String, parameter "read_library_ref" of String,
-           parameter "condition" of String, parameter
-           "assembly_or_genome_ref" of String, parameter "aligned_using" of
-           String, parameter "aligner_version" of String, parameter
-           "aligner_opts" of mapping from String to String, parameter
-           "replicate_id" of String, parameter "platform" of String,
-           parameter "bowtie2_index" of type "ws_bowtieIndex_id", parameter
-           "sampleset_ref" of type "ws_Sampleset_ref", parameter
+           converted to the sorted bam format before being saved file_paths
+           -  Instead of file_path, the paths of several sam or bam files of
+           the same library, e.g. one per lane. They are sorted in parallel
+           and merged into one coordinate sorted bam file, and the stats of
+           the parts are combined rather than computed again read_library_ref
+           -  workspace object ref of the read sample used to make the
+           alignment file condition              - assembly_or_genome_ref -
+           workspace object ref of genome assembly or genome object that was
+           used to build the alignment *) -> structure: parameter
+           "destination_ref" of String, parameter "file_path" of String,
+           parameter "file_paths" of list of String, parameter
+           "read_library_ref" of String, parameter "condition" of String,
+           parameter "assembly_or_genome_ref" of String, parameter
+           "aligned_using" of String, parameter "aligner_version" of String,
+           parameter "aligner_opts" of mapping from String to String,
+           parameter "replicate_id" of String, parameter "platform" of
+           String, parameter "bowtie2_index" of type "ws_bowtieIndex_id",
+           parameter "sampleset_ref" of type "ws_Sampleset_ref", parameter
            "mapped_sample_id" of mapping from String to mapping from String
            to String, parameter "validate" of type "boolean" (A boolean - 0
            for false, 1 for true. @range (0, 1)), parameter "ignore" of list
-           of String
+           of String, parameter "report_timings" of type "boolean" (A boolean
+           - 0 for false, 1 for true. @range (0, 1)), parameter "stats_mode"
+           of String, parameter "extended_stats" of type "boolean" (A boolean
+           - 0 for false, 1 for true. @range (0, 1)), parameter
+           "coverage_tiles" of type "boolean" (A boolean - 0 for false, 1 for
+           true. @range (0, 1)), parameter "count_features" of type "boolean"
+           (A boolean - 0 for false, 1 for true. @range (0, 1)), parameter
+           "mergeable_stats" of type "boolean" (A boolean - 0 for false, 1
+           for true. @range (0, 1))
         :returns: instance of type "UploadAlignmentOutput" (*  Output from
            uploading a reads alignment  *) -> structure: parameter "obj_ref"
-           of String
+           of String, parameter "timings" of list of type "StageTiming" (*
+           Wall and CPU time (in seconds) of a stage of a method call, e.g.
+           resolve_params, validate, convert, upload, stats, save, download
+           or index. cpu_time is the CPU time of the thread running the
+           stage, process_cpu_time that of the service process during the
+           stage, including other threads such as concurrent stages.
+           peak_rss_kb is the peak RSS of the service process so far at the
+           end of the stage. child_cpu_time and child_peak_rss_kb cover the
+           external processes run during the stage. *) -> structure:
+           parameter "stage" of String, parameter "wall_time" of Double,
+           parameter "cpu_time" of Double, parameter "process_cpu_time" of
+           Double, parameter "peak_rss_kb" of Long, parameter
+           "child_cpu_time" of Double, parameter "child_peak_rss_kb" of Long,
+           parameter "processes" of list of type "ProcessTiming" (* Resource
+           use of an external process (samtools, Picard) run during a stage.
+           cpu_time is user + system time in seconds. peak_rss_kb is null if
+           the process did not raise the peak RSS of the child processes run
+           so far. *) -> structure: parameter "name" of String, parameter
+           "wall_time" of Double, parameter "cpu_time" of Double, parameter
+           "peak_rss_kb" of Long, parameter "stats_error_bounds" of type
+           "AlignmentStats" -> structure: parameter "properly_paired" of
+           Long, parameter "multiple_alignments" of Long, parameter
+           "singletons" of Long, parameter "alignment_rate" of Double,
+           parameter "unmapped_reads" of Long, parameter "mapped_reads" of
+           Long, parameter "total_reads" of Long, parameter "contig_stats" of
+           list of type "ContigStats" (* Mapped and unmapped record counts of
+           a reference of a BAM file, read from its BAI index as by samtools
+           idxstats. The last entry, contig '*', counts the unmapped records
+           without a position. *) -> structure: parameter "contig" of String,
+           parameter "length" of Long, parameter "mapped" of Long, parameter
+           "unmapped" of Long, parameter "stats_match_index" of type
+           "boolean" (A boolean - 0 for false, 1 for true. @range (0, 1)),
+           parameter "qc_stats" of type "QCStatsSummary" (* Summary of the QC
+           histograms collected with extended_stats: the mean MAPQ, median
+           insert size of proper pairs, mean NM edit distance and the
+           fraction of soft clipped bases, over the primary mapped records.
+           The histograms are saved with the alignment as the qc_stats
+           companion file, a .npz of fixed-size arrays mapq (256 bins),
+           insert_size (10001 bins) and nm (65 bins), the last bin counting
+           the larger values. *) -> structure: parameter "mean_mapq" of
+           Double, parameter "median_insert_size" of Long, parameter
+           "mean_nm" of Double, parameter "soft_clip_fraction" of Double,
+           parameter "feature_counts" of type "FeatureCountsSummary" (*
+           Numbers of reads counted per feature with count_features: all of
+           them, and the ones overlapping no feature or several features. The
+           counts per feature are saved with the alignment as the
+           feature_counts companion file, a tab separated file of feature id
+           and count as by htseq-count. *) -> structure: parameter
+           "counted_reads" of Long, parameter "no_feature" of Long, parameter
+           "ambiguous" of Long
         """
         # ctx is the context object
         # return variables are: returnVal
@@ -462,63 +943,149 @@ stored alignment.
         self.__LOGGER.info('Starting upload Reads Alignment, parsing parameters ')
         pprint(params)
 
-        ws_name_id, obj_name_id, file_path, lib_type = self._proc_upload_alignment_params(ctx, params)
+        timer = self._get_stage_timer('upload_alignment')
 
-        dir, file_name, file_base, file_ext = self._get_file_path_info(file_path)
+        with timer.stage('resolve_params'):
+            ws_name_id, obj_name_id, file_path, lib_type = \
+                self._proc_upload_alignment_params(ctx, params)
 
-        if self.PARAM_IN_VALIDATE in params and params[self.PARAM_IN_VALIDATE] is True:
-            if self._validate(params) == 1:
-                raise Exception('{0} failed validation'.format(file_path))
-
-        bam_file = file_path
-        if file_ext.lower() == '.sam':
-            bam_file = os.path.join(dir, file_base + '.bam')
-            self.samtools.convert_sam_to_sorted_bam(ifile=file_name, ipath=dir, ofile=bam_file)
-
-        uploaded_file = self.dfu.file_to_shock({'file_path': bam_file,
-                                                'make_handle': 1
-                                                })
-        file_handle = uploaded_file['handle']
-        file_size = uploaded_file['size']
-
-        aligner_stats = self._get_aligner_stats(file_path)
-        aligner_data = {'file': file_handle,
-                        'size': file_size,
-                        'condition': params.get(self.PARAM_IN_CONDITION),
-                        'read_sample_id': params.get(self.PARAM_IN_READ_LIB_REF),
-                        'library_type': lib_type,
-                        'genome_id': params.get(self.PARAM_IN_ASM_GEN_REF),
-                        'alignment_stats': aligner_stats
-                        }
-        optional_params = [self.PARAM_IN_ALIGNED_USING,
-                           self.PARAM_IN_ALIGNER_VER,
-                           self.PARAM_IN_ALIGNER_OPTS,
-                           self.PARAM_IN_REPLICATE_ID,
-                           self.PARAM_IN_PLATFORM,
-                           self.PARAM_IN_BOWTIE2_INDEX,
-                           self.PARAM_IN_SAMPLESET_REF,
-                           self.PARAM_IN_MAPPED_SAMPLE_ID
-                           ]
-        for opt_param in optional_params:
-            if opt_param in params and params[opt_param] is not None:
-                aligner_data[opt_param] = params[opt_param]
-
-        self.__LOGGER.info('=========  Adding extra_provenance_refs')
-        self.__LOGGER.info(params.get(self.PARAM_IN_READ_LIB_REF))
-        self.__LOGGER.info(params.get(self.PARAM_IN_ASM_GEN_REF))
-        self.__LOGGER.info('=======================================')
-
-        res = self.dfu.save_objects({"id": ws_name_id,
-                                     "objects": [{"type": "KBaseRNASeq.RNASeqAlignment",
-                                                  "data": aligner_data,
-                                                  "name": obj_name_id,
-                                                  "extra_provenance_input_refs":
-                                                      [params.get(self.PARAM_IN_READ_LIB_REF),
-                                                       params.get(self.PARAM_IN_ASM_GEN_REF)]}
-                                                 ]})[0]
-        self.__LOGGER.info('save complete')
-
-        returnVal = {'obj_ref': str(res[6]) + '/' + str(res[0]) + '/' + str(res[4])}
+        # the merged file of a multi-file upload and the companion files are
+        # removed once uploaded
+        scratch_dirs = []
+        try:
+            stats_mode = params.get(self.PARAM_IN_STATS_MODE) or self.STATS_MODE_EXACT
+            part_states = None
+            if params.get(self.PARAM_IN_FILES):
+                # the stats of the parts are combined, unless the merged file is
+                # read anyway for the extended stats or coverage
+                with_part_stats = not (params.get(self.PARAM_IN_EXTENDED_STATS, False) or
+                                       params.get(self.PARAM_IN_COVERAGE_TILES, False))
+                file_path, part_states = self._merge_parts(params[self.PARAM_IN_FILES], stats_mode,
+                                                           with_part_stats, timer)
+                scratch_dirs.append(os.path.dirname(file_path))
+
+            dir, file_name, file_base, file_ext = self._get_file_path_info(file_path)
+
+            if self.PARAM_IN_VALIDATE in params and params[self.PARAM_IN_VALIDATE] is True:
+                with timer.stage('validate'):
+                    if self._validate(dict(params, file_path=file_path)) == 1:
+                        raise Exception('{0} failed validation'.format(file_path))
+
+            bam_file = file_path
+            if file_ext.lower() == '.sam':
+                bam_file = os.path.join(dir, file_base + '.bam')
+                with timer.stage('convert'):
+                    self.samtools.convert_sam_to_sorted_bam(ifile=file_name, ipath=dir,
+                                                            ofile=bam_file)
+
+            with timer.stage('upload'):
+                uploaded_file = self.dfu.file_to_shock({'file_path': bam_file,
+                                                        'make_handle': 1
+                                                        })
+            file_handle = uploaded_file['handle']
+            file_size = uploaded_file['size']
+            BYTES_PROCESSED.inc(file_size, method='upload_alignment')
+
+            # companion files computed in the stats pass, by name
+            collectors = {}
+            if params.get(self.PARAM_IN_EXTENDED_STATS, False):
+                from ReadsAlignmentUtils.core.qc_stats import QCStatsAccumulator
+                collectors['qc_stats'] = QCStatsAccumulator()
+            if params.get(self.PARAM_IN_COVERAGE_TILES, False):
+                collectors['coverage'] = self._get_coverage_accumulator(bam_file)
+            companion_dir = os.path.join(self.scratch, 'companions_' + str(uuid.uuid4()))
+            scratch_dirs.append(companion_dir)
+            state_path = None
+            if params.get(self.PARAM_IN_MERGEABLE_STATS, False):
+                self._mkdir_p(companion_dir)
+                state_path = os.path.join(companion_dir, '{}.{}.npz'.format(
+                    file_base, self.STATS_STATE_COMPANION))
+            with timer.stage('stats'):
+                if part_states:
+                    _, aligner_stats, stats_error_bounds = self._merge_stats_states(part_states,
+                                                                                    state_path)
+                else:
+                    # the sorted bam, so the coverage is read in coordinate order
+                    aligner_stats, stats_error_bounds = self._get_aligner_stats_and_error_bounds(
+                        bam_file, stats_mode, list(collectors.values()), state_path)
+                # a bai next to the bam file gives the per-contig counts for free
+                index_output = self._get_index_stats(
+                    [bam_file], aligner_stats, check=stats_mode == self.STATS_MODE_EXACT)
+            feature_counts = None
+            if params.get(self.PARAM_IN_COUNT_FEATURES, False):
+                with timer.stage('count_features'):
+                    feature_counts = self._count_features([bam_file],
+                                                          params.get(self.PARAM_IN_ASM_GEN_REF))
+            aligner_data = {'file': file_handle,
+                            'size': file_size,
+                            'condition': params.get(self.PARAM_IN_CONDITION),
+                            'read_sample_id': params.get(self.PARAM_IN_READ_LIB_REF),
+                            'library_type': lib_type,
+                            'genome_id': params.get(self.PARAM_IN_ASM_GEN_REF),
+                            'alignment_stats': aligner_stats
+                            }
+            optional_params = [self.PARAM_IN_ALIGNED_USING,
+                               self.PARAM_IN_ALIGNER_VER,
+                               self.PARAM_IN_ALIGNER_OPTS,
+                               self.PARAM_IN_REPLICATE_ID,
+                               self.PARAM_IN_PLATFORM,
+                               self.PARAM_IN_BOWTIE2_INDEX,
+                               self.PARAM_IN_SAMPLESET_REF,
+                               self.PARAM_IN_MAPPED_SAMPLE_ID
+                               ]
+            for opt_param in optional_params:
+                if opt_param in params and params[opt_param] is not None:
+                    aligner_data[opt_param] = params[opt_param]
+
+            # the stats mode is kept in the object metadata, as the typed stats can't hold
+            # it, and so are the shock ids of the companion files
+            meta = {"stats_mode": stats_mode}
+            if collectors or feature_counts is not None or state_path is not None:
+                with timer.stage('companions'):
+                    self._mkdir_p(companion_dir)
+                    companions = {name: collector.save(os.path.join(
+                        companion_dir, '{}.{}.npz'.format(file_base, name)))
+                        for name, collector in collectors.items()}
+                    if state_path is not None:
+                        companions[self.STATS_STATE_COMPANION] = state_path
+                    if feature_counts is not None:
+                        from ReadsAlignmentUtils.core.feature_counts import write_counts
+                        companions['feature_counts'] = write_counts(feature_counts, os.path.join(
+                            companion_dir, file_base + '.feature_counts.tsv'))
+                    meta.update(self._upload_companions(companions))
+
+            self.__LOGGER.info('=========  Adding extra_provenance_refs')
+            self.__LOGGER.info(params.get(self.PARAM_IN_READ_LIB_REF))
+            self.__LOGGER.info(params.get(self.PARAM_IN_ASM_GEN_REF))
+            self.__LOGGER.info('=======================================')
+
+            with timer.stage('save'):
+                provenance_refs = [params.get(self.PARAM_IN_READ_LIB_REF),
+                                   params.get(self.PARAM_IN_ASM_GEN_REF)]
+                res = self.dfu.save_objects({"id": ws_name_id,
+                                             "objects": [{"type": "KBaseRNASeq.RNASeqAlignment",
+                                                          "data": aligner_data,
+                                                          "name": obj_name_id,
+                                                          "meta": meta,
+                                                          "extra_provenance_input_refs":
+                                                              provenance_refs}
+                                                         ]})[0]
+            self.__LOGGER.info('save complete')
+
+            returnVal = {'obj_ref': str(res[6]) + '/' + str(res[0]) + '/' + str(res[4])}
+            if stats_error_bounds is not None:
+                returnVal['stats_error_bounds'] = stats_error_bounds
+            returnVal.update(index_output)
+            if 'qc_stats' in collectors:
+                returnVal['qc_stats'] = collectors['qc_stats'].summary()
+            if feature_counts is not None:
+                returnVal['feature_counts'] = {key: feature_counts[key] for key in
+                                               ('counted_reads', 'no_feature', 'ambiguous')}
+            if params.get(self.PARAM_IN_REPORT_TIMINGS, False):
+                returnVal['timings'] = timer.report()
+        finally:
+            for scratch_dir in scratch_dirs:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
 
         self.__LOGGER.info('Uploaded object: ')
         self.__LOGGER.info(returnVal)
@@ -545,7 +1112,14 @@ stored alignment.
            true. @range (0, 1)), parameter "downloadBAI" of type "boolean" (A
            boolean - 0 for false, 1 for true. @range (0, 1)), parameter
            "validate" of type "boolean" (A boolean - 0 for false, 1 for true.
-           @range (0, 1)), parameter "ignore" of list of String
+           @range (0, 1)), parameter "ignore" of list of String, parameter
+           "report_timings" of type "boolean" (A boolean - 0 for false, 1 for
+           true. @range (0, 1)), parameter "downloadCompanions" of type
+           "boolean" (A boolean - 0 for false, 1 for true. @range (0, 1)),
+           parameter "downloadParquet" of type "boolean" (A boolean - 0 for
+           false, 1 for true. @range (0, 1)), parameter "parquet_fields" of
+           list of String, parameter "split_by_contig" of type "boolean" (A
+           boolean - 0 for false, 1 for true. @range (0, 1))
         :returns: instance of type "DownloadAlignmentOutput" (*  The output
            of the download method.  *) -> structure: parameter
            "destination_dir" of String, parameter "stats" of type
@@ -553,7 +1127,42 @@ stored alignment.
            Long, parameter "multiple_alignments" of Long, parameter
            "singletons" of Long, parameter "alignment_rate" of Double,
            parameter "unmapped_reads" of Long, parameter "mapped_reads" of
-           Long, parameter "total_reads" of Long
+           Long, parameter "total_reads" of Long, parameter "timings" of list
+           of type "StageTiming" (* Wall and CPU time (in seconds) of a stage
+           of a method call, e.g. resolve_params, validate, convert, upload,
+           stats, save, download or index. cpu_time is the CPU time of the
+           thread running the stage, process_cpu_time that of the service
+           process during the stage, including other threads such as
+           concurrent stages. peak_rss_kb is the peak RSS of the service
+           process so far at the end of the stage. child_cpu_time and
+           child_peak_rss_kb cover the external processes run during the
+           stage. *) -> structure: parameter "stage" of String, parameter
+           "wall_time" of Double, parameter "cpu_time" of Double, parameter
+           "process_cpu_time" of Double, parameter "peak_rss_kb" of Long,
+           parameter "child_cpu_time" of Double, parameter
+           "child_peak_rss_kb" of Long, parameter "processes" of list of type
+           "ProcessTiming" (* Resource use of an external process (samtools,
+           Picard) run during a stage. cpu_time is user + system time in
+           seconds. peak_rss_kb is null if the process did not raise the peak
+           RSS of the child processes run so far. *) -> structure: parameter
+           "name" of String, parameter "wall_time" of Double, parameter
+           "cpu_time" of Double, parameter "peak_rss_kb" of Long, parameter
+           "contig_stats" of list of type "ContigStats" (* Mapped and
+           unmapped record counts of a reference of a BAM file, read from its
+           BAI index as by samtools idxstats. The last entry, contig '*',
+           counts the unmapped records without a position. *) -> structure:
+           parameter "contig" of String, parameter "length" of Long,
+           parameter "mapped" of Long, parameter "unmapped" of Long,
+           parameter "stats_match_index" of type "boolean" (A boolean - 0 for
+           false, 1 for true. @range (0, 1)), parameter "companion_files" of
+           mapping from String to String, parameter "contig_shards" of list
+           of type "ContigShard" (* A bam file of the records of some of the
+           references of an alignment, written with split_by_contig, and its
+           BAI index. A reference of at least contig_split_group_bases has a
+           shard of its own and the smaller ones are grouped. The unplaced
+           unmapped records are in the shard of contig '*'. *) -> structure:
+           parameter "contigs" of list of String, parameter "bam_file" of
+           String, parameter "bai_file" of String
         """
         # ctx is the context object
         # return variables are: returnVal
@@ -562,59 +1171,78 @@ stored alignment.
         self.__LOGGER.info('Running download_alignment with params:\n' +
                  pformat(params))
 
+        timer = self._get_stage_timer('download_alignment')
+
         inref = params.get(self.PARAM_IN_SRC_REF)
         if not inref:
             raise ValueError('{} parameter is required'.format(self.PARAM_IN_SRC_REF))
+        if params.get(self.PARAM_IN_DOWNLOAD_PARQUET, False):
+            parquet_fields = self._get_parquet_fields(params)
 
-        try:
-            alignment = self.dfu.get_objects({'object_refs': [inref]})['data']
-        except DFUError as e:
-            self.__LOGGER.error('Logging stacktrace from workspace exception:\n' + e.data)
-            raise
+        with timer.stage('resolve_params'):
+            try:
+                alignment = self.dfu.get_objects({'object_refs': [inref]})['data']
+            except DFUError as e:
+                self.__LOGGER.error('Logging stacktrace from workspace exception:\n' + e.data)
+                raise
 
         # set the output dir
         uuid_str = str(uuid.uuid4())
         output_dir = os.path.join(self.scratch, 'download_' + uuid_str)
         self._mkdir_p(output_dir)
 
-        file_ret = self.dfu.shock_to_file({'shock_id': alignment[0]['data']['file']['id'],
-                                           'file_path': output_dir
-                                           })
-        if zipfile.is_zipfile(file_ret.get('file_path')):
-            with zipfile.ZipFile(file_ret.get('file_path')) as z:
-                z.extractall(output_dir)
+        with timer.stage('download'):
+            file_ret = self.dfu.shock_to_file({'shock_id': alignment[0]['data']['file']['id'],
+                                               'file_path': output_dir
+                                               })
+            BYTES_PROCESSED.inc(file_ret.get('size') or 0, method='download_alignment')
+            # legacy objects saved the bam file in a zip package
+            if zipfile.is_zipfile(file_ret.get('file_path')):
+                from ReadsAlignmentUtils.core.legacy_package import extract_alignment_files
+                extract_alignment_files(file_ret.get('file_path'), output_dir)
 
-        for f in glob.glob(output_dir + '/*.zip'):
-            os.remove(f)
-
-        bam_files = glob.glob(output_dir + '/*.bam')
+        bam_files = sorted(os.path.join(output_dir, f) for f in os.listdir(output_dir)
+                           if f.endswith('.bam'))
 
         if len(bam_files) == 0:
             raise ValueError("Alignment object does not contain a bam file")
 
-        for bam_file_path in bam_files:
-            dir, file_name, file_base, file_ext = self._get_file_path_info(bam_file_path)
-            if params.get(self.PARAM_IN_VALIDATE, False):
-                validate_params = {'file_path': bam_file_path}
-                if self._validate(validate_params) == 1:
-                    raise Exception('{0} failed validation'.format(bam_file_path))
+        # the bam files are validated before anything is written from them,
+        # then their bai, sam and parquet files are written concurrently
+        if params.get(self.PARAM_IN_VALIDATE, False):
+            self._run_tasks([(self._validate_bam, bam_file_path, timer)
+                             for bam_file_path in bam_files], self.download_workers)
 
+        tasks = []
+        for bam_file_path in bam_files:
             if params.get(self.PARAM_IN_DOWNLOAD_BAI, False):
-                bai_file = file_base + '.bai'
-                bai_file_path = os.path.join(output_dir, bai_file)
-                self.samtools.create_bai_from_bam(ifile=file_name, ipath=output_dir, ofile=bai_file)
-                if not os.path.isfile(bai_file_path):
-                    raise ValueError('Error creating {}'.format(bai_file_path))
-
+                tasks.append((self._create_bai, bam_file_path, timer))
             if params.get(self.PARAM_IN_DOWNLOAD_SAM, False):
-                sam_file = file_base + '.sam'
-                sam_file_path = os.path.join(output_dir, sam_file)
-                self.samtools.convert_bam_to_sam(ifile=file_name, ipath=output_dir, ofile=sam_file)
-                if not os.path.isfile(sam_file_path):
-                    raise ValueError('Error creating {}'.format(sam_file_path))
+                tasks.append((self._create_sam, bam_file_path, timer))
+            if params.get(self.PARAM_IN_DOWNLOAD_PARQUET, False):
+                tasks.append((self._create_parquet, bam_file_path, parquet_fields, timer))
+        self._run_tasks(tasks, self.download_workers)
+
+        # shards are extracted with the bai index, in parallel within a bam file
+        contig_shards = []
+        if params.get(self.PARAM_IN_SPLIT_BY_CONTIG, False):
+            for bam_file_path in bam_files:
+                contig_shards.extend(self._split_by_contig(bam_file_path, timer))
 
         returnVal = {'destination_dir': output_dir,
                      'stats': alignment[0]['data']['alignment_stats']}
+        # objects saved before stats_mode existed have exact stats
+        stats_mode = (alignment[0]['info'][10] or {}).get('stats_mode', self.STATS_MODE_EXACT)
+        returnVal.update(self._get_index_stats(bam_files, returnVal['stats'],
+                                               check=stats_mode == self.STATS_MODE_EXACT))
+        if params.get(self.PARAM_IN_SPLIT_BY_CONTIG, False):
+            returnVal['contig_shards'] = contig_shards
+        if params.get(self.PARAM_IN_DOWNLOAD_COMPANIONS, False):
+            with timer.stage('companions'):
+                returnVal['companion_files'] = self._download_companions(
+                    alignment[0]['info'][10], output_dir)
+        if params.get(self.PARAM_IN_REPORT_TIMINGS, False):
+            returnVal['timings'] = timer.report()
 
         #END download_alignment
 
@@ -638,21 +1266,47 @@ stored alignment.
            true. @range (0, 1)), parameter "exportBAI" of type "boolean" (A
            boolean - 0 for false, 1 for true. @range (0, 1)), parameter
            "validate" of type "boolean" (A boolean - 0 for false, 1 for true.
-           @range (0, 1)), parameter "ignore" of list of String
+           @range (0, 1)), parameter "ignore" of list of String, parameter
+           "report_timings" of type "boolean" (A boolean - 0 for false, 1 for
+           true. @range (0, 1)), parameter "exportParquet" of type "boolean"
+           (A boolean - 0 for false, 1 for true. @range (0, 1)), parameter
+           "parquet_fields" of list of String
         :returns: instance of type "ExportOutput" -> structure: parameter
-           "shock_id" of String
+           "shock_id" of String, parameter "timings" of list of type
+           "StageTiming" (* Wall and CPU time (in seconds) of a stage of a
+           method call, e.g. resolve_params, validate, convert, upload,
+           stats, save, download or index. cpu_time is the CPU time of the
+           thread running the stage, process_cpu_time that of the service
+           process during the stage, including other threads such as
+           concurrent stages. peak_rss_kb is the peak RSS of the service
+           process so far at the end of the stage. child_cpu_time and
+           child_peak_rss_kb cover the external processes run during the
+           stage. *) -> structure: parameter "stage" of String, parameter
+           "wall_time" of Double, parameter "cpu_time" of Double, parameter
+           "process_cpu_time" of Double, parameter "peak_rss_kb" of Long,
+           parameter "child_cpu_time" of Double, parameter
+           "child_peak_rss_kb" of Long, parameter "processes" of list of type
+           "ProcessTiming" (* Resource use of an external process (samtools,
+           Picard) run during a stage. cpu_time is user + system time in
+           seconds. peak_rss_kb is null if the process did not raise the peak
+           RSS of the child processes run so far. *) -> structure: parameter
+           "name" of String, parameter "wall_time" of Double, parameter
+           "cpu_time" of Double, parameter "peak_rss_kb" of Long
         """
         # ctx is the context object
         # return variables are: output
         #BEGIN export_alignment
 
+        timer = self._get_stage_timer('export_alignment')
+
         inref = params.get(self.PARAM_IN_SRC_REF)
         if not inref:
             raise ValueError('{} parameter is required'.format(self.PARAM_IN_SRC_REF))
 
         if params.get(self.PARAM_IN_VALIDATE, False) or \
            params.get('exportBAI', False) or \
-           params.get('exportSAM', False):
+           params.get('exportSAM', False) or \
+           params.get('exportParquet', False):
             """
             Need to validate or convert files. Use download_alignment
             """
@@ -660,26 +1314,35 @@ stored alignment.
             for key, val in params.items():
                 download_params[key.replace('export', 'download')] = val
 
-            download_retVal = self.download_alignment(ctx, download_params)[0]
+            # the download stages are recorded on this timer
+            download_params.pop(self.PARAM_IN_REPORT_TIMINGS, None)
+            with timer.stage('download_alignment'):
+                download_retVal = self.download_alignment(ctx, download_params)[0]
 
             export_dir = download_retVal['destination_dir']
 
             # package and load to shock
-            ret = self.dfu.package_for_download({'file_path': export_dir,
-                                                 'ws_refs': [inref]
-                                                 })
+            with timer.stage('package'):
+                ret = self.dfu.package_for_download({'file_path': export_dir,
+                                                     'ws_refs': [inref]
+                                                     })
             output = {'shock_id': ret['shock_id']}
         else:
             """
             return shock id from the object
             """
-            try:
-                alignment = self.dfu.get_objects({'object_refs': [inref]})['data']
-            except DFUError as e:
-                self.__LOGGER.error('Logging stacktrace from workspace exception:\n' + e.data)
-                raise
+            with timer.stage('resolve_params'):
+                try:
+                    alignment = self.dfu.get_objects({'object_refs': [inref]})['data']
+                except DFUError as e:
+                    self.__LOGGER.error('Logging stacktrace from workspace exception:\n' +
+                                        e.data)
+                    raise
             output = {'shock_id': alignment[0]['data']['file']['id']}
 
+        if params.get(self.PARAM_IN_REPORT_TIMINGS, False):
+            output['timings'] = timer.report()
+
         #END export_alignment
 
         # At some point might do deeper type checking...
@@ -688,6 +1351,193 @@ stored alignment.
                              'output is not type dict as required.')
         # return the results
         return [output]
+
+    def count_features(self, ctx, params):
+        """
+        Counts the reads of an alignment per feature of its genome, as htseq-count in
+                union mode: primary mapped reads, pairs counted once, reads overlapping
+                several features counted as ambiguous. Contigs are counted in parallel. *
+        :param params: instance of type "CountFeaturesParams" (* Required
+           input parameters for counting the reads of an alignment per
+           feature string source_ref -  object reference of the alignment
+           string genome_ref -  Optional. Object reference of the
+           KBaseGenomes.Genome with the features to count. Default: the
+           genome_id of the alignment *) -> structure: parameter "source_ref"
+           of String, parameter "genome_ref" of String, parameter
+           "report_timings" of type "boolean" (A boolean - 0 for false, 1 for
+           true. @range (0, 1))
+        :returns: instance of type "CountFeaturesOutput" -> structure:
+           parameter "counts" of mapping from String to Long, parameter
+           "no_feature" of Long, parameter "ambiguous" of Long, parameter
+           "counted_reads" of Long, parameter "timings" of list of type
+           "StageTiming" (* Wall and CPU time (in seconds) of a stage of a
+           method call, e.g. resolve_params, validate, convert, upload,
+           stats, save, download or index. cpu_time is the CPU time of the
+           thread running the stage, process_cpu_time that of the service
+           process during the stage, including other threads such as
+           concurrent stages. peak_rss_kb is the peak RSS of the service
+           process so far at the end of the stage. child_cpu_time and
+           child_peak_rss_kb cover the external processes run during the
+           stage. *) -> structure: parameter "stage" of String, parameter
+           "wall_time" of Double, parameter "cpu_time" of Double, parameter
+           "process_cpu_time" of Double, parameter "peak_rss_kb" of Long,
+           parameter "child_cpu_time" of Double, parameter
+           "child_peak_rss_kb" of Long, parameter "processes" of list of type
+           "ProcessTiming" (* Resource use of an external process (samtools,
+           Picard) run during a stage. cpu_time is user + system time in
+           seconds. peak_rss_kb is null if the process did not raise the peak
+           RSS of the child processes run so far. *) -> structure: parameter
+           "name" of String, parameter "wall_time" of Double, parameter
+           "cpu_time" of Double, parameter "peak_rss_kb" of Long
+        """
+        # ctx is the context object
+        # return variables are: returnVal
+        #BEGIN count_features
+
+        timer = self._get_stage_timer('count_features')
+
+        inref = params.get(self.PARAM_IN_SRC_REF)
+        if not inref:
+            raise ValueError('{} parameter is required'.format(self.PARAM_IN_SRC_REF))
+
+        genome_ref = params.get(self.PARAM_IN_GENOME_REF)
+        if not genome_ref:
+            with timer.stage('resolve_params'):
+                from installed_clients.WorkspaceClient import Workspace
+                ws = Workspace(self.ws_url)
+                try:
+                    alignment = ws.get_objects2({'objects': [{
+                        'ref': inref, 'included': ['genome_id']}]})['data'][0]
+                except WorkspaceError as wse:
+                    self.__LOGGER.error('Logging workspace exception')
+                    self.__LOGGER.error(str(wse))
+                    raise
+                genome_ref = alignment['data']['genome_id']
+
+        # the bai lets contigs be counted in parallel
+        with timer.stage('download_alignment'):
+            download = self.download_alignment(ctx, {self.PARAM_IN_SRC_REF: inref,
+                                                     self.PARAM_IN_DOWNLOAD_BAI: True})[0]
+        bam_files = glob.glob(download['destination_dir'] + '/*.bam')
+
+        with timer.stage('count'):
+            returnVal = self._count_features(bam_files, genome_ref)
+
+        if params.get(self.PARAM_IN_REPORT_TIMINGS, False):
+            returnVal['timings'] = timer.report()
+
+        #END count_features
+
+        # At some point might do deeper type checking...
+        if not isinstance(returnVal, dict):
+            raise ValueError('Method count_features return value ' +
+                             'returnVal is not type dict as required.')
+        # return the results
+        return [returnVal]
+
+    def merge_alignment_stats(self, ctx, params):
+        """
+        Combines the stats of alignments uploaded with mergeable_stats, e.g. the
+                lanes or technical replicates of a sample, from their saved counters and
+                read id sets, without reading the alignments again. The stats are those of
+                the alignments merged into one, as long as they are all paired or all
+                single end. *
+        :param params: instance of type "MergeAlignmentStatsParams" (*
+           Required input parameters for merging the stats of alignments
+           list<string> alignment_refs -  object references of the
+           alignments, uploaded with mergeable_stats *) -> structure:
+           parameter "alignment_refs" of list of String, parameter
+           "report_timings" of type "boolean" (A boolean - 0 for false, 1 for
+           true. @range (0, 1))
+        :returns: instance of type "MergeAlignmentStatsOutput" -> structure:
+           parameter "stats" of type "AlignmentStats" -> structure: parameter
+           "properly_paired" of Long, parameter "multiple_alignments" of
+           Long, parameter "singletons" of Long, parameter "alignment_rate"
+           of Double, parameter "unmapped_reads" of Long, parameter
+           "mapped_reads" of Long, parameter "total_reads" of Long, parameter
+           "stats_mode" of String, parameter "stats_error_bounds" of type
+           "AlignmentStats" -> structure: parameter "properly_paired" of
+           Long, parameter "multiple_alignments" of Long, parameter
+           "singletons" of Long, parameter "alignment_rate" of Double,
+           parameter "unmapped_reads" of Long, parameter "mapped_reads" of
+           Long, parameter "total_reads" of Long, parameter "timings" of list
+           of type "StageTiming" (* Wall and CPU time (in seconds) of a stage
+           of a method call, e.g. resolve_params, validate, convert, upload,
+           stats, save, download or index. cpu_time is the CPU time of the
+           thread running the stage, process_cpu_time that of the service
+           process during the stage, including other threads such as
+           concurrent stages. peak_rss_kb is the peak RSS of the service
+           process so far at the end of the stage. child_cpu_time and
+           child_peak_rss_kb cover the external processes run during the
+           stage. *) -> structure: parameter "stage" of String, parameter
+           "wall_time" of Double, parameter "cpu_time" of Double, parameter
+           "process_cpu_time" of Double, parameter "peak_rss_kb" of Long,
+           parameter "child_cpu_time" of Double, parameter
+           "child_peak_rss_kb" of Long, parameter "processes" of list of type
+           "ProcessTiming" (* Resource use of an external process (samtools,
+           Picard) run during a stage. cpu_time is user + system time in
+           seconds. peak_rss_kb is null if the process did not raise the peak
+           RSS of the child processes run so far. *) -> structure: parameter
+           "name" of String, parameter "wall_time" of Double, parameter
+           "cpu_time" of Double, parameter "peak_rss_kb" of Long
+        """
+        # ctx is the context object
+        # return variables are: returnVal
+        #BEGIN merge_alignment_stats
+
+        timer = self._get_stage_timer('merge_alignment_stats')
+
+        refs = params.get(self.PARAM_IN_ALIGNMENT_REFS)
+        if not refs:
+            raise ValueError('{} parameter is required'.format(self.PARAM_IN_ALIGNMENT_REFS))
+
+        with timer.stage('resolve_params'):
+            from installed_clients.WorkspaceClient import Workspace
+            ws = Workspace(self.ws_url)
+            try:
+                infos = ws.get_object_info3({'objects': [{'ref': ref} for ref in refs],
+                                             'includeMetadata': 1})['infos']
+            except WorkspaceError as wse:
+                self.__LOGGER.error('Logging workspace exception')
+                self.__LOGGER.error(str(wse))
+                raise
+        state_key = self.COMPANION_META_PREFIX + self.STATS_STATE_COMPANION
+        for ref, info in zip(refs, infos):
+            if state_key not in (info[10] or {}):
+                raise ValueError('{} was not uploaded with {}, its stats can not be '
+                                 'merged'.format(ref, self.PARAM_IN_MERGEABLE_STATS))
+
+        output_dir = os.path.join(self.scratch, 'merge_stats_' + str(uuid.uuid4()))
+        with timer.stage('download'):
+            state_paths = []
+            for info in infos:
+                # each state in its own directory, as they may share a file name
+                state_dir = os.path.join(output_dir, str(len(state_paths)))
+                self._mkdir_p(state_dir)
+                file_ret = self.dfu.shock_to_file({'shock_id': info[10][state_key],
+                                                   'file_path': state_dir})
+                BYTES_PROCESSED.inc(file_ret.get('size') or 0, method='merge_alignment_stats')
+                state_paths.append(file_ret['file_path'])
+
+        with timer.stage('merge'):
+            stats_mode, stats, error_bounds = self._merge_stats_states(state_paths)
+        returnVal = {'stats': stats,
+                     'stats_mode': stats_mode}
+        if error_bounds is not None:
+            returnVal['stats_error_bounds'] = error_bounds
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+        if params.get(self.PARAM_IN_REPORT_TIMINGS, False):
+            returnVal['timings'] = timer.report()
+
+        #END merge_alignment_stats
+
+        # At some point might do deeper type checking...
+        if not isinstance(returnVal, dict):
+            raise ValueError('Method merge_alignment_stats return value ' +
+                             'returnVal is not type dict as required.')
+        # return the results
+        return [returnVal]
     def status(self, ctx):
         #BEGIN_STATUS
         returnVal = {'state': "OK",
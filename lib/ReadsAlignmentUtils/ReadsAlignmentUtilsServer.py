@@ -5,7 +5,9 @@ import json
 import os
 import random as _random
 import sys
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from getopt import getopt, GetoptError
 from multiprocessing import Process
 from os import environ
@@ -18,6 +20,10 @@ from jsonrpcbase import ServerError as JSONServerError
 
 from biokbase import log
 from ReadsAlignmentUtils.authclient import KBaseAuth as _KBaseAuth
+from ReadsAlignmentUtils.core import metrics
+from ReadsAlignmentUtils.core import profiling
+from ReadsAlignmentUtils.core.resource_queue import ResourceQueue
+from ReadsAlignmentUtils.core.sam_tools import get_tool_queue
 
 try:
     from ConfigParser import ConfigParser
@@ -28,6 +34,18 @@ DEPLOY = 'KB_DEPLOYMENT_CONFIG'
 SERVICE = 'KB_SERVICE_NAME'
 AUTH = 'auth-service-url'
 
+# Methods that are run through the job queue, with the CPUs and memory (in MB)
+# a call is expected to use. A request may override these in its context,
+# e.g. "context": {"resources": {"cpu": 4, "memory_mb": 8192}}
+QUEUED_METHODS = {
+    'ReadsAlignmentUtils.validate_alignment': {'cpu': 1, 'memory_mb': 2048},
+    'ReadsAlignmentUtils.upload_alignment': {'cpu': 2, 'memory_mb': 2048},
+    'ReadsAlignmentUtils.download_alignment': {'cpu': 1, 'memory_mb': 1024},
+    'ReadsAlignmentUtils.export_alignment': {'cpu': 1, 'memory_mb': 1024},
+    'ReadsAlignmentUtils.count_features': {'cpu': 2, 'memory_mb': 2048},
+    'ReadsAlignmentUtils.merge_alignment_stats': {'cpu': 1, 'memory_mb': 2048},
+}
+
 # Note that the error fields do not match the 2.0 JSONRPC spec
 
 
@@ -299,6 +317,22 @@ class ServerError(Exception):
             '\n' + self.data
 
 
+def call_with_profiling(ctx, req, call):
+    """
+    Returns call(ctx, req), run under cProfile if profiling was requested for
+    this call through the KB_PROFILE_CALLS environment variable or the
+    "profile" flag in the request context
+    """
+    if not profiling.profiling_requested(req.get('context')):
+        return call(ctx, req)
+    scratch = (config or {}).get('scratch') or '/tmp'
+    result, pstats_path = profiling.profile_call(os.path.join(scratch, 'profiles'),
+                                                 ctx.get('call_id') or req.get('id'),
+                                                 call, ctx, req)
+    application.log(log.INFO, ctx, 'wrote profile ' + pstats_path)
+    return result
+
+
 def getIPAddress(environ):
     xFF = environ.get('HTTP_X_FORWARDED_FOR')
     realIP = environ.get('HTTP_X_REAL_IP')
@@ -342,6 +376,10 @@ class Application(object):
                              name='ReadsAlignmentUtils.validate_alignment',
                              types=[dict])
         self.method_authentication['ReadsAlignmentUtils.validate_alignment'] = 'required'  # noqa
+        self.rpc_service.add(impl_ReadsAlignmentUtils.estimate_alignment_stats,
+                             name='ReadsAlignmentUtils.estimate_alignment_stats',
+                             types=[dict])
+        self.method_authentication['ReadsAlignmentUtils.estimate_alignment_stats'] = 'required'  # noqa
         self.rpc_service.add(impl_ReadsAlignmentUtils.upload_alignment,
                              name='ReadsAlignmentUtils.upload_alignment',
                              types=[dict])
@@ -354,17 +392,87 @@ class Application(object):
                              name='ReadsAlignmentUtils.export_alignment',
                              types=[dict])
         self.method_authentication['ReadsAlignmentUtils.export_alignment'] = 'required'  # noqa
+        self.rpc_service.add(impl_ReadsAlignmentUtils.count_features,
+                             name='ReadsAlignmentUtils.count_features',
+                             types=[dict])
+        self.method_authentication['ReadsAlignmentUtils.count_features'] = 'required'  # noqa
+        self.rpc_service.add(impl_ReadsAlignmentUtils.merge_alignment_stats,
+                             name='ReadsAlignmentUtils.merge_alignment_stats',
+                             types=[dict])
+        self.method_authentication['ReadsAlignmentUtils.merge_alignment_stats'] = 'required'  # noqa
         self.rpc_service.add(impl_ReadsAlignmentUtils.status,
                              name='ReadsAlignmentUtils.status',
                              types=[dict])
         authurl = config.get(AUTH) if config else None
         self.auth_client = _KBaseAuth(authurl)
+        queue_config = config or {}
+        self.job_queue = ResourceQueue(
+            queue_config.get('job_queue_cpu_slots') or os.cpu_count() or 1,
+            memory_mb=queue_config.get('job_queue_memory_mb'),
+            name='methods')
+        metrics.REGISTRY.add_collector(
+            metrics.queue_collector(self.job_queue, get_tool_queue(config)))
+
+    def get_job_resources(self, req):
+        """
+        Returns the resources a queued method call is expected to use, or None
+        if the method is not run through the job queue. Raises
+        InvalidParamsError if a resource of the context is not a non-negative
+        integer.
+        """
+        resources = QUEUED_METHODS.get(req['method'])
+        if resources is None:
+            return None
+        resources = dict(resources)
+        context = req.get('context')
+        if isinstance(context, dict) and isinstance(context.get('resources'), dict):
+            for key in resources:
+                value = context['resources'].get(key)
+                if value is None:
+                    continue
+                try:
+                    resources[key] = int(value)
+                except (TypeError, ValueError):
+                    resources[key] = -1
+                if resources[key] < 0:
+                    raise InvalidParamsError(
+                        'context resources {0} must be a non-negative integer, not {1!r}'.format(
+                            key, value))
+        return resources
+
+    def call_method(self, ctx, req):
+        """
+        Calls the requested method. Heavy methods wait for their turn in the
+        job queue so a burst of large uploads can not starve the server.
+        """
+        method = req['method']
+        if method not in self.rpc_service.method_data:
+            # keep arbitrary method names out of the metric labels
+            method = 'unknown'
+        metrics.IN_FLIGHT.inc(method=method)
+        start_time = time.time()
+        status = 'error'
+        try:
+            resources = self.get_job_resources(req)
+            if resources is None:
+                result = call_with_profiling(ctx, req, self.rpc_service.call)
+            else:
+                with self.job_queue.slot(**resources) as wait_time:
+                    self.log(log.INFO, ctx, 'waited {:.3f}s in job queue'.format(wait_time))
+                    result = call_with_profiling(ctx, req, self.rpc_service.call)
+            status = 'ok'
+            return result
+        finally:
+            metrics.IN_FLIGHT.dec(method=method)
+            metrics.REQUEST_DURATION.observe(time.time() - start_time, method=method)
+            metrics.REQUESTS.inc(method=method, status=status)
 
     def __call__(self, environ, start_response):
         # Context object, equivalent to the perl impl CallContext
         ctx = MethodContext(self.userlog)
         ctx['client_ip'] = getIPAddress(environ)
         status = '500 Internal Server Error'
+        content_type = 'application/json'
 
         try:
             body_size = int(environ.get('CONTENT_LENGTH', 0))
@@ -374,6 +482,17 @@ class Application(object):
             # we basically do nothing and just return headers
             status = '200 OK'
             rpc_result = ""
+        elif (environ['REQUEST_METHOD'] == 'GET' and
+                environ.get('PATH_INFO', '').rstrip('/') == '/queue'):
+            # depth and wait times of the method and external tool queues
+            status = '200 OK'
+            rpc_result = json.dumps({'methods': self.job_queue.stats(),
+                                     'tools': get_tool_queue(config).stats()})
+        elif (environ['REQUEST_METHOD'] == 'GET' and
+                environ.get('PATH_INFO', '').rstrip('/') == '/metrics'):
+            status = '200 OK'
+            content_type = 'text/plain; version=0.0.4'
+            rpc_result = metrics.REGISTRY.render()
         else:
             request_body = environ['wsgi.input'].read(body_size)
             try:
@@ -431,7 +550,7 @@ class Application(object):
                         self.log(log.INFO, ctx, 'X-Forwarded-For: ' +
                                  environ.get('HTTP_X_FORWARDED_FOR'))
                     self.log(log.INFO, ctx, 'start method')
-                    rpc_result = self.rpc_service.call(ctx, req)
+                    rpc_result = self.call_method(ctx, req)
                     self.log(log.INFO, ctx, 'end method')
                     status = '200 OK'
                 except JSONRPCError as jre:
@@ -467,7 +586,7 @@ class Application(object):
             ('Access-Control-Allow-Origin', '*'),
             ('Access-Control-Allow-Headers', environ.get(
                 'HTTP_ACCESS_CONTROL_REQUEST_HEADERS', 'authorization')),
-            ('content-type', 'application/json'),
+            ('content-type', content_type),
             ('content-length', str(len(response_body)))]
         start_response(status, response_headers)
         return [response_body.encode('utf8')]
@@ -562,34 +681,58 @@ def stop_server():
     _proc = None
 
 
-def process_async_cli(input_file_path, output_file_path, token):
-    exit_code = 0
-    with open(input_file_path) as data_file:
-        req = json.load(data_file)
-    if 'version' not in req:
-        req['version'] = '1.1'
-    if 'id' not in req:
-        req['id'] = str(_random.random())[2:]
-    ctx = MethodContext(application.userlog)
-    if token:
-        user = application.auth_client.get_user(token)
-        ctx['user_id'] = user
-        ctx['authenticated'] = 1
-        ctx['token'] = token
-    if 'context' in req:
-        ctx['rpc_context'] = req['context']
-    ctx['CLI'] = 1
-    ctx['module'], ctx['method'] = req['method'].split('.')
-    prov_action = {'service': ctx['module'], 'method': ctx['method'],
-                   'method_params': req['params']}
-    ctx['provenance'] = [prov_action]
+def get_async_batch_workers():
+    """
+    Number of requests from a batch input file that are run concurrently
+    """
+    if config is None:
+        return 1
+    return max(int(config.get('async_batch_workers', 1)), 1)
+
+
+def process_async_request(req, user, token):
+    """
+    Runs one request of the async CLI and returns its response, or a JSON-RPC
+    error response if the request is malformed or fails
+    """
+    req_id = None
+    version = '1.1'
     resp = None
     try:
-        resp = application.rpc_service.call_py(ctx, req)
+        if not isinstance(req, dict):
+            err = InvalidRequestError()
+            err.data = 'The request must be an object'
+            raise err
+        if 'version' not in req:
+            req['version'] = '1.1'
+        if 'id' not in req:
+            req['id'] = str(_random.random())[2:]
+        req_id = req['id']
+        version = req['version']
+        method = req.get('method')
+        if (not isinstance(method, str) or method.count('.') != 1 or
+                'params' not in req):
+            err = InvalidRequestError()
+            err.data = ('The request must have a method of the form '
+                        'Module.method and params')
+            raise err
+        ctx = MethodContext(application.userlog)
+        if token:
+            ctx['user_id'] = user
+            ctx['authenticated'] = 1
+            ctx['token'] = token
+        if 'context' in req:
+            ctx['rpc_context'] = req['context']
+        ctx['CLI'] = 1
+        ctx['module'], ctx['method'] = method.split('.')
+        prov_action = {'service': ctx['module'], 'method': ctx['method'],
+                       'method_params': req['params']}
+        ctx['provenance'] = [prov_action]
+        resp = call_with_profiling(ctx, req, application.rpc_service.call_py)
     except JSONRPCError as jre:
         trace = jre.trace if hasattr(jre, 'trace') else None
-        resp = {'id': req['id'],
-                'version': req['version'],
+        resp = {'id': req_id,
+                'version': version,
                 'error': {'code': jre.code,
                           'name': jre.message,
                           'message': jre.data,
@@ -597,15 +740,43 @@ def process_async_cli(input_file_path, output_file_path, token):
                 }
     except Exception:
         trace = traceback.format_exc()
-        resp = {'id': req['id'],
-                'version': req['version'],
+        resp = {'id': req_id,
+                'version': version,
                 'error': {'code': 0,
                           'name': 'Unexpected Server Error',
                           'message': 'An unexpected server error occurred',
                           'error': trace}
                 }
-    if 'error' in resp:
-        exit_code = 500
+    return resp
+
+
+def process_async_cli(input_file_path, output_file_path, token):
+    """
+    Runs the request in input_file_path and writes the response to
+    output_file_path. The input file may also hold a list of requests, which
+    are run in this process (async_batch_workers at a time) and whose
+    responses are written as a list in the same order.
+    """
+    exit_code = 0
+    with open(input_file_path) as data_file:
+        req = json.load(data_file)
+    user = None
+    if token:
+        user = application.auth_client.get_user(token)
+    if isinstance(req, list):
+        workers = min(get_async_batch_workers(), max(len(req), 1))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                resp = list(executor.map(
+                    lambda r: process_async_request(r, user, token), req))
+        else:
+            resp = [process_async_request(r, user, token) for r in req]
+        if any('error' in r for r in resp):
+            exit_code = 500
+    else:
+        resp = process_async_request(req, user, token)
+        if 'error' in resp:
+            exit_code = 500
     with open(output_file_path, "w") as f:
         f.write(json.dumps(resp, cls=JSONObjectEncoder))
     return exit_code
@@ -0,0 +1,571 @@
+import math
+import os
+import shutil
+import tempfile
+import zipfile
+from array import array
+
+import numpy as np
+
+'''
+Alignment stats computed from the flags and read names of BAM records.
+
+Read names are reduced to 64-bit FNV-1a hashes. The distinct hashes of each
+category (mapped and secondary, left, right and single end) are kept in
+memory up to a budget, past which sorted runs of them are spilled to scratch
+and merged when the counts are taken. Both paths give the same counts.
+'''
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+
+FNV_OFFSET = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+_MASK64 = 0xffffffffffffffff
+
+# number of hashes read from a spilled run at a time
+RUN_BLOCK_SIZE = 1 << 20
+
+
+def read_id_hash(read_id):
+    """
+    Returns the 64-bit FNV-1a hash of a read name (str or bytes)
+    """
+    if isinstance(read_id, str):
+        read_id = read_id.encode()
+    h = FNV_OFFSET
+    for byte in read_id or b'':
+        h = ((h ^ byte) * FNV_PRIME) & _MASK64
+    return h
+
+
+def read_id_hashes(data, starts, lengths):
+    """
+    Returns the read_id_hash of many read names at once, as a uint64 array.
+
+    :param data: uint8 array holding the read names
+    :param starts: offsets of the read names in data
+    :param lengths: lengths of the read names
+    """
+    # longest names first, so the names longer than i are a prefix
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind='stable')
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    lengths = np.asarray(lengths, dtype=np.int64)[order]
+    longer = np.searchsorted(-lengths, -np.arange(int(lengths[0]) if len(lengths) else 0),
+                             side='left')
+    hashes = np.full(len(starts), FNV_OFFSET, dtype=np.uint64)
+    prime = np.uint64(FNV_PRIME)
+    # one step per byte position, over the names longer than it
+    for i, n in enumerate(longer):
+        hashes[:n] = (hashes[:n] ^ data[starts[:n] + i]) * prime
+    result = np.empty_like(hashes)
+    result[order] = hashes
+    return result
+
+
+def _run_blocks(path):
+    with open(path, 'rb') as run:
+        while True:
+            block = np.fromfile(run, dtype=np.uint64, count=RUN_BLOCK_SIZE)
+            if not block.size:
+                return
+            yield block
+
+
+def _write_array(package, name, array=None, dtype=None, shape=None, blocks=None):
+    """
+    Writes an array to a member of a .npz package, or an array of dtype and
+    shape given as blocks, so that it is never held in memory as a whole
+    """
+    if array is not None:
+        dtype, shape, blocks = array.dtype, array.shape, [array]
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False,
+              'shape': shape}
+    with package.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array_header_1_0(member, header)
+        for block in blocks:
+            member.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+
+
+def _read_blocks(package, name):
+    """
+    Yields a 1-dimensional array of a member of a .npz package in blocks of
+    RUN_BLOCK_SIZE
+    """
+    with package.open(name + '.npy') as member:
+        if np.lib.format.read_magic(member) == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(member)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(member)
+        remaining = shape[0]
+        while remaining:
+            count = min(RUN_BLOCK_SIZE, remaining)
+            data = member.read(count * dtype.itemsize)
+            if len(data) != count * dtype.itemsize:
+                raise ValueError('Truncated array {0} in {1}'.format(name, package.filename))
+            remaining -= count
+            yield np.frombuffer(data, dtype=dtype)
+
+
+def _merge_sorted(sources):
+    """
+    Merges iterables of sorted blocks of distinct hashes into sorted blocks of
+    the distinct hashes of all of them
+    """
+    sources = [iter(source) for source in sources]
+    heads = []
+    for source in sources:
+        block = next(source, None)
+        if block is not None:
+            heads.append([block, source])
+    while heads:
+        # everything up to the smallest block end is complete, as the
+        # following blocks of each source only hold larger values
+        bound = min(block[-1] for block, _ in heads)
+        parts = []
+        for head in heads:
+            split = np.searchsorted(head[0], bound, side='right')
+            parts.append(head[0][:split])
+            head[0] = head[0][split:]
+            if not head[0].size:
+                head[0] = next(head[1], None)
+        heads = [head for head in heads if head[0] is not None]
+        yield np.unique(np.concatenate(parts))
+
+
+class ExactReadIdSet:
+    """
+    A set of read name hashes that spills to disk when the ExactReadIdSets
+    it was created by runs over its memory budget
+    """
+
+    # counts are exact, see AlignmentStatsAccumulator.error_bounds
+    relative_error = 0.0
+
+    def __init__(self, owner, name):
+        self.name = name
+        self._owner = owner
+        self._buffer = array('Q')
+        self._sorted = np.empty(0, dtype=np.uint64)
+        self._runs = []
+        self._count = None
+
+    def add(self, h):
+        self._buffer.append(h)
+        owner = self._owner
+        owner.used += 8
+        if owner.used > owner.budget:
+            owner.relieve()
+
+    def add_many(self, hashes):
+        """
+        Adds a uint64 array of hashes
+        """
+        self._buffer.frombytes(np.ascontiguousarray(hashes, dtype=np.uint64).tobytes())
+        owner = self._owner
+        owner.used += 8 * len(hashes)
+        if owner.used > owner.budget:
+            owner.relieve()
+
+    @property
+    def nbytes(self):
+        return self._sorted.nbytes + len(self._buffer) * 8
+
+    @property
+    def spilled(self):
+        return bool(self._runs)
+
+    def compact(self):
+        """
+        Merges the hashes added since the last compaction into the sorted
+        distinct hashes held in memory
+        """
+        if not self._buffer:
+            return
+        before = self.nbytes
+        added = np.frombuffer(self._buffer, dtype=np.uint64)
+        self._sorted = np.union1d(self._sorted, added)
+        self._buffer = array('Q')
+        self._count = None
+        self._owner.used += self.nbytes - before
+
+    def spill(self):
+        """
+        Writes the hashes held in memory to a sorted run in scratch
+        """
+        self.compact()
+        if not self._sorted.size:
+            return
+        path = os.path.join(self._owner.spill_path(),
+                            '{0}_{1}.run'.format(self.name, len(self._runs)))
+        self._sorted.tofile(path)
+        self._runs.append(path)
+        self._owner.used -= self._sorted.nbytes
+        self._sorted = np.empty(0, dtype=np.uint64)
+
+    def sorted_blocks(self):
+        """
+        Yields the distinct hashes of the set in sorted blocks
+        """
+        self.compact()
+        if not self._runs:
+            if self._sorted.size:
+                yield self._sorted
+            return
+        sources = [_run_blocks(path) for path in self._runs]
+        if self._sorted.size:
+            sources.append([self._sorted])
+        yield from _merge_sorted(sources)
+
+    def sorted_runs(self):
+        """
+        Returns the sorted runs of the set without merging them, as a list of
+        (size, sorted blocks) of the spilled runs and the hashes in memory.
+        Runs hold distinct hashes, but can share some.
+        """
+        self.compact()
+        runs = [(os.path.getsize(path) // 8, _run_blocks(path)) for path in self._runs]
+        if self._sorted.size:
+            runs.append((self._sorted.size, [self._sorted]))
+        return runs
+
+    def count(self):
+        """
+        Returns the number of distinct hashes in the set
+        """
+        if self._count is None:
+            self._count = sum(block.size for block in self.sorted_blocks())
+        return self._count
+
+    def intersection_count(self, other):
+        """
+        Returns the number of hashes in both this set and other
+        """
+        self.compact()
+        other.compact()
+        if not self._runs and not other._runs:
+            return np.intersect1d(self._sorted, other._sorted, assume_unique=True).size
+
+        count = mine = theirs = 0
+        a_blocks = self.sorted_blocks()
+        b_blocks = other.sorted_blocks()
+        a = next(a_blocks, None)
+        b = next(b_blocks, None)
+        while a is not None and b is not None:
+            bound = min(a[-1], b[-1])
+            a_split = np.searchsorted(a, bound, side='right')
+            b_split = np.searchsorted(b, bound, side='right')
+            count += np.intersect1d(a[:a_split], b[:b_split], assume_unique=True).size
+            mine += a_split
+            theirs += b_split
+            a = a[a_split:] if a_split < a.size else next(a_blocks, None)
+            b = b[b_split:] if b_split < b.size else next(b_blocks, None)
+        # the pass also counts both sets, which saves reading their runs again
+        while a is not None:
+            mine += a.size
+            a = next(a_blocks, None)
+        while b is not None:
+            theirs += b.size
+            b = next(b_blocks, None)
+        self._count = mine
+        other._count = theirs
+        return count
+
+
+class ExactReadIdSets:
+    """
+    Creates ExactReadIdSets sharing one memory budget.
+
+    When the hashes held by all sets exceed the budget, every set is
+    compacted to its sorted distinct hashes, which is often enough as mates
+    and multimappers repeat read names. If the sets still hold more than half
+    of the budget, the largest ones are spilled to sorted runs in a temporary
+    directory under spill_dir until they don't. Compacting briefly needs about
+    twice the memory of the set being compacted.
+
+    Usage:
+        with ExactReadIdSets(memory_mb=1024, spill_dir=scratch) as id_sets:
+            stats = AlignmentStatsAccumulator(id_sets)
+    """
+
+    def __init__(self, memory_mb=None, spill_dir=None):
+        """
+        :param memory_mb: memory budget of the hashes of all sets, in MB. None for no limit
+        :param spill_dir: directory to spill runs to, the system temp directory if None
+        """
+        self.budget = int(float(memory_mb) * 1024 * 1024) if memory_mb else float('inf')
+        self.spill_dir = spill_dir
+        self.used = 0
+        self.spills = 0
+        self._sets = []
+        self._spill_path = None
+
+    def __call__(self, name):
+        id_set = ExactReadIdSet(self, name)
+        self._sets.append(id_set)
+        return id_set
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def spill_path(self):
+        if self._spill_path is None:
+            self._spill_path = tempfile.mkdtemp(prefix='aligner_stats_', dir=self.spill_dir)
+        return self._spill_path
+
+    def relieve(self):
+        for id_set in self._sets:
+            id_set.compact()
+        for id_set in sorted(self._sets, key=lambda s: s.nbytes, reverse=True):
+            if self.used <= self.budget // 2:
+                break
+            id_set.spill()
+            self.spills += 1
+
+    def close(self):
+        """
+        Removes the spilled runs
+        """
+        if self._spill_path is not None:
+            shutil.rmtree(self._spill_path, ignore_errors=True)
+            self._spill_path = None
+
+
+class AlignmentStatsAccumulator:
+    """
+    Computes the stats stored in the alignment_stats of an alignment object
+    from the flag and read name of each record.
+
+    Once a paired record is seen, all following records are counted as
+    paired. The distinct read names of each category are kept in sets made by
+    id_set_factory(name), which need add(hash), count(),
+    intersection_count(other) and relative_error, the relative standard
+    error of their counts: ExactReadIdSets, or HyperLogLogSets for
+    approximate stats.
+    """
+
+    SET_NAMES = ('mapped_left', 'mapped_right', 'mapped_single',
+                 'secondary_left', 'secondary_right', 'secondary_single')
+    COUNTERS = ('total_alignments', 'unmapped_reads', 'secondary_alignments',
+                'properly_paired')
+
+    def __init__(self, id_set_factory):
+        self.sets = {name: id_set_factory(name) for name in self.SET_NAMES}
+        self.paired = False
+        self.total_alignments = 0
+        self.unmapped_reads = 0
+        self.secondary_alignments = 0
+        self.properly_paired = 0
+        self._last_read_id = None
+        self._last_hash = None
+
+    def add(self, flag, read_id):
+        # mates and secondary alignments of a read are often adjacent
+        if read_id != self._last_read_id:
+            self._last_read_id = read_id
+            self._last_hash = read_id_hash(read_id)
+        self.add_hash(flag, self._last_hash)
+
+    def add_chunk(self, flags, hashes):
+        """
+        Adds the records of a chunk at once, given as arrays of their flags
+        and read name hashes, with the same result as add_hash for each
+        """
+        flags = np.asarray(flags)
+        self.total_alignments += len(flags)
+        if self.paired:
+            paired = np.ones(len(flags), dtype=bool)
+        else:
+            paired = np.logical_or.accumulate(flags & FLAG_PAIRED != 0)
+            self.paired = bool(len(paired) and paired[-1])
+        unmapped = flags & FLAG_UNMAPPED != 0
+        secondary = flags & FLAG_SECONDARY != 0
+        proper = flags & FLAG_PROPER_PAIR != 0
+        sets = self.sets
+
+        def add_mappings(records, mapped_set, secondary_set, is_paired):
+            self.unmapped_reads += int(np.count_nonzero(records & unmapped))
+            mapped = records & ~unmapped
+            # mates and secondary alignments repeat read names within a chunk
+            mapped_set.add_many(np.unique(hashes[mapped]))
+            mapped_secondary = mapped & secondary
+            self.secondary_alignments += int(np.count_nonzero(mapped_secondary))
+            secondary_set.add_many(np.unique(hashes[mapped_secondary]))
+            if is_paired:
+                self.properly_paired += int(np.count_nonzero(mapped & ~secondary & proper))
+
+        add_mappings(paired & (flags & FLAG_READ1 != 0), sets['mapped_left'],
+                     sets['secondary_left'], True)
+        add_mappings(paired & (flags & FLAG_READ2 != 0), sets['mapped_right'],
+                     sets['secondary_right'], True)
+        add_mappings(~paired, sets['mapped_single'], sets['secondary_single'], False)
+
+    def add_hash(self, flag, h):
+        self.total_alignments += 1
+        if flag & FLAG_PAIRED:
+            self.paired = True
+
+        if self.paired:
+            if flag & FLAG_READ1:
+                self._add_mapping(flag, h, self.sets['mapped_left'], self.sets['secondary_left'],
+                                  True)
+            if flag & FLAG_READ2:
+                self._add_mapping(flag, h, self.sets['mapped_right'],
+                                  self.sets['secondary_right'], True)
+        else:
+            self._add_mapping(flag, h, self.sets['mapped_single'],
+                              self.sets['secondary_single'], False)
+
+    def _add_mapping(self, flag, h, mapped, secondary, paired):
+        if flag & FLAG_UNMAPPED:
+            self.unmapped_reads += 1
+            return
+        mapped.add(h)
+        if flag & FLAG_SECONDARY:
+            self.secondary_alignments += 1
+            secondary.add(h)
+        elif paired and flag & FLAG_PROPER_PAIR:
+            # proper pairs are counted on primary alignments only
+            self.properly_paired += 1
+
+    def save(self, path):
+        """
+        Saves the counters and read id sets to a compressed .npz file, from
+        which merge_saved adds them to the stats of other alignments: the
+        sorted runs of exact sets, one array each, or the registers of
+        sketches. Runs are written and read back a block at a time.
+        """
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as package:
+            for name in self.COUNTERS:
+                _write_array(package, name, np.array(getattr(self, name), dtype=np.int64))
+            _write_array(package, 'paired', np.array(self.paired, dtype=np.bool_))
+            for name, id_set in self.sets.items():
+                if hasattr(id_set, 'registers'):
+                    _write_array(package, 'registers_' + name,
+                                 np.frombuffer(id_set.registers, dtype=np.uint8))
+                    continue
+                for i, (size, blocks) in enumerate(id_set.sorted_runs()):
+                    _write_array(package, 'hashes_{0}_{1}'.format(name, i),
+                                 dtype=np.uint64, shape=(size,), blocks=blocks)
+        return path
+
+    def merge_saved(self, path):
+        """
+        Adds the stats saved to path, e.g. of another lane or replicate, to
+        these stats. The counts are those of the records of both, as long as
+        both are paired or both single end.
+
+        Sketches can only be merged into sketches, exact sets into either.
+        """
+        from ReadsAlignmentUtils.core.hyperloglog import HyperLogLog
+
+        with np.load(path) as saved, zipfile.ZipFile(path) as package:
+            for name in self.COUNTERS:
+                setattr(self, name, getattr(self, name) + int(saved[name]))
+            self.paired = self.paired or bool(saved['paired'])
+            for name, id_set in self.sets.items():
+                if 'registers_' + name not in saved.files:
+                    # the runs are added a block at a time, within the
+                    # memory budget of exact sets
+                    for key in saved.files:
+                        if key.rsplit('_', 1)[0] == 'hashes_' + name:
+                            for block in _read_blocks(package, key):
+                                id_set.add_many(block)
+                    continue
+                registers = saved['registers_' + name]
+                if not hasattr(id_set, 'registers'):
+                    raise ValueError('Approximate stats can only be merged into '
+                                     'approximate stats')
+                sketch = HyperLogLog(int(registers.size).bit_length() - 1)
+                sketch.registers = bytearray(registers.tobytes())
+                id_set.registers = id_set.merge(sketch).registers
+
+    @staticmethod
+    def saved_mode(path):
+        """
+        Returns 'approximate' if the stats saved to path hold sketches, else
+        'exact'
+        """
+        with np.load(path) as saved:
+            if any(key.startswith('registers_') for key in saved.files):
+                return 'approximate'
+        return 'exact'
+
+    def result(self):
+        """
+        Returns the stats as stored in the alignment_stats of an alignment object
+        """
+        sets = self.sets
+        both_mapped = sets['mapped_left'].intersection_count(sets['mapped_right'])
+        mapped_left = sets['mapped_left'].count()
+        mapped_right = sets['mapped_right'].count()
+        singletons = mapped_left + mapped_right - both_mapped * 2
+        mapped_reads = mapped_left + mapped_right + sets['mapped_single'].count()
+        total_reads = mapped_reads + self.unmapped_reads
+
+        # count for reads that are aligned in multiple places
+        multiple_alignments = (sets['secondary_left'].count() +
+                               sets['secondary_right'].count() +
+                               sets['secondary_single'].count())
+
+        try:
+            alignment_rate = round(float(mapped_reads) / total_reads * 100, 3)
+        except ZeroDivisionError:
+            alignment_rate = 0
+
+        return {
+            'alignment_rate': alignment_rate,
+            'mapped_reads': mapped_reads,
+            'multiple_alignments': multiple_alignments,
+            'singletons': singletons,
+            'total_reads': total_reads,
+            'properly_paired': self.properly_paired,
+            'unmapped_reads': self.unmapped_reads
+        }
+
+    def error_bounds(self, z=2.0):
+        """
+        Returns the error bound of each stat of result(), z standard errors
+        wide (about 95% for the default of 2). All bounds are 0 for exact sets.
+
+        The errors of the set counts a stat is made of are treated as
+        independent. unmapped_reads and properly_paired are always exact.
+        """
+        sets = self.sets
+        left = sets['mapped_left']
+        right = sets['mapped_right']
+        single = sets['mapped_single']
+        n_left, n_right, n_single = left.count(), right.count(), single.count()
+        n_union = n_left + n_right - left.intersection_count(right)
+
+        def error(*terms):
+            # terms are (coefficient, set, count)
+            return z * math.sqrt(sum((c * s.relative_error * n) ** 2 for c, s, n in terms))
+
+        mapped_error = error((1, left, n_left), (1, right, n_right), (1, single, n_single))
+        # singletons = left + right - 2 * both = 2 * union - left - right
+        singletons_error = error((2, left, n_union), (1, left, n_left), (1, right, n_right))
+        multiple_error = error(*[(1, sets[name], sets[name].count()) for name in
+                                 ('secondary_left', 'secondary_right', 'secondary_single')])
+        total_reads = n_left + n_right + n_single + self.unmapped_reads
+        if total_reads:
+            rate_error = 100.0 * mapped_error * self.unmapped_reads / total_reads ** 2
+        else:
+            rate_error = 0.0
+
+        return {
+            'alignment_rate': round(rate_error, 3),
+            'mapped_reads': int(math.ceil(mapped_error)),
+            'multiple_alignments': int(math.ceil(multiple_error)),
+            'singletons': int(math.ceil(singletons_error)),
+            'total_reads': int(math.ceil(mapped_error)),
+            'properly_paired': 0,
+            'unmapped_reads': 0
+        }
@@ -0,0 +1,342 @@
+import os
+import struct
+import zlib
+from array import array
+
+'''
+Random access to BAM files at the level of BGZF blocks and records.
+
+A BAM file is a series of BGZF blocks, gzip members of at most 64 KB of
+data each, which can be decompressed on their own. These helpers read single
+blocks at a compressed offset, find the block containing any offset, parse
+the BAM header and the fixed fields of records, and read the BAI index,
+without going through pysam or decompressing the whole file.
+'''
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+# the largest compressed block allowed by the BGZF format
+MAX_BLOCK_SIZE = 65536
+# the empty block that ends a BGZF file
+EOF_MARKER = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq,
+# next_refID, next_pos, tlen
+RECORD_HEADER = struct.Struct('<iiiBBHHHiiii')
+# a record without read name, CIGAR and sequence
+MIN_RECORD_SIZE = RECORD_HEADER.size - 4
+# records larger than this are taken as noise when looking for a record start
+MAX_RECORD_SIZE = 1 << 24
+
+# the pseudo-bin of a BAI reference holding its offsets and record counts
+BAI_PSEUDO_BIN = 37450
+
+
+class BgzfError(Exception):
+    pass
+
+
+def virtual_offset(coffset, uoffset):
+    return (coffset << 16) | uoffset
+
+
+def split_virtual_offset(voffset):
+    return voffset >> 16, voffset & 0xffff
+
+
+class BgzfReader:
+    """
+    Reads single BGZF blocks of a file
+
+    Usage:
+        with BgzfReader(bam_path) as bgzf:
+            data, block_size = bgzf.read_block(bgzf.find_block(offset))
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._file = open(path, 'rb')
+        self._file.seek(max(self.size - len(EOF_MARKER), 0))
+        self.has_eof_marker = self._file.read() == EOF_MARKER
+        # offset of the EOF marker block, or the end of the file
+        self.data_end = self.size - len(EOF_MARKER) if self.has_eof_marker else self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def _block_size(header):
+        """
+        Returns the total size of the block starting with header, or None if
+        header is not a BGZF block header
+        """
+        if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC:
+            return None
+        xlen = struct.unpack_from('<H', header, 10)[0]
+        extra = header[12:12 + xlen]
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack_from('<H', extra, i + 2)[0]
+            if extra[i:i + 2] == b'BC' and slen == 2 and i + 6 <= len(extra):
+                return struct.unpack_from('<H', extra, i + 4)[0] + 1
+            i += 4 + slen
+        return None
+
+    def read_block(self, coffset):
+        """
+        Returns the data of the block at compressed offset coffset and the
+        compressed size of the block
+        """
+        self._file.seek(coffset)
+        header = self._file.read(BGZF_HEADER_SIZE)
+        block_size = self._block_size(header)
+        if block_size is None:
+            raise BgzfError('No BGZF block at offset {0} of {1}'.format(coffset, self.path))
+        xlen = struct.unpack_from('<H', header, 10)[0]
+        rest = self._file.read(block_size - BGZF_HEADER_SIZE)
+        if len(rest) != block_size - BGZF_HEADER_SIZE:
+            raise BgzfError('Truncated BGZF block at offset {0} of {1}'.format(coffset,
+                                                                               self.path))
+        cdata = (header + rest)[12 + xlen:block_size - 8]
+        isize = struct.unpack_from('<I', rest, len(rest) - 4)[0]
+        data = zlib.decompressobj(-15).decompress(cdata)
+        if len(data) != isize:
+            raise BgzfError('Corrupt BGZF block at offset {0} of {1}'.format(coffset,
+                                                                             self.path))
+        return data, block_size
+
+    def blocks(self, coffset=0):
+        """
+        Yields (offset, data, block size) of the blocks from coffset to the end
+        of the file
+        """
+        while coffset < self.data_end:
+            data, block_size = self.read_block(coffset)
+            yield coffset, data, block_size
+            coffset += block_size
+
+    def find_block(self, offset):
+        """
+        Returns the compressed offset of the block containing offset.
+
+        Looks back up to MAX_BLOCK_SIZE bytes for candidate block headers and
+        accepts the one whose block ends past offset and is followed by
+        another block header or the end of the data.
+        """
+        start = max(offset - MAX_BLOCK_SIZE, 0)
+        self._file.seek(start)
+        window = self._file.read(offset - start + 2 * MAX_BLOCK_SIZE)
+        best = None
+        i = window.find(BGZF_MAGIC)
+        while i != -1 and start + i <= offset:
+            block_size = self._block_size(window[i:i + BGZF_HEADER_SIZE + 16])
+            if block_size is not None and start + i + block_size > offset:
+                following = start + i + block_size
+                if following >= self.data_end or self._block_size(
+                        window[i + block_size:i + block_size + BGZF_HEADER_SIZE + 16]):
+                    best = start + i
+            i = window.find(BGZF_MAGIC, i + 1)
+        if best is None:
+            raise BgzfError('No BGZF block contains offset {0} of {1}'.format(offset,
+                                                                              self.path))
+        return best
+
+
+class BamHeader:
+    """
+    The reference names and lengths of a BAM file, and the virtual offset of
+    its first record
+    """
+
+    def __init__(self, names, lengths, first_record):
+        self.names = names
+        self.lengths = lengths
+        self.first_record = first_record
+
+    @classmethod
+    def read(cls, bgzf):
+        data = b''
+        blocks = []
+        for coffset, block, block_size in bgzf.blocks(0):
+            blocks.append((coffset, len(data), block_size))
+            data += block
+            if data[:4] != b'BAM\x01':
+                raise BgzfError('{0} is not a BAM file'.format(bgzf.path))
+            parsed = cls._parse(data)
+            if parsed is None:
+                continue
+            names, lengths, end = parsed
+            coffset, data_start, block_size = blocks[-1]
+            if end == len(data):
+                # the header ends with its block, the records start in the next one
+                return cls(names, lengths, virtual_offset(coffset + block_size, 0))
+            for coffset, data_start, block_size in reversed(blocks):
+                if data_start <= end:
+                    return cls(names, lengths, virtual_offset(coffset, end - data_start))
+        raise BgzfError('Truncated BAM header in {0}'.format(bgzf.path))
+
+    @staticmethod
+    def _parse(data):
+        """
+        Returns the reference names, lengths and the end offset of the header
+        at the start of data, or None if data holds only part of it
+        """
+        if len(data) < 8:
+            return None
+        i = 8 + struct.unpack_from('<i', data, 4)[0]
+        if len(data) < i + 4:
+            return None
+        n_ref = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        names, lengths = [], []
+        for _ in range(n_ref):
+            if len(data) < i + 4:
+                return None
+            l_name = struct.unpack_from('<i', data, i)[0]
+            if len(data) < i + 8 + l_name:
+                return None
+            names.append(data[i + 4:i + 3 + l_name].decode())
+            lengths.append(struct.unpack_from('<i', data, i + 4 + l_name)[0])
+            i += 8 + l_name
+        return names, lengths, i
+
+
+def iter_records(data, start=0):
+    """
+    Yields (offset, record header fields) of the records starting in data
+    from start, up to the first record not completely in data
+    """
+    end = len(data)
+    i = start
+    while i + RECORD_HEADER.size <= end:
+        fields = RECORD_HEADER.unpack_from(data, i)
+        block_size = fields[0]
+        if block_size < MIN_RECORD_SIZE or i + 4 + block_size > end:
+            return
+        yield i, fields
+        i += 4 + block_size
+
+
+def is_record_start(data, i, n_ref):
+    """
+    Returns True if a plausible BAM record starts at offset i of data
+    """
+    if i + RECORD_HEADER.size > len(data):
+        return False
+    (block_size, ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq,
+     next_ref_id, next_pos, tlen) = RECORD_HEADER.unpack_from(data, i)
+    if not MIN_RECORD_SIZE <= block_size <= MAX_RECORD_SIZE:
+        return False
+    if not -1 <= ref_id < n_ref or not -1 <= next_ref_id < n_ref or pos < -1 or next_pos < -1:
+        return False
+    if l_read_name < 2 or l_seq < 0:
+        return False
+    if (RECORD_HEADER.size - 4 + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 +
+            l_seq > block_size):
+        return False
+    name_end = i + RECORD_HEADER.size + l_read_name - 1
+    if name_end < len(data):
+        if data[name_end] != 0:
+            return False
+        name = data[i + RECORD_HEADER.size:name_end]
+        if not all(33 <= c <= 126 for c in name):
+            return False
+    return True
+
+
+def find_record_start(data, n_ref, start=0, chain=3):
+    """
+    Returns the offset of the first record start in data at or after start,
+    found by looking for chain consecutive plausible records (fewer when data
+    ends first), or None
+    """
+    for i in range(start, len(data) - RECORD_HEADER.size + 1):
+        j = i
+        checked = 0
+        while checked < chain and is_record_start(data, j, n_ref):
+            checked += 1
+            j += 4 + struct.unpack_from('<i', data, j)[0]
+            if j + RECORD_HEADER.size > len(data):
+                break
+        if checked == chain or (checked and j + RECORD_HEADER.size > len(data)):
+            return i
+    return None
+
+
+class BaiReference:
+    """
+    The index of one reference of a BAI file
+    """
+
+    def __init__(self, linear_offsets, mapped=None, unmapped=None, begin=None, end=None):
+        # virtual offsets of the first record of each 16 kb window
+        self.linear_offsets = linear_offsets
+        self.mapped = mapped
+        self.unmapped = unmapped
+        self.begin = begin
+        self.end = end
+
+
+class BaiIndex:
+    """
+    The references of a BAI index and the number of unplaced unmapped records
+    """
+
+    def __init__(self, references, no_coordinate):
+        self.references = references
+        self.no_coordinate = no_coordinate
+
+    @property
+    def has_counts(self):
+        return all(ref.mapped is not None for ref in self.references)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as bai:
+            data = bai.read()
+        if data[:4] != b'BAI\x01':
+            raise BgzfError('{0} is not a BAI file'.format(path))
+        n_ref = struct.unpack_from('<i', data, 4)[0]
+        i = 8
+        references = []
+        for _ in range(n_ref):
+            n_bin = struct.unpack_from('<i', data, i)[0]
+            i += 4
+            # a reference without records has no bins, nor the pseudo-bin of
+            # its counts
+            counts = {'mapped': 0, 'unmapped': 0} if n_bin == 0 else {}
+            for _ in range(n_bin):
+                bin_, n_chunk = struct.unpack_from('<Ii', data, i)
+                i += 8
+                if bin_ == BAI_PSEUDO_BIN and n_chunk == 2:
+                    counts = dict(zip(('begin', 'end', 'mapped', 'unmapped'),
+                                      struct.unpack_from('<QQQQ', data, i)))
+                i += 16 * n_chunk
+            n_intv = struct.unpack_from('<i', data, i)[0]
+            i += 4
+            linear_offsets = array('Q')
+            linear_offsets.frombytes(data[i:i + 8 * n_intv])
+            i += 8 * n_intv
+            references.append(BaiReference(linear_offsets, **counts))
+        no_coordinate = None
+        if len(data) >= i + 8:
+            no_coordinate = struct.unpack_from('<Q', data, i)[0]
+        return cls(references, no_coordinate)
+
+
+def find_bai(bam_path):
+    """
+    Returns the path of the BAI index of a BAM file, as named by samtools
+    (file.bam.bai) or Picard and this module (file.bai), or None
+    """
+    for path in (bam_path + '.bai', os.path.splitext(bam_path)[0] + '.bai'):
+        if os.path.isfile(path):
+            return path
+    return None
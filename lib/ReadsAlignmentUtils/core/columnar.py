@@ -0,0 +1,150 @@
+import json
+from array import array
+from itertools import islice
+
+from ReadsAlignmentUtils.core.record_chunks import iter_chunks
+
+'''
+Columnar export of the records of an alignment to Parquet, for vectorized
+scans without going through SAM text.
+
+Records are read in file order and written in row groups of BATCH_SIZE
+records, so memory stays bounded by a batch whatever the size of the file.
+The fixed fields of a batch are taken from a chunk of record_chunks, with the
+read names hashed for the whole chunk at once. The cigar and tags fields
+need each record to be decoded with pysam, so the file is only read that way
+when they are selected. The reference names and lengths are kept in the
+schema metadata, under 'references', so ref_id can be mapped back to contig
+names.
+'''
+
+BATCH_SIZE = 1 << 16
+
+FIELDS = ('qname_hash', 'flag', 'ref_id', 'pos', 'mapq', 'cigar', 'tlen', 'tags')
+
+# the fields decoded record by record
+DECODED_FIELDS = ('cigar', 'tags')
+
+CIGAR_OPS = 'MIDNSHP=XB'
+
+
+def schema(fields=FIELDS, references=None):
+    """
+    Returns the Arrow schema of the selected fields:
+        qname_hash - 64-bit FNV-1a hash of the read name, as read_id_hash
+        flag, ref_id, pos (0-based, -1 if unmapped), mapq, tlen
+        cigar - the CIGAR operations as in BAM, length << 4 | op, op an index
+                of CIGAR_OPS
+        tags - the optional fields, tag to value as in SAM text
+    """
+    import pyarrow as pa
+
+    types = {
+        'qname_hash': pa.uint64(),
+        'flag': pa.uint16(),
+        'ref_id': pa.int32(),
+        'pos': pa.int64(),
+        'mapq': pa.uint8(),
+        'cigar': pa.list_(pa.uint32()),
+        'tlen': pa.int64(),
+        'tags': pa.map_(pa.string(), pa.string())
+    }
+    unknown = [field for field in fields if field not in types]
+    if unknown:
+        raise ValueError('Unknown fields: {0}, expected some of {1}'.format(
+            ', '.join(unknown), ', '.join(FIELDS)))
+    metadata = None
+    if references is not None:
+        metadata = {'references': json.dumps(references)}
+    return pa.schema([(field, types[field]) for field in fields], metadata=metadata)
+
+
+def _tag_value(value):
+    if isinstance(value, (list, tuple, array)):
+        return ','.join(str(v) for v in value)
+    return str(value)
+
+
+def _decoded_columns(alignments, fields):
+    """
+    Returns the Arrow arrays of the cigar and tags fields of pysam
+    AlignedSegments, by field
+    """
+    import pyarrow as pa
+
+    cigar = array('I')
+    cigar_offsets = array('i', [0])
+    tag_keys = []
+    tag_values = []
+    tag_offsets = array('i', [0])
+    for alignment in alignments:
+        if 'cigar' in fields:
+            for op, length in alignment.cigartuples or ():
+                cigar.append(length << 4 | op)
+            cigar_offsets.append(len(cigar))
+        if 'tags' in fields:
+            for tag, value in alignment.get_tags():
+                tag_keys.append(tag)
+                tag_values.append(_tag_value(value))
+            tag_offsets.append(len(tag_keys))
+    columns = {}
+    if 'cigar' in fields:
+        columns['cigar'] = pa.ListArray.from_arrays(pa.array(cigar_offsets, type=pa.int32()),
+                                                    pa.array(cigar, type=pa.uint32()))
+    if 'tags' in fields:
+        columns['tags'] = pa.MapArray.from_arrays(pa.array(tag_offsets, type=pa.int32()),
+                                                  pa.array(tag_keys, type=pa.string()),
+                                                  pa.array(tag_values, type=pa.string()))
+    return columns
+
+
+def iter_batches(path, fields=FIELDS, batch_size=BATCH_SIZE):
+    """
+    Yields the records of a sam or bam file as Arrow RecordBatches of at most
+    batch_size records
+    """
+    import pyarrow as pa
+
+    batch_schema = schema(fields)
+    decoded = [field for field in fields if field in DECODED_FIELDS]
+    bam = None
+    if decoded:
+        import pysam
+
+        bam = pysam.AlignmentFile(path, 'r', check_sq=False)
+    try:
+        alignments = iter(bam) if bam is not None else None
+        for chunk in iter_chunks(path, chunk_size=batch_size):
+            columns = {}
+            if decoded:
+                # the same records, read alongside the chunks
+                columns = _decoded_columns(islice(alignments, len(chunk)), decoded)
+            yield pa.RecordBatch.from_arrays(
+                [columns[field] if field in columns else
+                 pa.array(chunk[field], type=batch_schema.field(field).type)
+                 for field in fields], schema=batch_schema)
+    finally:
+        if bam is not None:
+            bam.close()
+
+
+def write_parquet(bam_path, parquet_path, fields=FIELDS, batch_size=BATCH_SIZE,
+                  compression='zstd'):
+    """
+    Writes the selected fields of the records of a sam or bam file to a
+    Parquet file, one row group per batch. Returns the number of records.
+    """
+    import pysam
+    import pyarrow.parquet as pq
+
+    fields = tuple(fields)
+    with pysam.AlignmentFile(bam_path, 'r', check_sq=False) as bam:
+        references = [{'name': name, 'length': length}
+                      for name, length in zip(bam.references, bam.lengths)]
+    records = 0
+    with pq.ParquetWriter(parquet_path, schema(fields, references),
+                          compression=compression) as writer:
+        for batch in iter_batches(bam_path, fields, batch_size):
+            writer.write_batch(batch)
+            records += batch.num_rows
+    return records
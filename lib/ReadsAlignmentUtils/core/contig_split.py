@@ -0,0 +1,79 @@
+import re
+
+from ReadsAlignmentUtils.core.index_stats import UNPLACED_CONTIG
+
+'''
+Shards of a coordinate sorted BAM file by reference, for stages that scatter
+by chromosome. Each reference of at least group_bases gets a shard of its
+own, and the smaller ones (scaffolds, unplaced contigs) are grouped, in
+header order, into shards of about group_bases, so an assembly of thousands
+of contigs does not give thousands of files. References without records are
+left out when the index has counts, and the unplaced unmapped records get a
+shard of their own.
+
+The shards are extracted from the indexed BAM file with region queries, so
+each one only reads its part of the file.
+'''
+
+# total length of the small references grouped in a shard
+GROUP_BASES = 10000000
+
+
+def plan_shards(contig_stats, group_bases=GROUP_BASES):
+    """
+    Returns the references of each shard, as lists of contig names.
+
+    :param contig_stats: the contig, length and, if known, mapped and unmapped
+    record counts of each reference, as read by index_stats.read_index_stats,
+    with the UNPLACED_CONTIG entry last
+    """
+    shards = []
+    group = []
+    grouped_bases = 0
+    for entry in contig_stats:
+        records = None
+        if entry.get('mapped') is not None:
+            records = entry['mapped'] + entry['unmapped']
+        if records == 0:
+            continue
+        if entry['contig'] == UNPLACED_CONTIG:
+            continue
+        if entry['length'] >= group_bases:
+            shards.append([entry['contig']])
+            continue
+        group.append(entry['contig'])
+        grouped_bases += entry['length']
+        if grouped_bases >= group_bases:
+            shards.append(group)
+            group = []
+            grouped_bases = 0
+    if group:
+        shards.append(group)
+    unplaced = [entry for entry in contig_stats if entry['contig'] == UNPLACED_CONTIG]
+    if unplaced and unplaced[0].get('unmapped') != 0:
+        shards.append([UNPLACED_CONTIG])
+    return shards
+
+
+def shard_regions(contigs, lengths):
+    """
+    Returns the samtools regions of the references of a shard. References
+    are given with their full range, so names containing ':' are read right
+    """
+    return [contig if contig == UNPLACED_CONTIG else '{0}:1-{1}'.format(contig, lengths[contig])
+            for contig in contigs]
+
+
+def shard_file_base(file_base, index, contigs):
+    """
+    Returns the name, without extension, of the file of a shard: the bam file
+    name, the shard number and the reference name, or 'contigs' for a group
+    of references and 'unmapped' for the unplaced unmapped records
+    """
+    if contigs == [UNPLACED_CONTIG]:
+        label = 'unmapped'
+    elif len(contigs) == 1:
+        label = re.sub(r'[^\w.-]', '_', contigs[0])
+    else:
+        label = 'contigs'
+    return '{0}.{1}.{2}'.format(file_base, index, label)
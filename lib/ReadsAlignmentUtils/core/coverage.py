@@ -0,0 +1,345 @@
+from array import array
+
+import numpy as np
+
+'''
+Multi-resolution read depth of an alignment, computed in the record pass of
+the alignment stats.
+
+Depth is kept as run-length encoded 1 bp depth (the start and depth of each
+run of equal depth) and as the mean depth of 1 kb, 10 kb and 100 kb bins, so
+the depth of any window can be read in O(bins) time without the BAM file.
+With a coordinate sorted file the start and end events of the aligned blocks
+are added to a difference buffer that slides along the contig: the bases
+before the start of a record can no longer change, so their depth runs and
+bin areas are emitted and the buffer is shifted. Memory stays bounded by the
+span of the buffer, a window plus the longest record, whatever the number of
+reads. Other files keep the events of each contig, in memory proportional to
+the number of blocks, and sort them once the whole file is read.
+
+Records that are unmapped, secondary, QC failed or duplicates are skipped,
+and deletions and skipped regions are not covered, as by samtools depth.
+'''
+
+BIN_SIZES = (1000, 10000, 100000)
+
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_QC_FAIL = 0x200
+FLAG_DUPLICATE = 0x400
+SKIPPED_FLAGS = FLAG_UNMAPPED | FLAG_SECONDARY | FLAG_QC_FAIL | FLAG_DUPLICATE
+
+# bases and block events gathered before the difference buffer is flushed
+FLUSH_BASES = 1 << 16
+FLUSH_EVENTS = 1 << 16
+
+
+def depth_runs(starts, ends, length):
+    """
+    Returns the run-length encoded depth of a contig of length bases covered
+    by the intervals [starts[i], ends[i]): the start of each run and its depth
+    """
+    if not len(starts):
+        return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int32)
+    positions = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(len(starts), dtype=np.int32),
+                             np.full(len(ends), -1, dtype=np.int32)])
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    run_starts, first = np.unique(positions, return_index=True)
+    depths = np.cumsum(np.add.reduceat(deltas[order], first), dtype=np.int32)
+    if run_starts[0] != 0:
+        run_starts = np.concatenate([[0], run_starts])
+        depths = np.concatenate([[0], depths]).astype(np.int32)
+    inside = run_starts < length
+    run_starts, depths = run_starts[inside], depths[inside]
+    # events cancelling out leave runs of the same depth
+    changes = np.concatenate([[True], depths[1:] != depths[:-1]])
+    return run_starts[changes].astype(np.int64), depths[changes]
+
+
+def binned_depth(run_starts, depths, length, bin_size):
+    """
+    Returns the mean depth of each bin_size bin of a contig from its depth runs.
+    The last bin is averaged over its actual width.
+    """
+    edges = np.append(np.arange(0, length, bin_size, dtype=np.int64), length)
+    # covered bases up to the start of each run, then up to each bin edge
+    run_ends = np.append(run_starts[1:], length)
+    area = np.concatenate([[0], np.cumsum(depths.astype(np.int64) * (run_ends - run_starts))])
+    run = np.searchsorted(run_starts, edges, side='right') - 1
+    area_at_edges = area[run] + depths[run].astype(np.int64) * (edges - run_starts[run])
+    return (np.diff(area_at_edges) / np.diff(edges)).astype(np.float32)
+
+
+class _SlidingDepth:
+    """
+    Depth of one contig from the aligned blocks of coordinate sorted records,
+    kept as a difference buffer starting at the first base whose depth can
+    still change
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self._offset = 0
+        self._diff = np.zeros(0, dtype=np.int64)
+        self._starts = array('q')
+        self._ends = array('q')
+        self._depth = 0
+        self._last = None
+        self._run_starts = []
+        self._run_depths = []
+        self._areas = [np.zeros(-(-length // bin_size), dtype=np.int64)
+                       for bin_size in BIN_SIZES]
+
+    def add_blocks(self, blocks):
+        if not blocks:
+            return
+        position = blocks[0][0]
+        if position < self._offset:
+            raise ValueError('Alignment file is not sorted by coordinate, a record at {0} '
+                             'follows one at {1}'.format(position, self._offset))
+        if position - self._offset >= FLUSH_BASES or len(self._starts) >= FLUSH_EVENTS:
+            self._flush(position)
+        for start, end in blocks:
+            self._starts.append(start)
+            self._ends.append(end)
+
+    def _flush(self, position):
+        """
+        Emits the depth of the bases before position, which no record added
+        later can cover
+        """
+        position = min(position, self.length)
+        if self._starts:
+            starts = np.frombuffer(self._starts, dtype=np.int64) - self._offset
+            ends = np.frombuffer(self._ends, dtype=np.int64) - self._offset
+            size = max(len(self._diff), int(ends.max()) + 1)
+            if size > len(self._diff):
+                self._diff = np.concatenate([self._diff,
+                                             np.zeros(size - len(self._diff), dtype=np.int64)])
+            self._diff += (np.bincount(starts, minlength=size) -
+                           np.bincount(ends, minlength=size))
+            self._starts = array('q')
+            self._ends = array('q')
+        covered = max(min(position - self._offset, len(self._diff)), 0)
+        if covered:
+            depths = self._depth + np.cumsum(self._diff[:covered])
+            self._emit(self._offset, depths)
+            self._depth = int(depths[-1])
+            self._diff = self._diff[covered:].copy()
+        if position > self._offset + covered:
+            # past the buffer no block starts or ends, the depth is constant
+            self._emit(self._offset + covered,
+                       np.full(position - self._offset - covered, self._depth, dtype=np.int64))
+            self._diff = np.zeros(0, dtype=np.int64)
+        self._offset = max(position, self._offset)
+
+    def _emit(self, start, depths):
+        """
+        Adds the depth of the bases from start on to the runs and bin areas
+        """
+        previous = np.concatenate([[-1 if self._last is None else self._last], depths[:-1]])
+        changes = np.flatnonzero(depths != previous)
+        self._run_starts.append(start + changes)
+        self._run_depths.append(depths[changes].astype(np.int32))
+        self._last = int(depths[-1])
+        end = start + len(depths)
+        area = np.concatenate([[0], np.cumsum(depths)])
+        for bin_size, areas in zip(BIN_SIZES, self._areas):
+            first = start // bin_size
+            edges = np.arange((first + 1) * bin_size, end, bin_size) - start
+            points = np.concatenate([[0], edges, [len(depths)]])
+            areas[first:first + len(points) - 1] += np.diff(area[points])
+
+    def finish(self):
+        """
+        Returns the depth runs and binned depth of the contig
+        """
+        self._flush(self.length)
+        if not self._run_starts:
+            self._run_starts.append(np.zeros(1, dtype=np.int64))
+            self._run_depths.append(np.zeros(1, dtype=np.int32))
+        bins = []
+        for bin_size, areas in zip(BIN_SIZES, self._areas):
+            edges = np.append(np.arange(0, self.length, bin_size, dtype=np.int64), self.length)
+            bins.append((areas / np.diff(edges)).astype(np.float32))
+        return (np.concatenate(self._run_starts).astype(np.int64),
+                np.concatenate(self._run_depths), bins)
+
+
+class CoverageAccumulator:
+    """
+    Collects the aligned blocks of records and computes the depth runs and
+    binned depth of each contig.
+
+    Usage:
+        coverage = CoverageAccumulator(bam.references, bam.lengths, sorted_input)
+        for alignment in bam:
+            coverage.add_alignment(alignment)
+        coverage.save(path)
+    """
+
+    def __init__(self, names, lengths, coordinate_sorted=False):
+        self.names = list(names)
+        self.lengths = list(lengths)
+        self.coordinate_sorted = coordinate_sorted
+        self._starts = {}
+        self._ends = {}
+        self._contigs = {}
+        self._current = None
+        self._sliding = None
+
+    def add_alignment(self, alignment):
+        """
+        Adds a pysam AlignedSegment
+        """
+        if alignment.flag & SKIPPED_FLAGS:
+            return
+        self.add_blocks(alignment.reference_id, alignment.get_blocks())
+
+    def add_blocks(self, ref_id, blocks):
+        """
+        Adds the (start, end) aligned blocks of a record on reference ref_id
+        """
+        if ref_id != self._current:
+            if ref_id in self._contigs:
+                raise ValueError('Alignment file is not sorted by coordinate, {0} '
+                                 'is not contiguous'.format(self.names[ref_id]))
+            if self.coordinate_sorted:
+                if self._current is not None:
+                    self._finish(self._current)
+                self._sliding = _SlidingDepth(self.lengths[ref_id])
+            self._current = ref_id
+        if self.coordinate_sorted:
+            self._sliding.add_blocks(blocks)
+            return
+        if ref_id not in self._starts:
+            self._starts[ref_id] = array('q')
+            self._ends[ref_id] = array('q')
+        starts = self._starts[ref_id]
+        ends = self._ends[ref_id]
+        for start, end in blocks:
+            starts.append(start)
+            ends.append(end)
+
+    def _finish(self, ref_id):
+        length = self.lengths[ref_id]
+        if self.coordinate_sorted:
+            sliding = self._sliding if ref_id == self._current else None
+            if sliding is None:
+                sliding = _SlidingDepth(length)
+            else:
+                self._sliding = None
+            self._contigs[ref_id] = sliding.finish()
+            return
+        starts = np.frombuffer(self._starts.pop(ref_id, array('q')), dtype=np.int64)
+        ends = np.frombuffer(self._ends.pop(ref_id, array('q')), dtype=np.int64)
+        run_starts, depths = depth_runs(starts, ends, length)
+        self._contigs[ref_id] = (run_starts, depths,
+                                 [binned_depth(run_starts, depths, length, bin_size)
+                                  for bin_size in BIN_SIZES])
+
+    def tiles(self):
+        """
+        Finishes the contigs and returns their CoverageTiles
+        """
+        for ref_id in range(len(self.names)):
+            if ref_id not in self._contigs:
+                self._finish(ref_id)
+        contigs = [self._contigs[ref_id] for ref_id in range(len(self.names))]
+        arrays = {'names': np.array(self.names, dtype=str),
+                  'lengths': np.array(self.lengths, dtype=np.int64)}
+        arrays.update(_concatenate('runs', {'run_starts': [c[0] for c in contigs],
+                                            'run_depths': [c[1] for c in contigs]}))
+        for level, bin_size in enumerate(BIN_SIZES):
+            key = 'bin_{0}'.format(bin_size)
+            arrays.update(_concatenate(key, {key: [c[2][level] for c in contigs]}))
+        return CoverageTiles(arrays)
+
+    def save(self, path):
+        """
+        Saves the coverage tiles to a compressed .npz file
+        """
+        return self.tiles().save(path)
+
+
+def _concatenate(key, columns):
+    """
+    Concatenates the per contig arrays of each column, all of the same size
+    for a contig, and adds the offset of each contig as key + '_offsets'
+    """
+    sizes = [len(arrays) for arrays in next(iter(columns.values()))]
+    result = {key + '_offsets': np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)}
+    for name, arrays in columns.items():
+        result[name] = np.concatenate(arrays)
+    return result
+
+
+class CoverageTiles:
+    """
+    Coverage tiles of an alignment, as saved by CoverageAccumulator.
+
+    Usage:
+        tiles = CoverageTiles.load(path)
+        bin_size, depth = tiles.depth('chr1', 0, 5000000, max_bins=1000)
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.names = [str(name) for name in arrays['names']]
+        self.lengths = [int(length) for length in arrays['lengths']]
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls({key: saved[key] for key in saved.files})
+
+    def save(self, path):
+        np.savez_compressed(path, **self.arrays)
+        return path
+
+    def _contig(self, contig):
+        if contig not in self._index:
+            raise ValueError('Unknown contig: {0}'.format(contig))
+        return self._index[contig]
+
+    def runs(self, contig):
+        """
+        Returns the start and depth of the runs of equal depth of a contig
+        """
+        i = self._contig(contig)
+        offsets = self.arrays['runs_offsets']
+        return (self.arrays['run_starts'][offsets[i]:offsets[i + 1]],
+                self.arrays['run_depths'][offsets[i]:offsets[i + 1]])
+
+    def bins(self, contig, bin_size):
+        """
+        Returns the mean depth of the bin_size bins of a contig
+        """
+        if bin_size not in BIN_SIZES:
+            raise ValueError('bin_size must be one of {0}'.format(BIN_SIZES))
+        i = self._contig(contig)
+        offsets = self.arrays['bin_{0}_offsets'.format(bin_size)]
+        return self.arrays['bin_{0}'.format(bin_size)][offsets[i]:offsets[i + 1]]
+
+    def depth(self, contig, start, end, max_bins=1000):
+        """
+        Returns the depth of the window [start, end) of a contig at the finest
+        resolution with at most max_bins values (or the coarsest one): the bin
+        size, 1 for the depth of each base, and the values. Binned values
+        cover the bins overlapping the window.
+        """
+        length = self.lengths[self._contig(contig)]
+        start, end = max(start, 0), min(end, length)
+        if end <= start:
+            return 1, np.zeros(0, dtype=np.float32)
+        if end - start <= max_bins:
+            run_starts, depths = self.runs(contig)
+            run = np.searchsorted(run_starts, np.arange(start, end), side='right') - 1
+            return 1, depths[run].astype(np.float32)
+        for bin_size in BIN_SIZES:
+            first, last = start // bin_size, (end - 1) // bin_size + 1
+            if last - first <= max_bins or bin_size == BIN_SIZES[-1]:
+                return bin_size, self.bins(contig, bin_size)[first:last]
@@ -0,0 +1,261 @@
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+'''
+Read counts per feature of a genome annotation.
+
+The intervals of the features of each contig are kept in arrays sorted by
+start, with the running maximum of their ends, so the features overlapping
+an aligned block are found with two binary searches. Reads are assigned as
+by htseq-count in union mode: a read overlapping one feature is counted for
+it, a read overlapping several is ambiguous and one overlapping none has no
+feature. Strand is ignored.
+
+Primary mapped records are counted. A pair is counted once, on the union of
+the features of both mates, which are matched by read name; the first mate
+read waits for the other one, so in a sorted file only the pairs spanning
+the current position are held. A mapped mate of an unmapped one, or one
+whose mate is missing from the file, is counted alone. With a BAI index,
+contigs are counted in parallel processes, and the mates of pairs across
+contigs are matched once all are counted. The processes are started by a
+fork server, as the server forks while other requests run in threads, and
+take a CPU of the tool queue each.
+'''
+
+FLAG_PAIRED = 0x1
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_NOT_PRIMARY = 0x100 | 0x800
+
+
+class FeatureIndex:
+    """
+    The intervals of features by contig, with 0-based half-open coordinates.
+    A feature may have several intervals, e.g. the exons of a gene.
+    """
+
+    def __init__(self, intervals):
+        """
+        :param intervals: iterable of (feature_id, contig, start, end)
+        """
+        self.feature_ids = []
+        feature_index = {}
+        by_contig = {}
+        for feature_id, contig, start, end in intervals:
+            if feature_id not in feature_index:
+                feature_index[feature_id] = len(self.feature_ids)
+                self.feature_ids.append(feature_id)
+            by_contig.setdefault(contig, []).append((start, end, feature_index[feature_id]))
+        self.contigs = {}
+        for contig, contig_intervals in by_contig.items():
+            contig_intervals.sort()
+            starts = [start for start, _, _ in contig_intervals]
+            ends = [end for _, end, _ in contig_intervals]
+            features = [feature for _, _, feature in contig_intervals]
+            self.contigs[contig] = (starts, ends, list(accumulate(ends, max)), features)
+
+    @classmethod
+    def from_genome_features(cls, features):
+        """
+        Returns the index of the features of a KBaseGenomes.Genome, given as
+        dicts with id and location, a list of [contig_id, start, strand,
+        length] with 1-based starts, the last base of the region on the -
+        strand
+        """
+        intervals = []
+        for feature in features:
+            for contig, start, strand, length in feature.get('location') or ():
+                if strand == '-':
+                    intervals.append((feature['id'], contig, start - length, start))
+                else:
+                    intervals.append((feature['id'], contig, start - 1, start - 1 + length))
+        return cls(intervals)
+
+    def subset(self, contig):
+        """
+        Returns the index of the features of one contig, with the same feature
+        numbering, to send to the process counting it
+        """
+        subset = FeatureIndex(())
+        subset.feature_ids = self.feature_ids
+        if contig in self.contigs:
+            subset.contigs[contig] = self.contigs[contig]
+        return subset
+
+    def overlapping(self, contig, blocks):
+        """
+        Returns the set of the indexes of the features overlapping any of the
+        (start, end) aligned blocks of a read on contig
+        """
+        found = set()
+        intervals = self.contigs.get(contig)
+        if intervals is None:
+            return found
+        starts, ends, max_ends, features = intervals
+        for start, end in blocks:
+            # the intervals before first end before start, the ones from last start after end
+            first = bisect_right(max_ends, start)
+            last = bisect_left(starts, end)
+            for i in range(first, last):
+                if ends[i] > start:
+                    found.add(features[i])
+        return found
+
+
+def is_counted(flag):
+    """
+    Returns True if a record with flag is counted
+    """
+    return not flag & (FLAG_UNMAPPED | FLAG_NOT_PRIMARY)
+
+
+def waits_for_mate(flag):
+    """
+    Returns True if a counted record with flag is counted with its mate
+    """
+    return bool(flag & FLAG_PAIRED and not flag & FLAG_MATE_UNMAPPED)
+
+
+class FeatureCounter:
+    """
+    The read counts by feature index, and the features of the mates waiting
+    for their pair by read name
+    """
+
+    def __init__(self, feature_count):
+        self.counts = [0] * feature_count
+        self.no_feature = 0
+        self.ambiguous = 0
+        self.pending = {}
+
+    def add(self, found):
+        """
+        Counts a read with the set of feature indexes it overlaps
+        """
+        if not found:
+            self.no_feature += 1
+        elif len(found) > 1:
+            self.ambiguous += 1
+        else:
+            self.counts[next(iter(found))] += 1
+
+    def add_mate(self, name, found):
+        """
+        Counts a pair on the union of the features of its mates once both are
+        added
+        """
+        mate_found = self.pending.pop(name, None)
+        if mate_found is None:
+            self.pending[name] = found
+        else:
+            self.add(found | mate_found)
+
+    def merge(self, other):
+        """
+        Adds the counts of other, e.g. of another contig, matching the mates
+        waiting in both
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.no_feature += other.no_feature
+        self.ambiguous += other.ambiguous
+        for name, found in other.pending.items():
+            self.add_mate(name, found)
+
+    def finish(self):
+        """
+        Counts the mates still waiting alone, as their mate is not in the file
+        """
+        for found in self.pending.values():
+            self.add(found)
+        self.pending = {}
+
+
+def _count(alignments, feature_index):
+    counter = FeatureCounter(len(feature_index.feature_ids))
+    for alignment in alignments:
+        flag = alignment.flag
+        if not is_counted(flag):
+            continue
+        found = feature_index.overlapping(alignment.reference_name, alignment.get_blocks())
+        if waits_for_mate(flag):
+            counter.add_mate(alignment.query_name, found)
+        else:
+            counter.add(found)
+    return counter
+
+
+def _count_contig(bam_path, contig, feature_index):
+    import pysam
+
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        return _count(bam.fetch(contig), feature_index)
+
+
+def count_features(bam_path, feature_index, workers=1, indexed=False, config=None):
+    """
+    Counts the reads of a sam or bam file per feature of feature_index.
+
+    :param workers: number of processes counting contigs in parallel, if indexed
+    :param indexed: True if the bam file has a BAI index, needed to read contigs
+    on their own
+    :param config: the config sizing the tool queue, if not sized yet
+    :returns a dict of the counts by feature id, and the numbers of reads with
+    no feature, ambiguous and counted in all
+    """
+    import pysam
+
+    with pysam.AlignmentFile(bam_path, 'r') as bam:
+        contigs = list(bam.references)
+        parallel = indexed and workers > 1 and len(contigs) > 1
+        if not parallel:
+            results = [_count(bam, feature_index)]
+    if parallel:
+        from ReadsAlignmentUtils.core.sam_tools import STREAMING_TOOL_MEMORY_MB, get_tool_queue
+
+        workers = min(workers, len(contigs))
+        context = multiprocessing.get_context('forkserver')
+        # one slot for all the workers, so a partly held pool can not deadlock
+        with get_tool_queue(config).slot(cpu=workers,
+                                         memory_mb=workers * STREAMING_TOOL_MEMORY_MB):
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                results = list(executor.map(_count_contig, [bam_path] * len(contigs), contigs,
+                                            [feature_index.subset(c) for c in contigs]))
+
+    counter = results[0]
+    for result in results[1:]:
+        counter.merge(result)
+    counter.finish()
+    return {
+        'counts': dict(zip(feature_index.feature_ids, counter.counts)),
+        'no_feature': counter.no_feature,
+        'ambiguous': counter.ambiguous,
+        'counted_reads': sum(counter.counts) + counter.no_feature + counter.ambiguous
+    }
+
+
+def merge_feature_counts(results):
+    """
+    Sums the results of count_features for several files
+    """
+    merged = {'counts': {}, 'no_feature': 0, 'ambiguous': 0, 'counted_reads': 0}
+    for result in results:
+        for feature_id, count in result['counts'].items():
+            merged['counts'][feature_id] = merged['counts'].get(feature_id, 0) + count
+        for key in ('no_feature', 'ambiguous', 'counted_reads'):
+            merged[key] += result[key]
+    return merged
+
+
+def write_counts(feature_counts, path):
+    """
+    Writes counts as a tab separated file of feature id and count, followed
+    by the __no_feature and __ambiguous counts, as by htseq-count
+    """
+    with open(path, 'w') as out:
+        for feature_id, count in feature_counts['counts'].items():
+            out.write('{0}\t{1}\n'.format(feature_id, count))
+        out.write('__no_feature\t{0}\n'.format(feature_counts['no_feature']))
+        out.write('__ambiguous\t{0}\n'.format(feature_counts['ambiguous']))
+    return path
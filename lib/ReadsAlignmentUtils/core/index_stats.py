@@ -0,0 +1,86 @@
+from ReadsAlignmentUtils.core.bgzf import BaiIndex, BamHeader, BgzfReader, find_bai
+
+'''
+Per-contig record counts read from the BAI index of a BAM file, as printed
+by samtools idxstats, and checks of the alignment stats against them.
+
+Only the BAM header and the index are read, so this takes milliseconds
+whatever the size of the file.
+'''
+
+# name of the entry counting the unmapped records without a position
+UNPLACED_CONTIG = '*'
+
+
+def read_index_stats(bam_path):
+    """
+    Returns the contig, length and mapped and unmapped record counts of each
+    reference of a BAM file, from its BAI index, followed by a '*' entry of
+    the unplaced unmapped records. Returns None if the file has no index or
+    its index has no counts (e.g. indexes of old Picard versions).
+    """
+    bai_path = find_bai(bam_path)
+    if not bai_path:
+        return None
+    index = BaiIndex.read(bai_path)
+    with BgzfReader(bam_path) as bgzf:
+        header = BamHeader.read(bgzf)
+    if len(index.references) != len(header.names):
+        raise ValueError('Index {0} does not match {1}: {2} references instead of {3}'.format(
+            bai_path, bam_path, len(index.references), len(header.names)))
+    if not index.has_counts:
+        return None
+
+    contig_stats = []
+    for name, length, ref in zip(header.names, header.lengths, index.references):
+        contig_stats.append({'contig': name,
+                             'length': length,
+                             'mapped': ref.mapped,
+                             'unmapped': ref.unmapped})
+    contig_stats.append({'contig': UNPLACED_CONTIG,
+                         'length': 0,
+                         'mapped': 0,
+                         'unmapped': index.no_coordinate or 0})
+    return contig_stats
+
+
+def merge_index_stats(contig_stats_list):
+    """
+    Sums the counts of contig stats of several BAM files by contig, keeping
+    the order in which contigs are first seen and the '*' entry last
+    """
+    merged = {}
+    for contig_stats in contig_stats_list:
+        for entry in contig_stats:
+            if entry['contig'] not in merged:
+                merged[entry['contig']] = dict(entry)
+            else:
+                merged[entry['contig']]['mapped'] += entry['mapped']
+                merged[entry['contig']]['unmapped'] += entry['unmapped']
+    unplaced = merged.pop(UNPLACED_CONTIG, None)
+    result = list(merged.values())
+    if unplaced is not None:
+        result.append(unplaced)
+    return result
+
+
+def check_stats(stats, contig_stats):
+    """
+    Checks alignment stats against the index counts of the same file.
+
+    Every unmapped record is an unmapped read, and a mapped read has at least
+    one mapped record, so unmapped_reads must equal the unmapped records and
+    mapped_reads can not exceed the mapped records.
+
+    :returns a list of the mismatches found, empty if the stats agree
+    """
+    mapped_records = sum(entry['mapped'] for entry in contig_stats)
+    unmapped_records = sum(entry['unmapped'] for entry in contig_stats)
+    errors = []
+    if stats.get('unmapped_reads') != unmapped_records:
+        errors.append('unmapped_reads is {0} but the index counts {1} unmapped records'.format(
+            stats.get('unmapped_reads'), unmapped_records))
+    if (stats.get('mapped_reads') or 0) > mapped_records:
+        errors.append('mapped_reads is {0} but the index counts {1} mapped records'.format(
+            stats.get('mapped_reads'), mapped_records))
+    return errors
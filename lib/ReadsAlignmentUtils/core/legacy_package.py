@@ -0,0 +1,147 @@
+import ctypes
+import os
+import struct
+import zipfile
+import zlib
+
+'''
+Extraction of the alignment files of legacy alignment objects, saved as a zip
+package of the bam file and its index, sometimes with other files such as
+the sam file or aligner logs.
+
+Only the bam and bai members at the top level of the package are extracted.
+Their data is streamed straight to their destination, and the blocks of the
+package already read are freed as it goes by punching holes in the file, so
+the package and the extracted files take about the space of the package at
+any time rather than twice it. Members are also read from the end of the
+package backwards, cutting the package behind each one, so that on file
+systems without hole punching the package still shrinks as it is read.
+'''
+
+ALIGNMENT_EXTENSIONS = ('.bam', '.bai')
+
+# read size when streaming a member
+COPY_BUFFER_SIZE = 1 << 20
+
+# signature, version, flags, compression, time, date, crc, compressed size,
+# uncompressed size, file name length, extra field length
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+_FLAG_ENCRYPTED = 0x1
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+# set to False once hole punching turns out not to be supported
+_punch_holes = True
+
+
+def _punch_hole(fd, offset, length):
+    """
+    Frees the blocks of a range of a file, keeping its size, where the OS and
+    file system support it
+    """
+    global _punch_holes
+    if not _punch_holes:
+        return
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except AttributeError:
+        _punch_holes = False
+        return
+    if fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, ctypes.c_longlong(offset),
+                 ctypes.c_longlong(length)) != 0:
+        _punch_holes = False
+
+
+def is_alignment_member(member, extensions=ALIGNMENT_EXTENSIONS):
+    """
+    Returns True if a member of a package is an alignment file at its top
+    level, as the files of the package were found by name after extraction
+    """
+    name = member.filename
+    if member.is_dir() or '/' in name or '\\' in name or name.startswith('.'):
+        return False
+    return os.path.splitext(name)[1] in extensions
+
+
+def _data_offset(package_file, member):
+    """
+    Returns the offset of the data of a member, following its local header
+    """
+    package_file.seek(member.header_offset)
+    header = _LOCAL_HEADER.unpack(package_file.read(_LOCAL_HEADER.size))
+    if header[0] != _LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile('Bad local header of {0}'.format(member.filename))
+    return member.header_offset + _LOCAL_HEADER.size + header[9] + header[10]
+
+
+def _stream_member(package_file, member, destination):
+    """
+    Writes the data of a stored or deflated member to destination, freeing
+    the blocks of the package behind it, and checks its CRC
+    """
+    offset = _data_offset(package_file, member)
+    end = offset + member.compress_size
+    decompressor = None
+    if member.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    while offset < end:
+        package_file.seek(offset)
+        data = package_file.read(min(COPY_BUFFER_SIZE, end - offset))
+        if not data:
+            raise zipfile.BadZipFile('Truncated member {0}'.format(member.filename))
+        _punch_hole(package_file.fileno(), offset, len(data))
+        offset += len(data)
+        if decompressor is None:
+            destination.write(data)
+            crc = zlib.crc32(data, crc)
+            continue
+        # bounded output, as sam members inflate several times
+        while data:
+            chunk = decompressor.decompress(data, COPY_BUFFER_SIZE)
+            destination.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+            data = decompressor.unconsumed_tail
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        destination.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+    if crc != member.CRC:
+        raise zipfile.BadZipFile('Bad CRC-32 for member {0}'.format(member.filename))
+
+
+def extract_alignment_files(zip_path, output_dir, extensions=ALIGNMENT_EXTENSIONS):
+    """
+    Extracts the alignment files of a zip package to output_dir and removes
+    the package.
+
+    :returns the paths of the extracted files, sorted
+    """
+    # a hidden name no member is extracted to, e.g. if the package itself is
+    # named as the bam file
+    package_path = os.path.join(os.path.dirname(zip_path),
+                                '.' + os.path.basename(zip_path) + '.extracting')
+    os.rename(zip_path, package_path)
+    extracted = []
+    with zipfile.ZipFile(package_path) as package, open(package_path, 'r+b') as package_file:
+        # the central directory has been read, so the package can be cut
+        # behind each member once it is extracted
+        members = sorted(package.infolist(), key=lambda member: member.header_offset,
+                         reverse=True)
+        for member in members:
+            if is_alignment_member(member, extensions):
+                path = os.path.join(output_dir, member.filename)
+                streamable = (member.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+                              and not member.flag_bits & _FLAG_ENCRYPTED)
+                with open(path, 'wb') as destination:
+                    if streamable:
+                        _stream_member(package_file, member, destination)
+                    else:
+                        with package.open(member) as source:
+                            for data in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+                                destination.write(data)
+                extracted.append(path)
+            package_file.truncate(member.header_offset)
+    os.remove(package_path)
+    return sorted(extracted)
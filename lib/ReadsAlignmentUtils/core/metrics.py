@@ -0,0 +1,214 @@
+import threading
+
+'''
+In-process metrics in the Prometheus text exposition format.
+
+The metrics are kept per process. When the server runs under uwsgi with
+several worker processes, each worker serves its own counts on /metrics.
+'''
+
+PREFIX = 'readsalignmentutils_'
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{0}="{1}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Metric:
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{0} expects labels {1}, got {2}'.format(
+                self.name, list(self.labelnames), sorted(labels)))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Returns a list of (name, labels, value) tuples
+        """
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, e.g. the number of requests
+    """
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only be increased')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. the number of requests in flight
+    """
+
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, e.g. request durations in seconds, in cumulative buckets
+    """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+            samples = []
+            for key, (counts, total) in values:
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key + (('le', _format_value(bound)),),
+                                    cumulative))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, cumulative))
+            return samples
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process and renders them for the /metrics route
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Adds a function that is called on each render and returns a list of
+        metrics holding values read at that time, e.g. queue depths
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        for collector in collectors:
+            metrics.extend(collector())
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.metric_type))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, _format_labels(labels),
+                                                 _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def queue_collector(*queues):
+    """
+    Returns a collector exposing the stats of ResourceQueues as gauges
+    """
+    def collect():
+        gauges = {
+            'queued': Gauge(PREFIX + 'queue_jobs_waiting', 'Jobs waiting in the queue',
+                            ['queue']),
+            'running': Gauge(PREFIX + 'queue_jobs_running', 'Jobs admitted by the queue',
+                             ['queue']),
+            'cpu_in_use': Gauge(PREFIX + 'queue_cpu_in_use', 'CPU slots held by running jobs',
+                                ['queue']),
+            'memory_in_use_mb': Gauge(PREFIX + 'queue_memory_in_use_mb',
+                                      'Memory held by running jobs, in MB', ['queue']),
+            'mean_wait_time': Gauge(PREFIX + 'queue_mean_wait_seconds',
+                                    'Mean time jobs waited in the queue', ['queue']),
+            'max_wait_time': Gauge(PREFIX + 'queue_max_wait_seconds',
+                                   'Longest time a job waited in the queue', ['queue']),
+        }
+        for queue in queues:
+            stats = queue.stats()
+            for key, gauge in gauges.items():
+                gauge.set(stats[key], queue=stats['name'])
+        return list(gauges.values())
+    return collect
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.register(Counter(
+    PREFIX + 'requests_total', 'Method calls by method and outcome', ['method', 'status']))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    PREFIX + 'request_duration_seconds', 'Method call latency, including queueing',
+    ['method']))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    PREFIX + 'requests_in_flight', 'Method calls being served', ['method']))
+BYTES_PROCESSED = REGISTRY.register(Counter(
+    PREFIX + 'bytes_processed_total', 'Size of the alignment files uploaded or downloaded',
+    ['method']))
+TOOL_DURATION = REGISTRY.register(Histogram(
+    PREFIX + 'tool_duration_seconds', 'Run time of samtools and Picard processes, '
+    'excluding the time waiting in the tool queue', ['tool']))
@@ -0,0 +1,131 @@
+import cProfile
+import heapq
+import os
+import pstats
+import re
+import time
+from collections import defaultdict
+
+'''
+Opt-in profiling of single method calls.
+
+A call is profiled when the KB_PROFILE_CALLS environment variable is set to
+a true value, or when its JSON-RPC context has "profile": true. The profile
+is written to <scratch>/profiles as a .pstats file, which can be read with
+pstats or snakeviz, and as a .collapsed file of folded stacks, the format
+py-spy and flamegraph.pl use, which can be turned into a flame graph.
+
+cProfile only profiles the thread it runs in, so the work a call hands to
+worker threads or external processes shows as time waiting for them.
+'''
+
+PROFILE_ENV = 'KB_PROFILE_CALLS'
+
+# stacks deeper than this are cut off in the collapsed output
+MAX_STACK_DEPTH = 200
+
+# stacks expanded into their callees in the collapsed output, heaviest first
+MAX_STACKS = 20000
+
+
+def profiling_requested(rpc_context=None):
+    """
+    Returns True if the call with the given JSON-RPC context should be profiled
+    """
+    if os.environ.get(PROFILE_ENV, '').lower() in ('1', 'true', 'yes'):
+        return True
+    return bool(isinstance(rpc_context, dict) and rpc_context.get('profile'))
+
+
+def profile_call(output_dir, call_id, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) under cProfile and writes the profile to
+    output_dir, tagged with call_id. Only the calling thread is profiled.
+
+    :returns a tuple of the return value of func and the path of the .pstats file
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    tag = re.sub(r'[^\w.-]', '_', str(call_id)) + '_' + str(int(time.time() * 1000))
+    pstats_path = os.path.join(output_dir, tag + '.pstats')
+
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(pstats_path)
+        write_collapsed_stacks(pstats.Stats(pstats_path),
+                               os.path.join(output_dir, tag + '.collapsed'))
+    return result, pstats_path
+
+
+def _frame_label(func):
+    file_name, line, name = func
+    if file_name == '~':
+        # built in functions
+        label = name
+    else:
+        label = '{0} ({1}:{2})'.format(name, os.path.basename(file_name), line)
+    return label.replace(';', ':')
+
+
+def write_collapsed_stacks(stats, path):
+    """
+    Writes the call graph of a pstats.Stats as folded stacks, one
+    "frame;frame;frame microseconds" line per stack.
+
+    cProfile only records caller -> callee edges, not full stacks, so the
+    time of a function reached along several paths is split between them in
+    proportion to the time recorded on each edge. As the number of paths can
+    grow exponentially with depth, stacks are expanded heaviest first, and
+    past MAX_STACKS or MAX_STACK_DEPTH a stack is written with its cumulative
+    time, including that of the callees it is not expanded into.
+    """
+    callees = defaultdict(dict)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    folded = defaultdict(float)
+    # (-cumulative time on the stack, tie breaker, function, the (stack,
+    # functions on it, depth) of its caller, fraction of the time of the
+    # function spent on the stack)
+    heap = [(-ct, i, func, None, 1.0)
+            for i, (func, (cc, nc, tt, ct, callers)) in enumerate(stats.stats.items())
+            if not callers]
+    heapq.heapify(heap)
+    pushed = len(heap)
+    expanded = 0
+    while heap:
+        _, _, func, caller, fraction = heapq.heappop(heap)
+        cc, nc, tt, ct, callers = stats.stats[func]
+        if caller is None:
+            stack, on_stack, depth = _frame_label(func), frozenset([func]), 1
+        else:
+            stack = caller[0] + ';' + _frame_label(func)
+            on_stack, depth = caller[1] | {func}, caller[2] + 1
+        if expanded >= MAX_STACKS or depth >= MAX_STACK_DEPTH:
+            folded[stack] += ct * fraction
+            continue
+        expanded += 1
+        folded[stack] += tt * fraction
+        node = (stack, on_stack, depth)
+        for callee, edge in callees[func].items():
+            callee_ct = stats.stats[callee][3]
+            if callee in on_stack or callee_ct <= 0:
+                continue
+            # edge: (call count, primitive call count, total time, cumulative time)
+            callee_fraction = fraction * edge[3] / callee_ct
+            if callee_fraction * callee_ct < 1e-6:
+                # too little time to show, kept in the caller
+                folded[stack] += callee_fraction * callee_ct
+                continue
+            heapq.heappush(heap, (-callee_fraction * callee_ct, pushed, callee, node,
+                                  callee_fraction))
+            pushed += 1
+
+    with open(path, 'w') as out:
+        for stack, seconds in sorted(folded.items()):
+            microseconds = int(round(seconds * 1e6))
+            if microseconds > 0:
+                out.write('{0} {1}\n'.format(stack, microseconds))
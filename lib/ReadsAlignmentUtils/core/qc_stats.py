@@ -0,0 +1,163 @@
+from array import array
+
+import numpy as np
+
+'''
+QC histograms collected in a record pass alongside the alignment stats.
+
+Values are buffered in compact arrays and binned with numpy every
+FLUSH_SIZE records, so each record costs a few appends. The histograms have
+a fixed size whatever the file, values past the last bin are counted in it.
+'''
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_READ1 = 0x40
+# secondary and supplementary alignments would count a read more than once
+FLAG_NOT_PRIMARY = 0x100 | 0x800
+
+CIGAR_SOFT_CLIP = 4
+
+MAPQ_BINS = 256
+# insert sizes of 0 to INSERT_SIZE_BINS - 2, and larger ones in the last bin
+INSERT_SIZE_BINS = 10001
+NM_BINS = 65
+
+FLUSH_SIZE = 1 << 20
+
+HISTOGRAMS = ('mapq', 'insert_size', 'nm')
+
+
+class QCStatsAccumulator:
+    """
+    Collects MAPQ, insert size and NM edit distance histograms and the soft
+    clipped fraction of bases of the primary mapped records of a BAM file.
+
+    Insert sizes are counted once per properly paired read, on the first
+    mate. NM is only counted for records that have the tag.
+
+    Usage:
+        qc = QCStatsAccumulator()
+        for alignment in pysam.AlignmentFile(bam_file):
+            qc.add_alignment(alignment)
+        qc.save(path)
+    """
+
+    def __init__(self):
+        self.mapq = np.zeros(MAPQ_BINS, dtype=np.int64)
+        self.insert_size = np.zeros(INSERT_SIZE_BINS, dtype=np.int64)
+        self.nm = np.zeros(NM_BINS, dtype=np.int64)
+        self.soft_clipped_bases = 0
+        self.query_bases = 0
+        self._mapq = array('B')
+        self._insert_size = array('l')
+        self._nm = array('l')
+
+    def add(self, flag, mapq, tlen, nm, soft_clipped, query_length):
+        """
+        Adds a record. nm is None if the record has no NM tag.
+        """
+        if flag & (FLAG_UNMAPPED | FLAG_NOT_PRIMARY):
+            return
+        self._mapq.append(mapq)
+        if flag & FLAG_PAIRED and flag & FLAG_PROPER_PAIR and flag & FLAG_READ1:
+            self._insert_size.append(abs(tlen))
+        if nm is not None:
+            self._nm.append(nm)
+        self.soft_clipped_bases += soft_clipped
+        self.query_bases += query_length
+        if len(self._mapq) >= FLUSH_SIZE:
+            self.flush()
+
+    def add_alignment(self, alignment):
+        """
+        Adds a pysam AlignedSegment
+        """
+        flag = alignment.flag
+        if flag & (FLAG_UNMAPPED | FLAG_NOT_PRIMARY):
+            return
+        soft_clipped = 0
+        for op, length in alignment.cigartuples or ():
+            if op == CIGAR_SOFT_CLIP:
+                soft_clipped += length
+        nm = alignment.get_tag('NM') if alignment.has_tag('NM') else None
+        self.add(flag, alignment.mapping_quality, alignment.template_length, nm,
+                 soft_clipped, alignment.query_length)
+
+    @staticmethod
+    def _bin(histogram, values):
+        if values:
+            counts = np.bincount(np.minimum(np.frombuffer(values, dtype=values.typecode),
+                                            histogram.size - 1),
+                                 minlength=histogram.size)
+            histogram += counts
+
+    def flush(self):
+        """
+        Bins the buffered values into the histograms
+        """
+        self._bin(self.mapq, self._mapq)
+        self._bin(self.insert_size, self._insert_size)
+        self._bin(self.nm, self._nm)
+        self._mapq = array('B')
+        self._insert_size = array('l')
+        self._nm = array('l')
+
+    @property
+    def soft_clip_fraction(self):
+        return float(self.soft_clipped_bases) / self.query_bases if self.query_bases else 0.0
+
+    def histograms(self):
+        """
+        Returns the histograms by name, see HISTOGRAMS
+        """
+        self.flush()
+        return {name: getattr(self, name) for name in HISTOGRAMS}
+
+    def summary(self):
+        """
+        Returns summary values of the histograms: the mean MAPQ, the median
+        insert size and mean NM, and the soft clipped fraction of bases
+        """
+        histograms = self.histograms()
+
+        def mean(counts):
+            total = int(counts.sum())
+            return float(np.dot(np.arange(counts.size), counts)) / total if total else 0.0
+
+        def median(counts):
+            total = counts.sum()
+            if not total:
+                return 0
+            return int(np.searchsorted(np.cumsum(counts), (total + 1) // 2))
+
+        return {
+            'mean_mapq': round(mean(histograms['mapq']), 3),
+            'median_insert_size': median(histograms['insert_size']),
+            'mean_nm': round(mean(histograms['nm']), 3),
+            'soft_clip_fraction': round(self.soft_clip_fraction, 6)
+        }
+
+    def save(self, path):
+        """
+        Saves the histograms and soft clip counts to a compressed .npz file
+        """
+        np.savez_compressed(path,
+                            soft_clipped_bases=np.int64(self.soft_clipped_bases),
+                            query_bases=np.int64(self.query_bases),
+                            **self.histograms())
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the QCStatsAccumulator saved to path
+        """
+        qc = cls()
+        with np.load(path) as saved:
+            for name in HISTOGRAMS:
+                getattr(qc, name)[:] = saved[name]
+            qc.soft_clipped_bases = int(saved['soft_clipped_bases'])
+            qc.query_bases = int(saved['query_bases'])
+        return qc
@@ -0,0 +1,204 @@
+import struct
+
+import numpy as np
+
+from ReadsAlignmentUtils.core.alignment_stats import read_id_hashes
+from ReadsAlignmentUtils.core.bgzf import BamHeader, BgzfReader, split_virtual_offset
+
+'''
+The fixed fields of the records of an alignment file as chunks of NumPy
+structured arrays, for stats written as vectorized operations over chunks
+rather than per-record attribute access on pysam AlignedSegments.
+
+BAM files are read block by block with the BGZF reader. The offsets of the
+records of a buffer are found with one pass over their sizes, and their
+fixed fields are then gathered and the read names hashed for all records of
+the buffer at once. Other files (SAM) are read with pysam into the same
+chunks. Memory is bounded by a chunk and a buffer of decompressed blocks.
+
+Usage:
+    for chunk in iter_chunks(bam_path):
+        mapped = np.count_nonzero(chunk['flag'] & 0x4 == 0)
+'''
+
+CHUNK_SIZE = 1 << 16
+# decompressed data parsed at a time
+BUFFER_SIZE = 1 << 22
+
+FLAG_PAIRED = 0x1
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+
+RECORD_DTYPE = np.dtype([
+    ('flag', np.uint16),
+    ('ref_id', np.int32),
+    ('pos', np.int32),
+    ('mapq', np.uint8),
+    ('next_ref_id', np.int32),
+    ('next_pos', np.int32),
+    ('tlen', np.int32),
+    ('qname_hash', np.uint64),
+    ('is_read1', np.bool_),
+    ('is_read2', np.bool_)
+])
+
+# the fixed part of a BAM record, from block_size to tlen
+_BAM_RECORD_DTYPE = np.dtype([
+    ('block_size', '<i4'),
+    ('ref_id', '<i4'),
+    ('pos', '<i4'),
+    ('l_read_name', 'u1'),
+    ('mapq', 'u1'),
+    ('bin', '<u2'),
+    ('n_cigar_op', '<u2'),
+    ('flag', '<u2'),
+    ('l_seq', '<i4'),
+    ('next_ref_id', '<i4'),
+    ('next_pos', '<i4'),
+    ('tlen', '<i4')
+])
+_FIXED_SIZE = _BAM_RECORD_DTYPE.itemsize
+_FIXED_OFFSETS = np.arange(_FIXED_SIZE)
+_BLOCK_SIZE = struct.Struct('<i')
+
+
+def is_bam(path):
+    """
+    Returns True if path is a BGZF compressed BAM file
+    """
+    with open(path, 'rb') as infile:
+        return infile.read(4) == b'\x1f\x8b\x08\x04'
+
+
+def _set_read_flags(records):
+    flags = records['flag']
+    records['is_read1'] = (flags & FLAG_PAIRED != 0) & (flags & FLAG_READ1 != 0)
+    records['is_read2'] = (flags & FLAG_PAIRED != 0) & (flags & FLAG_READ2 != 0)
+
+
+def parse_records(data, offsets):
+    """
+    Returns the records starting at offsets of data, a uint8 array, as an
+    array of RECORD_DTYPE
+    """
+    fixed = data[offsets[:, None] + _FIXED_OFFSETS].view(_BAM_RECORD_DTYPE).reshape(-1)
+    records = np.empty(len(offsets), dtype=RECORD_DTYPE)
+    for name in ('flag', 'ref_id', 'pos', 'mapq', 'next_ref_id', 'next_pos', 'tlen'):
+        records[name] = fixed[name]
+    # read names are NUL terminated
+    records['qname_hash'] = read_id_hashes(data, offsets + _FIXED_SIZE,
+                                           fixed['l_read_name'].astype(np.int64) - 1)
+    _set_read_flags(records)
+    return records
+
+
+def _record_offsets(data, end):
+    """
+    Returns the offsets of the complete records of data[:end] and the offset
+    following the last of them
+    """
+    offsets = []
+    unpack_from = _BLOCK_SIZE.unpack_from
+    i = 0
+    while i + 4 <= end:
+        block_size = unpack_from(data, i)[0]
+        if i + 4 + block_size > end:
+            break
+        offsets.append(i)
+        i += 4 + block_size
+    return np.array(offsets, dtype=np.int64), i
+
+
+def _iter_bam_records(bam_path):
+    """
+    Yields arrays of the records of a BAM file, one per buffer of blocks
+    """
+    with BgzfReader(bam_path) as bgzf:
+        header = BamHeader.read(bgzf)
+        coffset, uoffset = split_virtual_offset(header.first_record)
+        buffer = bytearray()
+        for _, block, _ in bgzf.blocks(coffset):
+            buffer += block[uoffset:]
+            uoffset = 0
+            if len(buffer) < BUFFER_SIZE:
+                continue
+            offsets, end = _record_offsets(buffer, len(buffer))
+            if len(offsets):
+                yield parse_records(np.frombuffer(bytes(buffer[:end]), dtype=np.uint8), offsets)
+            del buffer[:end]
+        offsets, end = _record_offsets(buffer, len(buffer))
+        if end != len(buffer):
+            raise ValueError('Truncated BAM record at the end of {0}'.format(bam_path))
+        if len(offsets):
+            yield parse_records(np.frombuffer(bytes(buffer), dtype=np.uint8), offsets)
+
+
+def _iter_pysam_records(path, chunk_size):
+    """
+    Yields arrays of the records of a file read with pysam, e.g. a SAM file
+    """
+    import pysam
+
+    with pysam.AlignmentFile(path, 'r', check_sq=False) as infile:
+        columns = {name: [] for name in RECORD_DTYPE.names if name != 'qname_hash'}
+        names = bytearray()
+        name_starts, name_lengths = [], []
+        for alignment in infile:
+            columns['flag'].append(alignment.flag)
+            columns['ref_id'].append(alignment.reference_id)
+            columns['pos'].append(alignment.reference_start)
+            columns['mapq'].append(alignment.mapping_quality)
+            columns['next_ref_id'].append(alignment.next_reference_id)
+            columns['next_pos'].append(alignment.next_reference_start)
+            columns['tlen'].append(alignment.template_length)
+            name = (alignment.query_name or '').encode()
+            name_starts.append(len(names))
+            name_lengths.append(len(name))
+            names += name
+            if len(name_starts) == chunk_size:
+                yield _records_from_columns(columns, names, name_starts, name_lengths)
+                for values in columns.values():
+                    del values[:]
+                names = bytearray()
+                name_starts, name_lengths = [], []
+        if name_starts:
+            yield _records_from_columns(columns, names, name_starts, name_lengths)
+
+
+def _records_from_columns(columns, names, name_starts, name_lengths):
+    records = np.empty(len(name_starts), dtype=RECORD_DTYPE)
+    for name in ('flag', 'ref_id', 'pos', 'mapq', 'next_ref_id', 'next_pos', 'tlen'):
+        records[name] = columns[name]
+    records['qname_hash'] = read_id_hashes(np.frombuffer(bytes(names), dtype=np.uint8),
+                                           name_starts, name_lengths)
+    _set_read_flags(records)
+    return records
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    Yields the records of a BAM or SAM file, in file order, as arrays of
+    RECORD_DTYPE of chunk_size records, the last one possibly shorter.
+
+    Fields:
+        flag, ref_id, pos (0-based, -1 if unplaced), mapq, next_ref_id,
+        next_pos, tlen - as in the BAM record
+        qname_hash - read_id_hash of the read name
+        is_read1, is_read2 - paired and first or second mate
+    """
+    if is_bam(path):
+        arrays = _iter_bam_records(path)
+    else:
+        arrays = _iter_pysam_records(path, chunk_size)
+    pending = []
+    pending_size = 0
+    for records in arrays:
+        pending.append(records)
+        pending_size += len(records)
+        while pending_size >= chunk_size:
+            records = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield records[:chunk_size]
+            pending = [records[chunk_size:]]
+            pending_size -= chunk_size
+    if pending_size:
+        yield np.concatenate(pending)
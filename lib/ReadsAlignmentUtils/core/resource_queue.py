@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class ResourceQueue:
+    """
+    A first-in first-out queue that admits jobs while enough CPU slots and
+    memory are free.
+
+    Each job declares the number of CPUs and the memory (in MB) it expects to
+    use. A job that asks for more than the queue's capacity is clamped to it,
+    so it runs on its own rather than waiting forever. Jobs are admitted in
+    arrival order: a large job at the head of the queue holds back the smaller
+    jobs behind it, so it can not be starved by them.
+
+    Usage:
+        queue = ResourceQueue(cpu_slots=4, memory_mb=8192)
+        with queue.slot(cpu=2, memory_mb=1024) as wait_time:
+            run_job()
+    """
+
+    def __init__(self, cpu_slots, memory_mb=None, name='jobs'):
+        """
+        :param cpu_slots: number of CPUs shared by the jobs
+        :param memory_mb: memory shared by the jobs, in MB. None for no limit
+        :param name: name of the queue, used in stats
+        """
+        self.cpu_slots = max(int(cpu_slots), 1)
+        self.memory_mb = int(memory_mb) if memory_mb else None
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._cpu_in_use = 0
+        self._memory_in_use = 0
+        self._running = 0
+        self._completed = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _clamp(self, cpu, memory_mb):
+        """
+        limit the requested resources to the capacity of the queue
+        """
+        cpu = min(max(int(cpu), 1), self.cpu_slots)
+        memory_mb = max(int(memory_mb or 0), 0)
+        if self.memory_mb is not None:
+            memory_mb = min(memory_mb, self.memory_mb)
+        return cpu, memory_mb
+
+    def _fits(self, cpu, memory_mb):
+        """
+        Returns True if a job with the given (clamped) requirements can start now
+        """
+        if self._cpu_in_use + cpu > self.cpu_slots:
+            return False
+        if self.memory_mb is not None and self._memory_in_use + memory_mb > self.memory_mb:
+            return False
+        return True
+
+    @contextmanager
+    def slot(self, cpu=1, memory_mb=0):
+        """
+        Blocks until the job reaches the head of the queue and its resources
+        are free, then holds them until the with block exits.
+
+        :param cpu: number of CPUs the job is expected to use
+        :param memory_mb: memory the job is expected to use, in MB
+        :returns the time in seconds the job waited in the queue
+        """
+        cpu, memory_mb = self._clamp(cpu, memory_mb)
+        ticket = object()
+        start_time = time.time()
+
+        with self._cond:
+            self._waiting.append(ticket)
+            while self._waiting[0] is not ticket or not self._fits(cpu, memory_mb):
+                self._cond.wait()
+            self._waiting.popleft()
+            self._cpu_in_use += cpu
+            self._memory_in_use += memory_mb
+            self._running += 1
+
+            wait_time = time.time() - start_time
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            # the next job in line may fit in what is left
+            self._cond.notify_all()
+
+        try:
+            yield wait_time
+        finally:
+            with self._cond:
+                self._cpu_in_use -= cpu
+                self._memory_in_use -= memory_mb
+                self._running -= 1
+                self._completed += 1
+                self._cond.notify_all()
+
+    def stats(self):
+        """
+        Returns a snapshot of the queue depth, resource use and wait times
+        """
+        with self._cond:
+            admitted = self._running + self._completed
+            return {'name': self.name,
+                    'queued': len(self._waiting),
+                    'running': self._running,
+                    'completed': self._completed,
+                    'cpu_slots': self.cpu_slots,
+                    'cpu_in_use': self._cpu_in_use,
+                    'memory_mb': self.memory_mb,
+                    'memory_in_use_mb': self._memory_in_use,
+                    'total_wait_time': self._total_wait_time,
+                    'max_wait_time': self._max_wait_time,
+                    'mean_wait_time': self._total_wait_time / admitted if admitted else 0.0
+                    }
@@ -1,11 +1,44 @@
 import logging
 import os
 import re
+import shlex
+import threading
+import time
+from contextlib import contextmanager
 from subprocess import Popen, PIPE
 
+from .metrics import TOOL_DURATION
+from .resource_queue import ResourceQueue
+from .stage_timer import track_process
 from .script_utils import log as log
 from .script_utils import whereis
 
+# estimated memory use, in MB, of samtools commands that stream their input
+STREAMING_TOOL_MEMORY_MB = 100
+
+# estimated memory use, in MB, of Picard run with the default heap of the JVM
+PICARD_MEMORY_MB = 2048
+
+_tool_queue = None
+_tool_queue_lock = threading.Lock()
+
+
+def get_tool_queue(config=None):
+    """
+    Returns the process-wide queue that all samtools and Picard processes wait
+    in, so concurrent requests do not oversubscribe the CPUs and memory of the
+    node. The queue is sized from the config of the first caller
+    (tool_cpu_slots, default: CPU count; tool_memory_mb, default: unlimited).
+    """
+    global _tool_queue
+    with _tool_queue_lock:
+        if _tool_queue is None:
+            config = config or {}
+            _tool_queue = ResourceQueue(config.get('tool_cpu_slots') or os.cpu_count() or 1,
+                                        memory_mb=config.get('tool_memory_mb'),
+                                        name='tools')
+        return _tool_queue
+
 
 class SamTools:
     """
@@ -19,8 +52,49 @@ class SamTools:
     def __init__(self, config, logger=None):
         self.config = config
         self.logger = logger
+        config = config or {}
+        # samtools sort uses up to sort_memory_mb per thread
+        self.sort_threads = max(int(config.get('samtools_sort_threads') or 1), 1)
+        self.sort_memory_mb = int(config.get('samtools_sort_memory_mb') or 768)
+        # the JVM picks its own default heap unless picard_memory_mb is set
+        self.picard_memory_mb = config.get('picard_memory_mb')
+        if self.picard_memory_mb:
+            self.picard_memory_mb = int(self.picard_memory_mb)
         pass
 
+    @contextmanager
+    def _tool_slot(self, name, cpu=1, memory_mb=STREAMING_TOOL_MEMORY_MB):
+        """
+        Waits for a turn in the process-wide tool queue, then records the
+        resource use of the external process run in the with block on the
+        current stage timer and its run time in the tool metrics.
+        """
+        with get_tool_queue(self.config).slot(cpu=cpu, memory_mb=memory_mb):
+            start_time = time.time()
+            try:
+                with track_process(name):
+                    yield
+            finally:
+                TOOL_DURATION.observe(time.time() - start_time, tool=name)
+
+    def _sort_options(self):
+        """
+        thread and memory options for samtools sort
+        """
+        options = '-m {0}M'.format(self.sort_memory_mb)
+        if self.sort_threads > 1:
+            # -@ is the number of threads in addition to the main one
+            options += ' -@ {0}'.format(self.sort_threads - 1)
+        return options
+
+    def _java_options(self):
+        """
+        heap option for Picard, empty for the default heap of the JVM
+        """
+        if not self.picard_memory_mb:
+            return ''
+        return '-Xmx{0}m'.format(self.picard_memory_mb)
+
     def _prepare_paths(self, ifile, ipath, ofile, opath, iext, oext):
         """
         setup input and output file paths and extensions
@@ -162,15 +236,19 @@ class SamTools:
         # value is not being checked.
         try:
             log('Converting sam to sorted bam for file: ' + str(ifile) + ' with cwd: ' + str(opath))
-            sort = Popen(
-                'samtools sort -l 9 -O BAM > {0}'.format(ofile),
-                shell=True,
-                stdin=PIPE,
-                stdout=PIPE,
-                cwd=opath)
-            view = Popen('samtools view -bS {0}'.format(ifile), shell=True, stdout=sort.stdin, cwd=opath)
-            result, stderr = sort.communicate()  # samtools always returns success
-            view.wait()
+            with self._tool_slot('samtools sort', cpu=self.sort_threads + 1,
+                                 memory_mb=self.sort_memory_mb * self.sort_threads +
+                                 STREAMING_TOOL_MEMORY_MB):
+                sort = Popen(
+                    'samtools sort -l 9 {0} -O BAM > {1}'.format(self._sort_options(), ofile),
+                    shell=True,
+                    stdin=PIPE,
+                    stdout=PIPE,
+                    cwd=opath)
+                view = Popen('samtools view -bS {0}'.format(ifile), shell=True, stdout=sort.stdin,
+                             cwd=opath)
+                result, stderr = sort.communicate()  # samtools always returns success
+                view.wait()
         except Exception as ex:
             log(f'failed to convert {ifile} to {ofile}. {str(ex)}', logging.ERROR)
 
@@ -215,9 +293,10 @@ class SamTools:
         # value is not being checked.
         try:
             log('Converting bam to sam for file: ' + str(ifile) + ' with output file: '+str(ofile)+' and cwd: ' + str(opath))
-            convert = Popen('samtools view -h {0} > {1}'.format(ifile, ofile),
-                            shell=True, stdin=PIPE, stdout=PIPE, cwd=opath)
-            convert.communicate()
+            with self._tool_slot('samtools view'):
+                convert = Popen('samtools view -h {0} > {1}'.format(ifile, ofile),
+                                shell=True, stdin=PIPE, stdout=PIPE, cwd=opath)
+                convert.communicate()
         except Exception as ex:
             log(f'failed to convert {ifile} to {ofile}. {str(ex)}', logging.ERROR)
 
@@ -264,15 +343,114 @@ class SamTools:
         # value is not being checked.
         try:
             log('Creating bai from bam for file: ' + str(ifile) + ' with output file: ' + str(ofile) + ' and cwd: ' + str(opath))
-            create = Popen('samtools index {0} {1}'.format(ifile, ofile),
-                           shell=True, stdin=PIPE, stdout=PIPE, cwd=opath)
-            create.communicate()
+            with self._tool_slot('samtools index'):
+                create = Popen('samtools index {0} {1}'.format(ifile, ofile),
+                               shell=True, stdin=PIPE, stdout=PIPE, cwd=opath)
+                create.communicate()
         except Exception as ex:
             log(f'failed to convert {ifile} to {ofile}. {str(ex)}', logging.ERROR)
             return 1
 
         return 0
 
+    def sort_bam(self, ifile, ipath, ofile, opath=None):
+        """
+        Sorts the specified sam or bam file by coordinate into a bam file
+
+        :param ifile: sam or bam file name
+        :param ipath: absolute path to the input file
+        :param ofile: sorted bam file name
+        :param opath: absolute path to the sorted bam file. If None, ipath will be used
+
+        :returns 0 if successful, else 1
+        """
+        ifile, ofile, opath = self._prepare_paths(ifile, ipath, ofile, opath, '.sam', '.bam')
+
+        if not os.path.exists(ifile):
+            raise RuntimeError(None, 'Input file does not exist: ' + str(ifile))
+
+        self._check_prog()
+
+        #   samtools sort -l 9 -O BAM -o ofile ifile
+        log('Sorting ' + str(ifile) + ' to ' + str(ofile))
+        with self._tool_slot('samtools sort', cpu=self.sort_threads + 1,
+                             memory_mb=self.sort_memory_mb * self.sort_threads +
+                             STREAMING_TOOL_MEMORY_MB):
+            sort = Popen('samtools sort -l 9 {0} -O BAM -o {1} {2}'.format(
+                self._sort_options(), ofile, ifile), shell=True, stdout=PIPE, stderr=PIPE,
+                cwd=opath)
+            result, stderr = sort.communicate()
+        if sort.returncode != 0:
+            log('failed to sort {0}. {1}'.format(ifile, stderr.decode()), logging.ERROR)
+            return 1
+
+        return 0
+
+    def merge_bams(self, ifiles, ofile):
+        """
+        Merges coordinate sorted bam files into one coordinate sorted bam file,
+        compressing with samtools_sort_threads threads. Read groups and program
+        records of the same ID are combined rather than renamed.
+
+        :param ifiles: absolute paths to the sorted bam files
+        :param ofile: absolute path to the merged bam file
+
+        :returns 0 if successful, else 1
+        """
+        for ifile in ifiles:
+            if not os.path.exists(ifile):
+                raise RuntimeError(None, 'Input bam file does not exist: ' + str(ifile))
+
+        self._check_prog()
+
+        #   samtools merge -f -c -p -@ threads ofile ifiles...
+        threads = ' -@ {0}'.format(self.sort_threads - 1) if self.sort_threads > 1 else ''
+        log('Merging {0} bam files to {1}'.format(len(ifiles), ofile))
+        with self._tool_slot('samtools merge', cpu=self.sort_threads):
+            merge = Popen('samtools merge -f -c -p{0} {1} {2}'.format(
+                threads, ofile, ' '.join(ifiles)), shell=True, stdout=PIPE, stderr=PIPE,
+                cwd=os.path.dirname(ofile))
+            result, stderr = merge.communicate()
+        if merge.returncode != 0:
+            log('failed to merge to {0}. {1}'.format(ofile, stderr.decode()), logging.ERROR)
+            return 1
+
+        return 0
+
+    def extract_regions(self, ifile, ipath, regions, ofile, opath=None):
+        """
+        Writes the records of regions of an indexed bam file to a bam file
+
+        :param ifile: bam file name, with a BAI index
+        :param ipath: absolute path to the bam file
+        :param regions: samtools regions, e.g. 'chr1:1-1000', or '*' for the
+        unplaced unmapped records
+        :param ofile: output bam file name
+        :param opath: absolute path to the output bam file. If None, ipath will be used
+
+        :returns 0 if successful, else 1
+        """
+        ifile, ofile, opath = self._prepare_paths(ifile, ipath, ofile, opath, '.bam', '.bam')
+
+        if not os.path.exists(ifile):
+            raise RuntimeError(None, 'Input bam file does not exist: ' + str(ifile))
+
+        self._check_prog()
+
+        #   samtools view -b -o ofile ifile regions...
+        log('Extracting {0} regions of {1} to {2}'.format(len(regions), ifile, ofile))
+        with self._tool_slot('samtools view'):
+            extract = Popen('samtools view -b -o {0} {1} {2}'.format(
+                ofile, ifile, ' '.join(shlex.quote(region) for region in regions)),
+                shell=True, stdout=PIPE, stderr=PIPE, cwd=opath)
+            result, stderr = extract.communicate()
+        if extract.returncode != 0:
+            log('failed to extract regions of {0}. {1}'.format(ifile, stderr.decode()),
+                logging.ERROR)
+            return 1
+
+        return 0
+
     def get_stats(self, ifile, ipath):
         """
         Generate simple statistics from a BAM file. The statistics collected include
@@ -299,9 +477,10 @@ class SamTools:
         # samtools appears to operates on garbage-in-garbage out policy. i.e.
         # it does not validate input and always returns True. Hence output
         # value is not being checked.
-        stats = Popen('samtools flagstat {0}'.format(ifile),
-                      shell=True, stdin=PIPE, stdout=PIPE)
-        stats, stderr = stats.communicate()
+        with self._tool_slot('samtools flagstat'):
+            stats = Popen('samtools flagstat {0}'.format(ifile),
+                          shell=True, stdin=PIPE, stdout=PIPE)
+            stats, stderr = stats.communicate()
 
         result = self._extractAlignmentStatsInfo(stats.decode())
 
@@ -330,12 +509,14 @@ class SamTools:
 
         try:
             # java -jar picard.jar ValidateSamFile I=ifile MODE=SUMMARY
-            validation = Popen(
-                'java -jar '
-                '/opt/picard/build/libs/picard.jar ValidateSamFile I={0} '
-                'MODE=SUMMARY'.format(ifile),
-                shell=True, stdin=PIPE, stdout=PIPE)
-            result, stderr = validation.communicate()
+            with self._tool_slot('picard ValidateSamFile',
+                                 memory_mb=self.picard_memory_mb or PICARD_MEMORY_MB):
+                validation = Popen(
+                    'java {0} -jar '
+                    '/opt/picard/build/libs/picard.jar ValidateSamFile I={1} '
+                    'MODE=SUMMARY'.format(self._java_options(), ifile),
+                    shell=True, stdin=PIPE, stdout=PIPE)
+                result, stderr = validation.communicate()
 
             if self._is_valid(result.decode(), ignore):
                 log(f'{ifile} passed validation', logging.INFO, self.logger)
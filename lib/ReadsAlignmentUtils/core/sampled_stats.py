@@ -0,0 +1,225 @@
+import math
+import random
+from statistics import NormalDist
+
+from ReadsAlignmentUtils.core.bgzf import (BaiIndex, BamHeader, BgzfReader, find_bai,
+                                           find_record_start, iter_records,
+                                           split_virtual_offset)
+
+'''
+Estimates of the alignment rate and properly paired count of a BAM file
+from a random sample of its BGZF blocks.
+
+Blocks are picked at evenly spaced offsets in the compressed data from a
+random start, so each block is picked with a probability proportional to its
+compressed size. The records starting in each picked block are counted, and the
+estimates are Horvitz-Thompson weighted ratios over the blocks, with
+confidence intervals from the between-block variance, treating the sample
+as random. Records in a block are far from independent (a coordinate sorted
+file keeps its unmapped reads together at the end), which the block level
+variance accounts for.
+
+With a BAI index the numbers of mapped and unmapped records come from the
+index and only the share of primary alignments among the mapped records is
+sampled. Record starts are taken from its linear index where a picked block
+has one.
+'''
+
+DEFAULT_SAMPLE_BLOCKS = 256
+DEFAULT_CONFIDENCE = 0.95
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+# secondary and supplementary alignments are extra records of a read
+FLAG_NOT_PRIMARY = 0x100 | 0x800
+
+
+class _BlockCounts:
+
+    __slots__ = ('weight', 'records', 'mapped', 'primary', 'primary_mapped', 'proper')
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.records = 0
+        self.mapped = 0
+        self.primary = 0
+        self.primary_mapped = 0
+        self.proper = 0
+
+    def add(self, flag):
+        self.records += 1
+        if not flag & FLAG_UNMAPPED:
+            self.mapped += 1
+        if flag & FLAG_NOT_PRIMARY:
+            return
+        self.primary += 1
+        if not flag & FLAG_UNMAPPED:
+            self.primary_mapped += 1
+            if flag & FLAG_PAIRED and flag & FLAG_PROPER_PAIR:
+                self.proper += 1
+
+
+def _ratio(blocks, numerator, denominator, z):
+    """
+    Returns the weighted ratio estimate of sum(numerator) / sum(denominator)
+    over the blocks and its confidence interval
+    """
+    den = sum(b.weight * getattr(b, denominator) for b in blocks)
+    if not den:
+        return 0.0, (0.0, 0.0)
+    num = sum(b.weight * getattr(b, numerator) for b in blocks)
+    ratio = num / den
+    n = len(blocks)
+    if n < 2:
+        return ratio, (0.0, 1.0)
+    residuals = sum((b.weight * (getattr(b, numerator) - ratio * getattr(b, denominator))) ** 2
+                    for b in blocks)
+    half_width = z * math.sqrt(n / (n - 1.0) * residuals) / den
+    return ratio, (max(ratio - half_width, 0.0), min(ratio + half_width, 1.0))
+
+
+def _count_records(bgzf, coffset, start, n_ref, block_counts):
+    """
+    Counts the records starting in the block at coffset into block_counts,
+    from data offset start or, if start is None, from the first record start
+    found in the block. Records spanning into the next block are completed
+    from it.
+    """
+    data, block_size = bgzf.read_block(coffset)
+    if start is None:
+        start = find_record_start(data, n_ref)
+        if start is None:
+            return block_size
+    end = len(data)
+    if coffset + block_size < bgzf.data_end:
+        data += bgzf.read_block(coffset + block_size)[0]
+    for offset, fields in iter_records(data, start):
+        if offset >= end:
+            break
+        block_counts.add(fields[7])
+    return block_size
+
+
+def estimate_alignment_stats(bam_path, sample_blocks=DEFAULT_SAMPLE_BLOCKS,
+                             confidence=DEFAULT_CONFIDENCE, seed=None):
+    """
+    Estimates the alignment rate and properly paired count of a BAM file.
+
+    alignment_rate is the percentage of primary records that are mapped,
+    which matches the alignment_rate of the full stats when each read has one
+    primary record. Files of no more than sample_blocks blocks are counted in
+    full.
+
+    :param bam_path: path of the BAM file, its BAI is used if found next to it
+    :param sample_blocks: number of blocks to sample
+    :param confidence: level of the confidence intervals, e.g. 0.95
+    :param seed: seed of the random sample, for repeatable estimates
+    :returns a dict of the estimates, their confidence intervals and the
+    size of the sample
+    """
+    if not 0 < confidence < 1:
+        raise ValueError('confidence must be between 0 and 1')
+    sample_blocks = max(int(sample_blocks), 2)
+    z = NormalDist().inv_cdf((1 + confidence) / 2.0)
+
+    bai = None
+    bai_path = find_bai(bam_path)
+    if bai_path:
+        bai = BaiIndex.read(bai_path)
+
+    with BgzfReader(bam_path) as bgzf:
+        header = BamHeader.read(bgzf)
+        n_ref = len(header.names)
+        first_coffset, first_uoffset = split_virtual_offset(header.first_record)
+        data_size = bgzf.data_end - first_coffset
+
+        # record starts known from the linear index, by block offset
+        known_starts = {first_coffset: first_uoffset}
+        if bai is not None:
+            for ref in bai.references:
+                for voffset in ref.linear_offsets:
+                    coffset, uoffset = split_virtual_offset(voffset)
+                    if coffset not in known_starts or uoffset < known_starts[coffset]:
+                        known_starts[coffset] = uoffset
+
+        blocks = []
+        census = data_size <= sample_blocks * 16384
+        if census:
+            # small files are read in full, every block has weight 1
+            coffset = first_coffset
+            while coffset < bgzf.data_end:
+                counts = _BlockCounts(1.0)
+                start = first_uoffset if coffset == first_coffset else None
+                coffset += _count_records(bgzf, coffset, start, n_ref, counts)
+                blocks.append(counts)
+        else:
+            # systematic sample, evenly spaced offsets from a random start, so
+            # that runs of similar records (e.g. the unmapped reads at the end
+            # of a sorted file) are sampled in proportion to their size
+            step = data_size / float(sample_blocks)
+            start = random.Random(seed).random()
+            for k in range(sample_blocks):
+                offset = first_coffset + int((start + k) * step)
+                coffset = bgzf.find_block(offset)
+                counts = _BlockCounts(0.0)
+                block_size = _count_records(bgzf, coffset, known_starts.get(coffset), n_ref,
+                                            counts)
+                # picked with probability proportional to block_size
+                counts.weight = 1.0 / block_size
+                blocks.append(counts)
+
+    if census:
+        # the blocks were split at arbitrary records, the counts are exact
+        records = sum(b.records for b in blocks)
+        primary = sum(b.primary for b in blocks)
+        rate = sum(b.primary_mapped for b in blocks) / float(primary) if primary else 0.0
+        rate_ci = (rate, rate)
+        proper = sum(b.proper for b in blocks)
+        proper_ci = (proper, proper)
+        records_ci = (records, records)
+    elif bai is not None and bai.has_counts:
+        # the index counts mapped and unmapped records exactly, only the
+        # share of primary records among the mapped ones is estimated. This
+        # keeps the estimate sound when the unmapped records are all in a few
+        # blocks at the end of the file.
+        mapped = sum(ref.mapped for ref in bai.references)
+        unmapped = sum(ref.unmapped for ref in bai.references) + (bai.no_coordinate or 0)
+        records = mapped + unmapped
+        records_ci = (records, records)
+
+        def rate_of(primary_share):
+            primary_mapped = primary_share * mapped
+            return primary_mapped / (primary_mapped + unmapped) if primary_mapped else 0.0
+
+        primary_share, primary_share_ci = _ratio(blocks, 'primary_mapped', 'mapped', z)
+        rate = rate_of(primary_share)
+        rate_ci = (rate_of(primary_share_ci[0]), rate_of(primary_share_ci[1]))
+        proper_share, proper_share_ci = _ratio(blocks, 'proper', 'mapped', z)
+        proper = proper_share * mapped
+        proper_ci = (proper_share_ci[0] * mapped, proper_share_ci[1] * mapped)
+    else:
+        rate, rate_ci = _ratio(blocks, 'primary_mapped', 'primary', z)
+        proper_share, proper_share_ci = _ratio(blocks, 'proper', 'records', z)
+        # Horvitz-Thompson estimate of the number of records
+        per_draw = [b.records * b.weight * data_size for b in blocks]
+        records = sum(per_draw) / len(per_draw)
+        spread = math.sqrt(sum((x - records) ** 2 for x in per_draw) /
+                           (len(per_draw) - 1) / len(per_draw))
+        records_ci = (max(records - z * spread, 0), records + z * spread)
+        proper = proper_share * records
+        proper_ci = (proper_share_ci[0] * records_ci[0], proper_share_ci[1] * records_ci[1])
+
+    return {
+        'alignment_rate': round(rate * 100, 3),
+        'alignment_rate_ci': [round(rate_ci[0] * 100, 3), round(rate_ci[1] * 100, 3)],
+        'properly_paired': int(round(proper)),
+        'properly_paired_ci': [int(math.floor(proper_ci[0])), int(math.ceil(proper_ci[1]))],
+        'estimated_records': int(round(records)),
+        'estimated_records_ci': [int(math.floor(records_ci[0])), int(math.ceil(records_ci[1]))],
+        'sampled_blocks': len(blocks),
+        'sampled_records': sum(b.records for b in blocks),
+        'exact': census,
+        'used_index': bai is not None,
+        'confidence': confidence
+    }
@@ -0,0 +1,151 @@
+import contextvars
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+'''
+Per-stage timing and resource use of a method call.
+
+A StageTimer is current while one of its stages is open. Code running in a
+stage, e.g. SamTools, records its external processes on the current timer
+with track_process() without the timer being passed down. Stages may run
+concurrently in threads started with contextvars.copy_context(), each thread
+recording its processes on the stage it opened.
+'''
+
+_current_timer = contextvars.ContextVar('stage_timer', default=None)
+# the timer and record of the innermost stage open in this context
+_current_stage = contextvars.ContextVar('stage_record', default=(None, None))
+
+
+def current_timer():
+    """
+    Returns the StageTimer of the running call, or None
+    """
+    return _current_timer.get()
+
+
+def _usage_snapshot():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'wall': time.time(),
+            'cpu': time.thread_time(),
+            'process_cpu': time.process_time(),
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'child_cpu': children.ru_utime + children.ru_stime,
+            'child_max_rss': children.ru_maxrss}
+
+
+def _peak_rss(start, end):
+    """
+    RUSAGE_CHILDREN only keeps the largest RSS of any child waited for so far,
+    so a peak is only known if it was raised between the two snapshots.
+    """
+    if end['child_max_rss'] > start['child_max_rss']:
+        return end['child_max_rss']
+    return None
+
+
+@contextmanager
+def track_process(name):
+    """
+    Records the wall time, CPU time and peak RSS of the external processes run
+    in the with block on the current timer, if there is one.
+    The process must have been waited for when the block exits.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    start = _usage_snapshot()
+    try:
+        yield
+    finally:
+        timer.add_process(name, start, _usage_snapshot())
+
+
+class StageTimer:
+    """
+    Records the wall time and CPU time of the named stages of a method call,
+    and the CPU time and peak RSS of the child processes run in each stage.
+    Each finished stage is logged as a JSON line.
+
+    cpu_time is the CPU time of the thread that ran the stage, so concurrent
+    stages each get their own, while process_cpu_time is that of the whole
+    process during the stage, including the threads the stage runs tasks in
+    and any concurrent stages. peak_rss_kb is the peak RSS of this process
+    so far when the stage ends.
+
+    Usage:
+        timer = StageTimer('upload_alignment', logger)
+        with timer.stage('validate'):
+            ...
+        timings = timer.report()
+
+    CPU time and peak RSS of child processes come from
+    resource.getrusage(RUSAGE_CHILDREN), which only covers processes that
+    have been waited for. When processes run concurrently their usage is
+    attributed to whichever stage or process finishes first.
+    """
+
+    def __init__(self, method, logger=None):
+        self.method = method
+        self.logger = logger
+        self._stages = []
+        self._open_stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the with block as the stage name
+        """
+        record = {'stage': name, 'processes': []}
+        self._open_stages.append(record)
+        token = _current_timer.set(self)
+        stage_token = _current_stage.set((self, record))
+        start = _usage_snapshot()
+        try:
+            yield record
+        finally:
+            end = _usage_snapshot()
+            _current_stage.reset(stage_token)
+            _current_timer.reset(token)
+            self._open_stages.remove(record)
+            process_cpu_time = end['process_cpu'] - start['process_cpu']
+            record.update({'wall_time': round(end['wall'] - start['wall'], 6),
+                           'cpu_time': round(end['cpu'] - start['cpu'], 6),
+                           'process_cpu_time': round(process_cpu_time, 6),
+                           'peak_rss_kb': end['max_rss'],
+                           'child_cpu_time': round(end['child_cpu'] - start['child_cpu'], 6),
+                           'child_peak_rss_kb': _peak_rss(start, end)})
+            self._stages.append(record)
+            self._log('stage_timing', dict(record, processes=len(record['processes'])))
+
+    def add_process(self, name, start, end):
+        """
+        Adds an external process to the innermost stage open in the calling
+        context, or else to the innermost open stage
+        """
+        record = {'name': name,
+                  'wall_time': round(end['wall'] - start['wall'], 6),
+                  'cpu_time': round(end['child_cpu'] - start['child_cpu'], 6),
+                  'peak_rss_kb': _peak_rss(start, end)}
+        timer, stage_record = _current_stage.get()
+        if timer is not self:
+            stage_record = self._open_stages[-1] if self._open_stages else None
+        if stage_record is not None:
+            stage_record['processes'].append(record)
+        stage = stage_record['stage'] if stage_record is not None else None
+        self._log('process_timing', dict(record, stage=stage))
+
+    def report(self):
+        """
+        Returns the finished stages in the order they finished
+        """
+        return list(self._stages)
+
+    def _log(self, record_type, record):
+        if self.logger is None:
+            return
+        self.logger.info(json.dumps(dict(record, method=self.method, type=record_type),
+                                    sort_keys=True))
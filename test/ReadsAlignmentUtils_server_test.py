@@ -13,9 +13,13 @@ from os import environ
 from pprint import pprint  # noqa: F401
 from zipfile import ZipFile
 
+import numpy as np
+import pyarrow.parquet as pq
+import pysam
 import requests
 
 from ReadsAlignmentUtils.authclient import KBaseAuth as _KBaseAuth
+from ReadsAlignmentUtils.core.coverage import CoverageTiles
 from ReadsAlignmentUtils.ReadsAlignmentUtilsImpl import ReadsAlignmentUtils
 from ReadsAlignmentUtils.ReadsAlignmentUtilsServer import MethodContext
 from installed_clients.AbstractHandleClient import AbstractHandle as HandleService
@@ -418,6 +422,257 @@ class ReadsAlignmentUtilsTest(unittest.TestCase):
                                         self.test_sam_file,
                                         self.test_bai_file)
 
+    def test_download_report_timings(self):
+
+        params = {'source_ref': self.getWsName() + '/test_bam',
+                  'downloadBAI': 'True',
+                  'report_timings': 1}
+
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+
+        stages = [t['stage'] for t in ret['timings']]
+        self.assertEqual(stages, ['resolve_params', 'download', 'index'])
+        index = ret['timings'][2]
+        self.assertEqual([p['name'] for p in index['processes']], ['samtools index'])
+        self.assertGreaterEqual(index['wall_time'], 0)
+
+    def test_download_contig_stats(self):
+
+        params = {'source_ref': self.getWsName() + '/test_bam'}
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+        # no index, no counts
+        self.assertNotIn('contig_stats', ret)
+
+        params['downloadBAI'] = 'True'
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+        self.assertTrue(ret['stats_match_index'])
+        self.assertEqual(ret['contig_stats'][-1],
+                         {'contig': '*', 'length': 0, 'mapped': 0, 'unmapped': 285})
+        self.assertEqual(sum(c['mapped'] for c in ret['contig_stats']), 19213)
+
+    def test_get_index_stats_stale_index(self):
+
+        # an index of another file, with one reference instead of two
+        bam_file = os.path.join(self.scratch, 'stale_index.bam')
+        header = {'HD': {'VN': '1.0'},
+                  'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+        with pysam.AlignmentFile(bam_file, 'wb', header=header):
+            pass
+        shutil.copy(os.path.join('data', 'accepted_hits.bai'),
+                    os.path.join(self.scratch, 'stale_index.bai'))
+
+        stats = {'mapped_reads': 0, 'unmapped_reads': 0}
+        self.assertEqual(self.getImpl()._get_index_stats([bam_file], stats), {})
+
+    def test_download_parquet(self):
+
+        params = {'source_ref': self.getWsName() + '/test_bam',
+                  'downloadParquet': 'True',
+                  'report_timings': 1}
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+        self.assertIn('columnar', [t['stage'] for t in ret['timings']])
+
+        parquet_files = glob.glob(ret['destination_dir'] + '/*.parquet')
+        self.assertEqual(len(parquet_files), 1)
+        table = pq.read_table(parquet_files[0], columns=['flag'])
+        self.assertEqual(table.num_rows, 19213 + 285)
+
+        params['parquet_fields'] = ['flag', 'pos']
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+        table = pq.read_table(glob.glob(ret['destination_dir'] + '/*.parquet')[0])
+        self.assertEqual(table.column_names, ['flag', 'pos'])
+        self.assertEqual(table.num_rows, 19213 + 285)
+
+        params['parquet_fields'] = ['flag', 'seq']
+        with self.assertRaisesRegex(ValueError, 'Unknown parquet_fields: seq'):
+            self.getImpl().download_alignment(self.ctx, params)
+
+    def test_download_concurrent_tasks(self):
+
+        params = {'source_ref': self.getWsName() + '/test_bam',
+                  'downloadBAI': 1,
+                  'downloadSAM': 1,
+                  'report_timings': 1}
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+
+        # the index and sam file are written at the same time, each stage
+        # keeping its own samtools process
+        processes = {t['stage']: [p['name'] for p in t['processes']] for t in ret['timings']}
+        self.assertEqual(processes['index'], ['samtools index'])
+        self.assertEqual(processes['convert'], ['samtools view'])
+        self.assertEqual(len(glob.glob(ret['destination_dir'] + '/*.bai')), 1)
+        self.assertEqual(len(glob.glob(ret['destination_dir'] + '/*.sam')), 1)
+
+    def test_download_split_by_contig(self):
+        import pysam
+
+        params = {'source_ref': self.getWsName() + '/test_bam',
+                  'split_by_contig': 1,
+                  'report_timings': 1}
+        ret = self.getImpl().download_alignment(self.ctx, params)[0]
+        self.assertIn('split', [t['stage'] for t in ret['timings']])
+
+        # the shards hold every record of the bam file once
+        records = 0
+        contigs = []
+        for shard in ret['contig_shards']:
+            self.assertTrue(os.path.isfile(shard['bai_file']))
+            with pysam.AlignmentFile(shard['bam_file'], 'rb') as bam:
+                records += sum(1 for _ in bam.fetch(until_eof=True))
+            contigs.extend(shard['contigs'])
+        self.assertEqual(records, 19213 + 285)
+        self.assertEqual(len(contigs), len(set(contigs)))
+        self.assertEqual(sum(entry['mapped'] + entry['unmapped'] for entry in ret['contig_stats']),
+                         records)
+
+    def test_upload_extended_stats(self):
+
+        params = dictmerge({'destination_ref': self.getWsName() + '/test_extended_stats',
+                            'file_path': self.test_bam_file['file_path'],
+                            'extended_stats': 1
+                            }, self.more_upload_params)
+        ret = self.getImpl().upload_alignment(self.ctx, params)[0]
+        self.assertEqual(set(ret['qc_stats']), {'mean_mapq', 'median_insert_size', 'mean_nm',
+                                                'soft_clip_fraction'})
+        self.assertGreater(ret['qc_stats']['mean_mapq'], 0)
+
+        ret = self.getImpl().download_alignment(
+            self.ctx, {'source_ref': ret['obj_ref'], 'downloadCompanions': 1})[0]
+        qc_stats_file = ret['companion_files']['qc_stats']
+        self.assertTrue(qc_stats_file.endswith('.qc_stats.npz'))
+        self.assertEqual(os.path.dirname(qc_stats_file), ret['destination_dir'])
+
+        with np.load(qc_stats_file) as qc_stats:
+            self.assertEqual(qc_stats['mapq'].size, 256)
+            self.assertEqual(int(qc_stats['mapq'].sum()), 14969)
+
+    def test_upload_coverage_tiles(self):
+
+        params = dictmerge({'destination_ref': self.getWsName() + '/test_coverage_tiles',
+                            'file_path': self.test_bam_file['file_path'],
+                            'coverage_tiles': 1,
+                            'report_timings': 1
+                            }, self.more_upload_params)
+        ret = self.getImpl().upload_alignment(self.ctx, params)[0]
+        self.assertIn('companions', [t['stage'] for t in ret['timings']])
+        self.assertNotIn('qc_stats', ret)
+
+        ret = self.getImpl().download_alignment(
+            self.ctx, {'source_ref': ret['obj_ref'], 'downloadCompanions': 1})[0]
+        self.assertEqual(list(ret['companion_files']), ['coverage'])
+
+        tiles = CoverageTiles.load(ret['companion_files']['coverage'])
+        contig = tiles.names[0]
+        bin_size, depth = tiles.depth(contig, 0, tiles.lengths[0], max_bins=1000)
+        self.assertIn(bin_size, (1, 1000, 10000, 100000))
+        self.assertGreater(depth.max(), 0)
+
+    def test_upload_coverage_tiles_sam(self):
+        tiles = {}
+        for name, test_file in (('bam', self.test_bam_file), ('sam', self.test_sam_file)):
+            params = dictmerge({'destination_ref': self.getWsName() + '/test_coverage_' + name,
+                                'file_path': test_file['file_path'],
+                                'coverage_tiles': 1
+                                }, self.more_upload_params)
+            ret = self.getImpl().upload_alignment(self.ctx, params)[0]
+            ret = self.getImpl().download_alignment(
+                self.ctx, {'source_ref': ret['obj_ref'], 'downloadCompanions': 1})[0]
+            tiles[name] = CoverageTiles.load(ret['companion_files']['coverage'])
+
+        # the coverage of a sam file is read from the sorted bam it is converted to
+        self.assertEqual(tiles['sam'].names, tiles['bam'].names)
+        for contig, length in zip(tiles['bam'].names, tiles['bam'].lengths):
+            np.testing.assert_array_equal(tiles['sam'].depth(contig, 0, length)[1],
+                                          tiles['bam'].depth(contig, 0, length)[1])
+
+    def test_upload_count_features(self):
+
+        params = dictmerge(self.more_upload_params,
+                           {'destination_ref': self.getWsName() + '/test_count_features',
+                            'file_path': self.test_bam_file['file_path'],
+                            'assembly_or_genome_ref': self.getWsName() + '/test_genome',
+                            'count_features': 1})
+        ret = self.getImpl().upload_alignment(self.ctx, params)[0]
+        self.assertEqual(set(ret['feature_counts']), {'counted_reads', 'no_feature', 'ambiguous'})
+        obj_ref = ret['obj_ref']
+
+        ret = self.getImpl().download_alignment(
+            self.ctx, {'source_ref': obj_ref, 'downloadCompanions': 1})[0]
+        with open(ret['companion_files']['feature_counts']) as counts_file:
+            lines = counts_file.read().splitlines()
+        self.assertEqual(lines[-2].split('\t')[0], '__no_feature')
+        self.assertEqual(lines[-1].split('\t')[0], '__ambiguous')
+
+        ret = self.getImpl().count_features(self.ctx, {'source_ref': obj_ref,
+                                                       'report_timings': 1})[0]
+        self.assertEqual(len(ret['counts']), len(lines) - 2)
+        self.assertEqual(ret['counted_reads'], sum(ret['counts'].values()) +
+                         ret['no_feature'] + ret['ambiguous'])
+        self.assertEqual([t['stage'] for t in ret['timings']],
+                         ['resolve_params', 'download_alignment', 'count'])
+
+    def test_upload_count_features_fail_assembly(self):
+
+        params = dictmerge({'destination_ref': self.getWsName() + '/test_count_features',
+                            'file_path': self.test_bam_file['file_path'],
+                            'count_features': 1
+                            }, self.more_upload_params)
+        with self.assertRaisesRegex(ValueError, 'KBaseGenomes.Genome to count features'):
+            self.getImpl().upload_alignment(self.ctx, params)
+
+    def test_merge_alignment_stats(self):
+
+        refs = []
+        for name in ('test_mergeable_1', 'test_mergeable_2'):
+            params = dictmerge({'destination_ref': self.getWsName() + '/' + name,
+                                'file_path': self.test_bam_file['file_path'],
+                                'mergeable_stats': 1
+                                }, self.more_upload_params)
+            refs.append(self.getImpl().upload_alignment(self.ctx, params)[0]['obj_ref'])
+
+        single = self.getImpl().merge_alignment_stats(self.ctx, {'alignment_refs': refs[:1]})[0]
+        stats = self.getImpl().download_alignment(self.ctx, {'source_ref': refs[0]})[0]['stats']
+        self.assertEqual(single['stats'], stats)
+        self.assertEqual(single['stats_mode'], 'exact')
+
+        # the same reads twice: the distinct read counts stay, the record counts double
+        merged = self.getImpl().merge_alignment_stats(self.ctx, {'alignment_refs': refs,
+                                                                 'report_timings': 1})[0]
+        self.assertEqual(merged['stats']['mapped_reads'], stats['mapped_reads'])
+        self.assertEqual(merged['stats']['unmapped_reads'], 2 * stats['unmapped_reads'])
+        self.assertEqual(merged['stats']['properly_paired'], 2 * stats['properly_paired'])
+        self.assertEqual([t['stage'] for t in merged['timings']],
+                         ['resolve_params', 'download', 'merge'])
+
+        with self.assertRaisesRegex(ValueError, 'was not uploaded with mergeable_stats'):
+            self.getImpl().merge_alignment_stats(
+                self.ctx, {'alignment_refs': [refs[0], self.getWsName() + '/test_bam']})
+
+    def test_upload_file_paths(self):
+
+        params = dictmerge({'destination_ref': self.getWsName() + '/test_file_paths',
+                            'file_paths': [self.test_bam_file['file_path'],
+                                           self.test_sam_file['file_path']],
+                            'mergeable_stats': 1,
+                            'report_timings': 1
+                            }, self.more_upload_params)
+        scratch_dirs = set(os.listdir(self.scratch))
+        ret = self.getImpl().upload_alignment(self.ctx, params)[0]
+        self.assertEqual([t['stage'] for t in ret['timings']][:4],
+                         ['resolve_params', 'sort', 'merge', 'index'])
+        # the merged file and the companion files are removed once uploaded
+        self.assertEqual([d for d in set(os.listdir(self.scratch)) - scratch_dirs
+                          if d.startswith(('merge_', 'companions_'))], [])
+
+        # the stats of the parts are combined as those of the merged file
+        ret = self.getImpl().download_alignment(self.ctx, {'source_ref': ret['obj_ref']})[0]
+        bam_file_path = glob.glob(ret['destination_dir'] + '/*.bam')[0]
+        self.assertEqual(ret['stats'], self.getImpl()._get_aligner_stats(bam_file_path))
+
+        with self.assertRaisesRegex(ValueError, 'Only one of file_path and file_paths'):
+            self.getImpl().upload_alignment(
+                self.ctx, dictmerge({'file_path': self.test_bam_file['file_path']}, params))
+
     def test_get_aligner_stats(self):
 
         # test_bam_file = os.path.join("data", "accepted_hits.bam")
@@ -432,6 +687,44 @@ class ReadsAlignmentUtilsTest(unittest.TestCase):
         self.assertEqual(stats_data.get('singletons'), 0)
         self.assertEqual(stats_data.get('multiple_alignments'), 3519)
 
+    def test_get_aligner_stats_approximate(self):
+        impl = self.getImpl()
+        stats_data, error_bounds = impl._get_aligner_stats_and_error_bounds(
+            self.test_bam_file['file_path'], impl.STATS_MODE_APPROXIMATE)
+
+        self.assertEqual(stats_data.get('unmapped_reads'), 285)
+        self.assertEqual(error_bounds.get('unmapped_reads'), 0)
+        for key, exact in (('total_reads', 15254), ('mapped_reads', 14969),
+                           ('multiple_alignments', 3519)):
+            self.assertGreater(error_bounds[key], 0)
+            self.assertLessEqual(abs(stats_data[key] - exact), 1.5 * error_bounds[key])
+
+    def test_estimate_alignment_stats(self):
+        result = self.getImpl().estimate_alignment_stats(
+            self.ctx, {'file_path': self.test_bam_file['file_path']})[0]
+
+        # the test file is small enough to be read in full
+        self.assertTrue(result['exact'])
+        self.assertEqual(result['alignment_rate'], round(14969 * 100.0 / 15254, 3))
+        self.assertEqual(result['properly_paired'], 0)
+
+        result = self.getImpl().estimate_alignment_stats(
+            self.ctx, {'file_path': self.test_bam_file['file_path'],
+                       'sample_blocks': 8, 'seed': 1})[0]
+        self.assertFalse(result['exact'])
+        self.assertEqual(result['sampled_blocks'], 8)
+        low, high = result['alignment_rate_ci']
+        self.assertLessEqual(low, result['alignment_rate'])
+        self.assertLessEqual(result['alignment_rate'], high)
+
+    def test_estimate_alignment_stats_fail_no_bam(self):
+        with self.assertRaises(ValueError) as context:
+            self.getImpl().estimate_alignment_stats(
+                self.ctx, {'file_path': self.test_sam_file['file_path']})
+        self.assertEqual(str(context.exception),
+                         'Stats can only be estimated for bam files: ' +
+                         self.test_sam_file['file_path'])
+
     # Following test uses object refs from a narrative to test backward compatibility to download
     # already created Alignment objects in RNASeq. comment the next line to run the test
     @unittest.skip("skipped test_download_legacy_alignment_success")
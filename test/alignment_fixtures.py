@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import random
+
+'''
+Random alignments shared by the tests of the stats and index modules.
+'''
+
+REFERENCES = [('chr{0}'.format(i), 1000000) for i in range(3)]
+
+
+def random_paired_alignments(reads, seed=1):
+    """
+    Returns the alignments of a paired end library on three references, with
+    unplaced unmapped reads, and the expected alignment_rate and properly_paired
+    """
+    rng = random.Random(seed)
+    alignments = []
+    primary_mapped = primary_unmapped = proper = 0
+    for i in range(reads):
+        is_unmapped = rng.random() < 0.15
+        ref = rng.randrange(3)
+        pos = rng.randrange(999000)
+        for mate in (0x40, 0x80):
+            alignment = {'query_name': 'read{0}'.format(i), 'query_sequence': 'ACGT' * 25}
+            if is_unmapped:
+                alignment.update(flag=0x1 | mate | 0x4 | 0x8, reference_id=-1,
+                                 reference_start=-1, next_reference_id=-1,
+                                 next_reference_start=-1, mapping_quality=0)
+                alignments.append(alignment)
+                primary_unmapped += 1
+                continue
+            flag = 0x1 | 0x2 | mate
+            alignment.update(flag=flag, reference_id=ref, reference_start=pos + (mate >> 3),
+                             next_reference_id=ref, next_reference_start=pos + (mate >> 3),
+                             mapping_quality=60, cigarstring='100M')
+            alignments.append(alignment)
+            primary_mapped += 1
+            proper += 1
+            if rng.random() < 0.2:
+                secondary_ref = rng.randrange(3)
+                secondary_pos = rng.randrange(999000)
+                alignments.append(dict(alignment, flag=flag | 0x100, reference_id=secondary_ref,
+                                       reference_start=secondary_pos,
+                                       next_reference_id=secondary_ref,
+                                       next_reference_start=secondary_pos))
+    primary = primary_mapped + primary_unmapped
+    return alignments, round(100.0 * primary_mapped / primary, 3), proper
+
+
+def random_records(count, paired, seed=1):
+    """
+    Returns (flag, read name) of count random records, a third as many reads
+    """
+    rng = random.Random(seed)
+    records = []
+    for _ in range(count):
+        read_id = 'read{0}'.format(rng.randint(0, count // 3))
+        flag = rng.choice((0x4, 0x100, 0, 0x10))
+        if paired:
+            flag |= 0x1 | rng.choice((0x40, 0x80)) | rng.choice((0, 0x2))
+        records.append((flag, read_id))
+    return records
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ReadsAlignmentUtils.core import alignment_stats
+from ReadsAlignmentUtils.core.alignment_stats import (AlignmentStatsAccumulator,
+                                                      ExactReadIdSets, read_id_hash)
+from ReadsAlignmentUtils.core.hyperloglog import HyperLogLogSets
+
+from alignment_fixtures import random_records
+
+
+def reference_stats(records):
+    """
+    The stats as computed by the original list and set based implementation
+    """
+    unmapped = secondary = properly_paired = 0
+    left, right, single = [], [], []
+    secondary_left, secondary_right, secondary_single = [], [], []
+    paired = False
+    for flag, read_id in records:
+        if flag & 0x1:
+            paired = True
+        if paired:
+            for mate_flag, mapped, secondary_ids in ((0x40, left, secondary_left),
+                                                     (0x80, right, secondary_right)):
+                if flag & mate_flag:
+                    if flag & 0x4:
+                        unmapped += 1
+                    else:
+                        mapped.append(read_id)
+                        if flag & 0x100:
+                            secondary += 1
+                            secondary_ids.append(read_id)
+                        elif flag & 0x2:
+                            properly_paired += 1
+        elif flag & 0x4:
+            unmapped += 1
+        else:
+            single.append(read_id)
+            if flag & 0x100:
+                secondary += 1
+                secondary_single.append(read_id)
+    mapped_reads = len(set(left)) + len(set(right)) + len(set(single))
+    total_reads = mapped_reads + unmapped
+    return {
+        'alignment_rate': round(float(mapped_reads) / total_reads * 100, 3) if total_reads else 0,
+        'mapped_reads': mapped_reads,
+        'multiple_alignments': (len(set(secondary_left)) + len(set(secondary_right)) +
+                                len(set(secondary_single))),
+        'singletons': len(set(left)) + len(set(right)) - 2 * len(set(left) & set(right)),
+        'total_reads': total_reads,
+        'properly_paired': properly_paired,
+        'unmapped_reads': unmapped
+    }
+
+
+class AlignmentStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def stats(self, records, memory_mb=None):
+        with ExactReadIdSets(memory_mb, self.spill_dir) as id_sets:
+            accumulator = AlignmentStatsAccumulator(id_sets)
+            for flag, read_id in records:
+                accumulator.add(flag, read_id)
+            return accumulator.result(), id_sets.spills
+
+    def chunked_stats(self, records, chunk_size, memory_mb=None):
+        flags = np.array([flag for flag, _ in records], dtype=np.uint16)
+        hashes = np.array([read_id_hash(read_id) for _, read_id in records], dtype=np.uint64)
+        with ExactReadIdSets(memory_mb, self.spill_dir) as id_sets:
+            accumulator = AlignmentStatsAccumulator(id_sets)
+            for start in range(0, len(records), chunk_size):
+                accumulator.add_chunk(flags[start:start + chunk_size],
+                                      hashes[start:start + chunk_size])
+            return accumulator.result(), id_sets.spills
+
+    def test_chunks_match_records(self):
+        for paired in (False, True):
+            records = random_records(20000, paired, seed=4)
+            expected, _ = self.stats(records)
+            for chunk_size in (1, 999, 1 << 16):
+                self.assertEqual(self.chunked_stats(records, chunk_size)[0], expected)
+            spilled, spills = self.chunked_stats(records, 500, memory_mb=0.004)
+            self.assertGreater(spills, 0)
+            self.assertEqual(spilled, expected)
+
+        # pairing starts within a chunk, and records flagged as both mates
+        records = [(0x0, 'single'), (0x100, 'single'), (0x1 | 0x2 | 0x40 | 0x80, 'both'),
+                   (0x4, 'unmapped'), (0x1 | 0x4 | 0x40 | 0x80, 'both_unmapped')]
+        for chunk_size in (1, 2, 5):
+            self.assertEqual(self.chunked_stats(records, chunk_size)[0], reference_stats(records))
+
+    def test_merge_saved(self):
+        records = random_records(20000, True, seed=5)
+        expected, _ = self.stats(records)
+        paths = []
+        for i, part in enumerate((records[:7000], records[7000:])):
+            with ExactReadIdSets(0.004, self.spill_dir) as id_sets:
+                accumulator = AlignmentStatsAccumulator(id_sets)
+                for flag, read_id in part:
+                    accumulator.add(flag, read_id)
+                paths.append(accumulator.save(os.path.join(self.spill_dir,
+                                                           'part{0}.npz'.format(i))))
+                self.assertGreater(id_sets.spills, 0)
+        self.assertEqual(AlignmentStatsAccumulator.saved_mode(paths[0]), 'exact')
+        # the spilled runs are saved as they are, one array each
+        with np.load(paths[0]) as saved:
+            self.assertGreater(len([key for key in saved.files
+                                    if key.startswith('hashes_mapped_left_')]), 1)
+        original = alignment_stats.RUN_BLOCK_SIZE
+        alignment_stats.RUN_BLOCK_SIZE = 7
+        try:
+            with ExactReadIdSets(0.004, self.spill_dir) as id_sets:
+                merged = AlignmentStatsAccumulator(id_sets)
+                for path in paths:
+                    merged.merge_saved(path)
+                self.assertEqual(merged.result(), expected)
+                self.assertEqual(merged.total_alignments, len(records))
+        finally:
+            alignment_stats.RUN_BLOCK_SIZE = original
+
+        # sets without any hashes
+        with ExactReadIdSets() as id_sets:
+            empty_path = AlignmentStatsAccumulator(id_sets).save(
+                os.path.join(self.spill_dir, 'empty.npz'))
+            merged = AlignmentStatsAccumulator(id_sets)
+            merged.merge_saved(empty_path)
+            self.assertEqual(merged.result()['total_reads'], 0)
+
+        # exact parts merge into sketches, which can't merge into exact sets
+        sketches = AlignmentStatsAccumulator(HyperLogLogSets())
+        for flag, read_id in records[:7000]:
+            sketches.add(flag, read_id)
+        sketches_path = sketches.save(os.path.join(self.spill_dir, 'sketches.npz'))
+        self.assertEqual(AlignmentStatsAccumulator.saved_mode(sketches_path), 'approximate')
+        sketches.merge_saved(paths[1])
+        approximate = AlignmentStatsAccumulator(HyperLogLogSets())
+        for flag, read_id in records:
+            approximate.add(flag, read_id)
+        for name, sketch in approximate.sets.items():
+            self.assertEqual(sketches.sets[name].registers, sketch.registers)
+        with ExactReadIdSets() as id_sets:
+            with self.assertRaises(ValueError):
+                AlignmentStatsAccumulator(id_sets).merge_saved(sketches_path)
+
+    def test_read_id_hash(self):
+        self.assertEqual(read_id_hash(b''), 0xcbf29ce484222325)
+        self.assertEqual(read_id_hash('a'), 0xaf63dc4c8601ec8c)
+        self.assertEqual(read_id_hash('foobar'), 0x85944171f73967e8)
+
+    def test_matches_reference(self):
+        for paired in (False, True):
+            records = random_records(5000, paired)
+            result, spills = self.stats(records)
+            self.assertEqual(spills, 0)
+            self.assertEqual(result, reference_stats(records))
+
+    def test_spill_matches_in_memory(self):
+        for paired in (False, True):
+            records = random_records(20000, paired, seed=2)
+            in_memory, _ = self.stats(records)
+            # a few KB forces many spilled runs
+            spilled, spills = self.stats(records, memory_mb=0.004)
+            self.assertGreater(spills, 0)
+            self.assertEqual(spilled, in_memory)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_merge_blocks(self):
+        original = alignment_stats.RUN_BLOCK_SIZE
+        alignment_stats.RUN_BLOCK_SIZE = 7
+        try:
+            records = random_records(3000, True, seed=3)
+            in_memory, _ = self.stats(records)
+            spilled, spills = self.stats(records, memory_mb=0.002)
+        finally:
+            alignment_stats.RUN_BLOCK_SIZE = original
+        self.assertGreater(spills, 0)
+        self.assertEqual(spilled, in_memory)
+
+    def test_sticky_paired(self):
+        records = [(0x0, 'single'), (0x1 | 0x2 | 0x40, 'pair'), (0x1 | 0x2 | 0x80, 'pair'),
+                   (0x0, 'neither_mate')]
+        result, _ = self.stats(records)
+        self.assertEqual(result, reference_stats(records))
+        self.assertEqual(result['mapped_reads'], 3)
+        self.assertEqual(result['properly_paired'], 2)
+
+    def test_empty(self):
+        result, _ = self.stats([])
+        self.assertEqual(result['total_reads'], 0)
+        self.assertEqual(result['alignment_rate'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ReadsAlignmentUtils import ReadsAlignmentUtilsServer
+from ReadsAlignmentUtils.ReadsAlignmentUtilsServer import process_async_cli
+
+
+def status_request(request_id):
+    return {'method': 'ReadsAlignmentUtils.status', 'params': [], 'version': '1.1',
+            'id': request_id}
+
+
+class AsyncCliTest(unittest.TestCase):
+    """
+    Runs requests through the async CLI entry point, as the job runner does
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.tmp, 'input.json')
+        self.output_path = os.path.join(self.tmp, 'output.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def run_cli(self, requests):
+        """
+        Returns the exit code and the response of the requests
+        """
+        with open(self.input_path, 'w') as input_file:
+            json.dump(requests, input_file)
+        exit_code = process_async_cli(self.input_path, self.output_path, None)
+        with open(self.output_path) as output_file:
+            return exit_code, json.load(output_file)
+
+    def test_single_request(self):
+        exit_code, resp = self.run_cli(status_request('single'))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(resp['id'], 'single')
+        self.assertEqual(resp['result'][0]['state'], 'OK')
+
+    def test_batch(self):
+        exit_code, resp = self.run_cli([status_request(str(i)) for i in range(3)])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual([r['id'] for r in resp], ['0', '1', '2'])
+        self.assertTrue(all(r['result'][0]['state'] == 'OK' for r in resp))
+
+    def test_batch_with_malformed_requests(self):
+        requests = [status_request('first'),
+                    'not a request',
+                    {'method': 'status', 'params': [], 'id': 'no_module'},
+                    {'method': 'ReadsAlignmentUtils.status', 'id': 'no_params'},
+                    {'params': [], 'id': 'no_method'},
+                    status_request('last')]
+        exit_code, resp = self.run_cli(requests)
+
+        self.assertEqual(exit_code, 500)
+        self.assertEqual([r['id'] for r in resp],
+                         ['first', None, 'no_module', 'no_params', 'no_method', 'last'])
+        # a malformed request only fails its own response
+        for r in (resp[0], resp[-1]):
+            self.assertNotIn('error', r)
+            self.assertEqual(r['result'][0]['state'], 'OK')
+        for r in resp[1:-1]:
+            self.assertNotIn('result', r)
+            self.assertEqual(r['error']['code'], -32600)
+
+    def test_batch_with_unknown_method(self):
+        exit_code, resp = self.run_cli([{'method': 'ReadsAlignmentUtils.nope', 'params': [],
+                                         'id': 'unknown'},
+                                        status_request('known')])
+        self.assertEqual(exit_code, 500)
+        self.assertEqual(resp[0]['id'], 'unknown')
+        self.assertIn('error', resp[0])
+        self.assertEqual(resp[1]['result'][0]['state'], 'OK')
+
+    def test_cli_exit_code(self):
+        server = ReadsAlignmentUtilsServer.__file__
+        with open(self.input_path, 'w') as input_file:
+            json.dump([status_request('good'), 'bad'], input_file)
+        proc = subprocess.run([sys.executable, server, self.input_path, self.output_path],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertNotEqual(proc.returncode, 0, proc.stdout.decode())
+        with open(self.output_path) as output_file:
+            resp = json.load(output_file)
+        self.assertEqual(resp[0]['result'][0]['state'], 'OK')
+        self.assertEqual(resp[1]['error']['code'], -32600)
+
+        with open(self.input_path, 'w') as input_file:
+            json.dump([status_request('good')], input_file)
+        proc = subprocess.run([sys.executable, server, self.input_path, self.output_path],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(proc.returncode, 0, proc.stdout.decode())
+
+
+if __name__ == '__main__':
+    unittest.main()
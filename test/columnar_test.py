@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pyarrow.parquet as pq
+import pysam
+
+from ReadsAlignmentUtils.core.alignment_stats import read_id_hash
+from ReadsAlignmentUtils.core.columnar import CIGAR_OPS, write_parquet
+
+from perf.synthetic_alignments import write_alignments
+
+
+class ColumnarTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.bam = os.path.join(cls.tmp, 'test.bam')
+        rng = random.Random(1)
+        alignments = []
+        for i in range(2500):
+            alignment = {'query_name': 'read{0}'.format(i // 2), 'query_sequence': 'A' * 100}
+            if rng.random() < 0.1:
+                alignment.update(flag=0x4, reference_id=-1, reference_start=-1)
+            else:
+                alignment.update(
+                    flag=rng.choice((0x1 | 0x2 | 0x40, 0x1 | 0x2 | 0x80 | 0x10, 0x100)),
+                    reference_id=rng.randrange(2),
+                    reference_start=rng.randrange(4000),
+                    mapping_quality=rng.randrange(61),
+                    cigarstring=rng.choice(('100M', '20S80M', '40M10D60M')),
+                    template_length=rng.randrange(-500, 500),
+                    tags={'NM': rng.randrange(5), 'XS': 'read{0}'.format(i)})
+            alignments.append(alignment)
+        write_alignments(cls.bam, [('chr1', 100000), ('chr2', 5000)], alignments)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def test_write_parquet(self):
+        parquet_file = os.path.join(self.tmp, 'test.parquet')
+        self.assertEqual(write_parquet(self.bam, parquet_file, batch_size=1000), 2500)
+
+        parquet = pq.ParquetFile(parquet_file)
+        self.assertEqual(parquet.metadata.num_row_groups, 3)
+        references = json.loads(parquet.schema_arrow.metadata[b'references'])
+        self.assertEqual(references, [{'name': 'chr1', 'length': 100000},
+                                      {'name': 'chr2', 'length': 5000}])
+
+        table = parquet.read().to_pydict()
+        with pysam.AlignmentFile(self.bam) as bam:
+            for i, record in enumerate(bam):
+                self.assertEqual(table['qname_hash'][i], read_id_hash(record.query_name))
+                self.assertEqual(table['flag'][i], record.flag)
+                self.assertEqual(table['ref_id'][i], record.reference_id)
+                self.assertEqual(table['pos'][i], record.reference_start)
+                self.assertEqual(table['mapq'][i], record.mapping_quality)
+                self.assertEqual(table['tlen'][i], record.template_length)
+                cigar = ''.join('{0}{1}'.format(op >> 4, CIGAR_OPS[op & 0xf])
+                                for op in table['cigar'][i])
+                self.assertEqual(cigar, record.cigarstring or '')
+                self.assertEqual(dict(table['tags'][i]),
+                                 {tag: str(value) for tag, value in record.get_tags()})
+
+    def test_selected_fields(self):
+        parquet_file = os.path.join(self.tmp, 'flags.parquet')
+        write_parquet(self.bam, parquet_file, fields=['flag', 'pos'])
+        table = pq.read_table(parquet_file)
+        self.assertEqual(table.column_names, ['flag', 'pos'])
+        self.assertEqual(table.num_rows, 2500)
+
+        # the fixed fields of a sam file, and its cigar and tags read alongside
+        sam_file = os.path.join(self.tmp, 'test.sam')
+        pysam.view('-h', '-o', sam_file, self.bam, catch_stdout=False)
+        sam_parquet_file = os.path.join(self.tmp, 'sam.parquet')
+        for fields in (['qname_hash', 'tlen'], ['flag', 'tags', 'cigar']):
+            write_parquet(self.bam, parquet_file, fields=fields, batch_size=700)
+            bam_table = pq.read_table(parquet_file)
+            self.assertEqual(write_parquet(sam_file, sam_parquet_file, fields=fields,
+                                           batch_size=700), 2500)
+            sam_table = pq.read_table(sam_parquet_file)
+            self.assertEqual(sam_table.column_names, fields)
+            self.assertEqual(sam_table.to_pydict(), bam_table.to_pydict())
+
+        with self.assertRaisesRegex(ValueError, 'Unknown fields: seq'):
+            write_parquet(self.bam, parquet_file, fields=['flag', 'seq'])
+
+
+if __name__ == '__main__':
+    unittest.main()
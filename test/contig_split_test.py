@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from ReadsAlignmentUtils.core.contig_split import plan_shards, shard_file_base, shard_regions
+from ReadsAlignmentUtils.core.index_stats import read_index_stats
+
+from alignment_fixtures import REFERENCES, random_paired_alignments
+from perf.synthetic_alignments import write_alignments
+
+
+def contig_stats(*entries):
+    return [{'contig': contig, 'length': length, 'mapped': mapped, 'unmapped': unmapped}
+            for contig, length, mapped, unmapped in entries]
+
+
+class ContigSplitTest(unittest.TestCase):
+
+    def test_plan_shards(self):
+        stats = contig_stats(('chr1', 1000, 10, 1), ('scaf1', 300, 5, 0), ('chr2', 1500, 0, 2),
+                             ('scaf2', 400, 1, 0), ('scaf3', 400, 1, 0), ('scaf4', 100, 0, 0),
+                             ('scaf5', 50, 3, 0), ('*', 0, 0, 7))
+        self.assertEqual(plan_shards(stats, group_bases=1000),
+                         [['chr1'], ['chr2'], ['scaf1', 'scaf2', 'scaf3'], ['scaf5'], ['*']])
+
+        # without unplaced records and a group of all the references
+        stats[-1]['unmapped'] = 0
+        self.assertEqual(plan_shards(stats, group_bases=10000),
+                         [['chr1', 'scaf1', 'chr2', 'scaf2', 'scaf3', 'scaf5']])
+
+    def test_plan_shards_without_counts(self):
+        stats = [{'contig': 'chr1', 'length': 1000}, {'contig': 'scaf1', 'length': 10},
+                 {'contig': '*', 'length': 0}]
+        self.assertEqual(plan_shards(stats, group_bases=100), [['chr1'], ['scaf1'], ['*']])
+        self.assertEqual(plan_shards([{'contig': '*', 'length': 0, 'mapped': 0, 'unmapped': 0}]),
+                         [])
+
+    def test_plan_shards_empty_contig(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            bam = os.path.join(tmp, 'empty_contig.bam')
+            alignments = [a for a in random_paired_alignments(1000)[0]
+                          if a['reference_id'] != 1]
+            write_alignments(bam, REFERENCES, alignments, sort=True)
+            pysam.index(bam)
+            stats = read_index_stats(bam)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.assertEqual(plan_shards(stats, group_bases=1000000), [['chr0'], ['chr2'], ['*']])
+
+    def test_shard_regions(self):
+        self.assertEqual(shard_regions(['chr1', 'HLA-A*01:01', '*'],
+                                       {'chr1': 1000, 'HLA-A*01:01': 3503}),
+                         ['chr1:1-1000', 'HLA-A*01:01:1-3503', '*'])
+
+    def test_shard_file_base(self):
+        self.assertEqual(shard_file_base('hits', 0, ['chr1']), 'hits.0.chr1')
+        self.assertEqual(shard_file_base('hits', 1, ['HLA-A*01:01']), 'hits.1.HLA-A_01_01')
+        self.assertEqual(shard_file_base('hits', 2, ['scaf1', 'scaf2']), 'hits.2.contigs')
+        self.assertEqual(shard_file_base('hits', 3, ['*']), 'hits.3.unmapped')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pysam
+
+from ReadsAlignmentUtils.core.coverage import (BIN_SIZES, CoverageAccumulator, CoverageTiles,
+                                               binned_depth, depth_runs)
+
+from perf.synthetic_alignments import write_alignments
+
+
+def write_bam(path, records, seed=1):
+    """
+    Writes a coordinate sorted BAM file of records with random CIGARs on two
+    contigs and returns the contig lengths
+    """
+    rng = random.Random(seed)
+    lengths = [250000, 31234]
+    alignments = []
+    for i in range(records):
+        ref = rng.choice((0, 0, 1))
+        # chr1 is only covered in its first half
+        pos = rng.randrange(lengths[ref] // (2 - ref) - 700)
+        alignments.append({
+            'query_name': 'read{0}'.format(i),
+            'flag': rng.choice((0, 0, 0, 0x10, 0x100, 0x400, 0x4)),
+            'reference_id': ref,
+            'reference_start': pos,
+            'mapping_quality': 60,
+            'cigarstring': rng.choice(('100M', '20S80M', '40M10D60M', '30M500N70M', '50M5I45M')),
+            'query_sequence': 'A' * 100})
+    write_alignments(path, zip(('chr1', 'chr2'), lengths), alignments, sort=True)
+    return lengths
+
+
+class CoverageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.bam = os.path.join(cls.tmp, 'sorted.bam')
+        cls.lengths = write_bam(cls.bam, 20000)
+        # the depth of every base, as by samtools depth -a
+        cls.expected = [np.zeros(length, dtype=np.int64) for length in cls.lengths]
+        for line in pysam.depth('-a', cls.bam).splitlines():
+            contig, pos, depth = line.split('\t')
+            cls.expected[int(contig[3:]) - 1][int(pos) - 1] = int(depth)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def compute(self, coordinate_sorted):
+        with pysam.AlignmentFile(self.bam) as bam:
+            coverage = CoverageAccumulator(bam.references, bam.lengths, coordinate_sorted)
+            alignments = list(bam)
+        if not coordinate_sorted:
+            random.Random(3).shuffle(alignments)
+        for alignment in alignments:
+            coverage.add_alignment(alignment)
+        return coverage.save(os.path.join(self.tmp, 'coverage.npz'))
+
+    def check_tiles(self, tiles):
+        self.assertEqual(tiles.names, ['chr1', 'chr2'])
+        self.assertEqual(tiles.lengths, self.lengths)
+        for contig, expected in zip(tiles.names, self.expected):
+            run_starts, depths = tiles.runs(contig)
+            run_ends = np.append(run_starts[1:], len(expected))
+            self.assertEqual(list(np.repeat(depths, run_ends - run_starts)), list(expected))
+            self.assertTrue(np.all(depths[1:] != depths[:-1]))
+            for bin_size in BIN_SIZES:
+                edges = list(range(0, len(expected), bin_size))
+                means = [expected[start:start + bin_size].mean() for start in edges]
+                np.testing.assert_allclose(tiles.bins(contig, bin_size), means, rtol=1e-5)
+
+    def test_sorted(self):
+        self.check_tiles(CoverageTiles.load(self.compute(True)))
+
+    def test_sorted_small_window(self):
+        # flushes the difference buffer every few records
+        with mock.patch('ReadsAlignmentUtils.core.coverage.FLUSH_BASES', 50), \
+                mock.patch('ReadsAlignmentUtils.core.coverage.FLUSH_EVENTS', 8):
+            self.check_tiles(CoverageTiles.load(self.compute(True)))
+        coverage = CoverageAccumulator(['chr1'], [1000], True)
+        coverage.add_blocks(0, [(500, 600)])
+        with self.assertRaises(ValueError):
+            with mock.patch('ReadsAlignmentUtils.core.coverage.FLUSH_BASES', 50):
+                coverage.add_blocks(0, [(700, 800)])
+                coverage.add_blocks(0, [(100, 200)])
+
+    def test_unsorted(self):
+        self.check_tiles(CoverageTiles.load(self.compute(False)))
+        with pysam.AlignmentFile(self.bam) as bam:
+            coverage = CoverageAccumulator(bam.references, bam.lengths, True)
+            coverage.add_blocks(1, [(0, 10)])
+            coverage.add_blocks(0, [(0, 10)])
+            with self.assertRaises(ValueError):
+                coverage.add_blocks(1, [(0, 10)])
+
+    def test_window(self):
+        tiles = CoverageTiles.load(self.compute(True))
+        expected = self.expected[0]
+
+        bin_size, depth = tiles.depth('chr1', 1234, 1834, max_bins=1000)
+        self.assertEqual(bin_size, 1)
+        self.assertEqual(list(depth), list(expected[1234:1834]))
+
+        bin_size, depth = tiles.depth('chr1', 1234, 201234, max_bins=1000)
+        self.assertEqual(bin_size, 1000)
+        self.assertEqual(len(depth), 201)
+        self.assertAlmostEqual(depth[0], expected[1000:2000].mean(), places=4)
+
+        bin_size, depth = tiles.depth('chr1', 0, 250000, max_bins=10)
+        self.assertEqual(bin_size, 100000)
+        self.assertEqual(len(depth), 3)
+
+        with self.assertRaises(ValueError):
+            tiles.depth('chr3', 0, 10)
+
+    def test_empty_contig(self):
+        run_starts, depths = depth_runs(np.zeros(0, dtype=np.int64),
+                                        np.zeros(0, dtype=np.int64), 2500)
+        self.assertEqual((list(run_starts), list(depths)), ([0], [0]))
+        self.assertEqual(list(binned_depth(run_starts, depths, 2500, 1000)), [0, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
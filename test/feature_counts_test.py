@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from ReadsAlignmentUtils.core.feature_counts import (FeatureIndex, count_features, is_counted,
+                                                     merge_feature_counts, waits_for_mate,
+                                                     write_counts)
+from ReadsAlignmentUtils.core.sam_tools import get_tool_queue
+
+from perf.synthetic_alignments import write_alignments
+
+
+def random_features(lengths, count, seed=1):
+    """
+    Returns random genome features, some nested or overlapping, some with two exons
+    """
+    rng = random.Random(seed)
+    features = []
+    for i in range(count):
+        contig = rng.choice(list(lengths))
+        length = rng.randrange(50, 2000)
+        start = rng.randrange(1, lengths[contig] - 2 * length - 500)
+        strand = rng.choice('+-')
+        location = [[contig, start + length - 1 if strand == '-' else start, strand, length]]
+        if rng.random() < 0.2:
+            exon_start = start + length + rng.randrange(10, 500)
+            location.append([contig, exon_start + length - 1 if strand == '-' else exon_start,
+                             strand, length])
+        features.append({'id': 'gene{0}'.format(i), 'location': location})
+    return features
+
+
+def reference_counts(records, features):
+    """
+    Counts with a linear scan over the features for each read, pairs on the
+    union of the features of their mates
+    """
+    intervals = []
+    for feature in features:
+        for contig, start, strand, length in feature['location']:
+            first = start - length + 1 if strand == '-' else start
+            intervals.append((feature['id'], contig, first - 1, first - 1 + length))
+    counts = {feature['id']: 0 for feature in features}
+    no_feature = ambiguous = 0
+    reads = []
+    pairs = {}
+    for flag, contig, blocks, name in records:
+        if not is_counted(flag):
+            continue
+        found = set(feature_id for feature_id, c, start, end in intervals
+                    for block_start, block_end in blocks
+                    if c == contig and start < block_end and block_start < end)
+        if waits_for_mate(flag):
+            if name not in pairs:
+                pairs[name] = set()
+                reads.append(pairs[name])
+            pairs[name] |= found
+        else:
+            reads.append(found)
+    for found in reads:
+        if not found:
+            no_feature += 1
+        elif len(found) > 1:
+            ambiguous += 1
+        else:
+            counts[found.pop()] += 1
+    return counts, no_feature, ambiguous
+
+
+class FeatureCountsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.lengths = {'chr1': 200000, 'chr2': 80000, 'chr3': 30000}
+        cls.features = random_features(cls.lengths, 300)
+        cls.bam = os.path.join(cls.tmp, 'sorted.bam')
+        rng = random.Random(2)
+        alignments = []
+        for i in range(6000):
+            ref = rng.randrange(3)
+            pos = rng.randrange(list(cls.lengths.values())[ref] - 1000)
+            for mate in (0x40, 0x80):
+                alignments.append({
+                    'query_name': 'read{0}'.format(i),
+                    'flag': rng.choice((0x1 | 0x2 | mate, 0x1 | mate | 0x8, 0x1 | mate | 0x100)),
+                    'reference_id': ref,
+                    'reference_start': pos + (mate >> 2),
+                    'mapping_quality': 60,
+                    'cigarstring': rng.choice(('100M', '30M300N70M', '10S90M')),
+                    'query_sequence': 'A' * 100})
+        records = write_alignments(cls.bam, cls.lengths.items(), alignments, sort=True)
+        cls.records = [(record.flag, record.reference_name, record.get_blocks(),
+                        record.query_name) for record in records]
+        cls.unindexed = os.path.join(cls.tmp, 'unindexed.bam')
+        shutil.copy(cls.bam, cls.unindexed)
+        pysam.index(cls.bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def test_counts(self):
+        counts, no_feature, ambiguous = reference_counts(self.records, self.features)
+        self.assertGreater(ambiguous, 0)
+        index = FeatureIndex.from_genome_features(self.features)
+        for bam_path, workers, indexed in ((self.unindexed, 1, False), (self.bam, 3, True)):
+            result = count_features(bam_path, index, workers=workers, indexed=indexed)
+            self.assertEqual(result['counts'], counts)
+            self.assertEqual(result['no_feature'], no_feature)
+            self.assertEqual(result['ambiguous'], ambiguous)
+            self.assertEqual(result['counted_reads'],
+                             sum(counts.values()) + no_feature + ambiguous)
+
+    def test_tool_queue(self):
+        # the workers wait in the tool queue with the samtools processes
+        index = FeatureIndex.from_genome_features(self.features)
+        completed = get_tool_queue().stats()['completed']
+        count_features(self.unindexed, index, workers=3, indexed=False)
+        self.assertEqual(get_tool_queue().stats()['completed'], completed)
+        count_features(self.bam, index, workers=3, indexed=True)
+        stats = get_tool_queue().stats()
+        self.assertEqual(stats['completed'], completed + 1)
+        self.assertEqual(stats['cpu_in_use'], 0)
+
+    def test_pair_on_mate_features(self):
+        references = [('chr1', 10000), ('chr2', 10000)]
+        index = FeatureIndex([('gene1', 'chr1', 5000, 5100), ('gene2', 'chr2', 500, 600),
+                              ('gene3', 'chr1', 8000, 8100)])
+
+        def pair(name, mate1, mate2):
+            # (reference_id, reference_start) of each mate
+            return [{'query_name': name, 'flag': 0x1 | 0x2 | mate, 'reference_id': ref,
+                     'reference_start': pos, 'mapping_quality': 60, 'cigarstring': '100M',
+                     'query_sequence': 'A' * 100}
+                    for mate, (ref, pos) in ((0x40, mate1), (0x80, mate2))]
+
+        alignments = (pair('mate2_only', (0, 100), (0, 5050)) +
+                      pair('mate1_only', (0, 4950), (0, 6000)) +
+                      pair('other_contig', (0, 100), (1, 550)) +
+                      pair('both', (0, 5000), (0, 8000)) +
+                      pair('none', (1, 1000), (1, 2000)))
+        bam = os.path.join(self.tmp, 'pairs.bam')
+        write_alignments(bam, references, alignments, sort=True)
+        unindexed = os.path.join(self.tmp, 'pairs_unindexed.bam')
+        shutil.copy(bam, unindexed)
+        pysam.index(bam)
+        for bam_path, workers, indexed in ((unindexed, 1, False), (bam, 2, True)):
+            result = count_features(bam_path, index, workers=workers, indexed=indexed)
+            self.assertEqual(result, {'counts': {'gene1': 2, 'gene2': 1, 'gene3': 0},
+                                      'no_feature': 1, 'ambiguous': 1, 'counted_reads': 5})
+
+    def test_genome_locations(self):
+        index = FeatureIndex.from_genome_features([
+            {'id': 'plus', 'location': [['chr1', 101, '+', 50]]},
+            {'id': 'minus', 'location': [['chr1', 300, '-', 100]]},
+            {'id': 'no_location'}])
+        self.assertEqual(index.feature_ids, ['plus', 'minus'])
+        self.assertEqual(index.contigs['chr1'][:2], ([100, 200], [150, 300]))
+        self.assertEqual(index.overlapping('chr1', [(149, 201)]), {0, 1})
+        self.assertEqual(index.overlapping('chr1', [(150, 200)]), set())
+        self.assertEqual(index.overlapping('chr1', [(0, 10), (299, 400)]), {1})
+        self.assertEqual(index.overlapping('chr2', [(0, 1000)]), set())
+
+    def test_merge_and_write(self):
+        a = {'counts': {'g1': 1, 'g2': 0}, 'no_feature': 2, 'ambiguous': 1, 'counted_reads': 4}
+        b = {'counts': {'g1': 3, 'g2': 5}, 'no_feature': 0, 'ambiguous': 0, 'counted_reads': 8}
+        merged = merge_feature_counts([a, b])
+        self.assertEqual(merged, {'counts': {'g1': 4, 'g2': 5}, 'no_feature': 2,
+                                  'ambiguous': 1, 'counted_reads': 12})
+        path = write_counts(merged, os.path.join(self.tmp, 'counts.tsv'))
+        with open(path) as counts_file:
+            self.assertEqual(counts_file.read(),
+                             'g1\t4\ng2\t5\n__no_feature\t2\n__ambiguous\t1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+
+import numpy as np
+
+from ReadsAlignmentUtils.core.alignment_stats import (AlignmentStatsAccumulator,
+                                                      ExactReadIdSets, read_id_hash)
+from ReadsAlignmentUtils.core.hyperloglog import HyperLogLog, HyperLogLogSets
+
+from alignment_fixtures import random_records
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def assertWithinError(self, estimate, actual, sketch, sigmas=4):
+        self.assertLessEqual(abs(estimate - actual),
+                             sigmas * sketch.relative_error * actual + 1,
+                             '{0} is too far from {1}'.format(estimate, actual))
+
+    def test_count(self):
+        for n in (10, 1000, 100000):
+            sketch = HyperLogLog()
+            for i in range(n):
+                # every read is added twice, as mates are
+                sketch.add(read_id_hash('read{0}'.format(i)))
+                sketch.add(read_id_hash('read{0}'.format(i)))
+            self.assertWithinError(sketch.count(), n, sketch)
+        self.assertEqual(len(sketch.registers), 4096)
+
+    def test_intersection(self):
+        a = HyperLogLog(precision=14)
+        b = HyperLogLog(precision=14)
+        for i in range(60000):
+            a.add(read_id_hash('read{0}'.format(i)))
+        for i in range(30000, 90000):
+            b.add(read_id_hash('read{0}'.format(i)))
+        self.assertWithinError(a.merge(b).count(), 90000, a)
+        # inclusion-exclusion adds up the errors of three estimates
+        self.assertLessEqual(abs(a.intersection_count(b) - 30000), 0.1 * 30000)
+
+    def test_add_many(self):
+        rng = random.Random(5)
+        # small values and ones just below powers of two check the register ranks
+        hashes = [rng.getrandbits(64) for _ in range(20000)] + \
+                 [0, 1, (1 << 60) - 1, (1 << 52) - 1, (1 << 64) - 1]
+        for precision in (4, 12, 18):
+            one_by_one = HyperLogLog(precision)
+            for h in hashes:
+                one_by_one.add(h)
+            at_once = HyperLogLog(precision)
+            at_once.add_many(np.array(hashes, dtype=np.uint64))
+            self.assertEqual(at_once.registers, one_by_one.registers)
+
+    def test_merge_precision(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(12).merge(HyperLogLog(14))
+        with self.assertRaises(ValueError):
+            HyperLogLog(2)
+
+    def test_approximate_stats(self):
+        records = random_records(60000, True, seed=4)
+        with ExactReadIdSets() as id_sets:
+            exact = AlignmentStatsAccumulator(id_sets)
+            for flag, read_id in records:
+                exact.add(flag, read_id)
+            expected = exact.result()
+            self.assertEqual(set(exact.error_bounds().values()), {0})
+
+        approximate = AlignmentStatsAccumulator(HyperLogLogSets())
+        for flag, read_id in records:
+            approximate.add(flag, read_id)
+        result = approximate.result()
+        bounds = approximate.error_bounds()
+
+        self.assertEqual(set(result), set(expected))
+        self.assertEqual(result['unmapped_reads'], expected['unmapped_reads'])
+        self.assertEqual(result['properly_paired'], expected['properly_paired'])
+        for key in ('mapped_reads', 'total_reads', 'multiple_alignments', 'alignment_rate'):
+            self.assertGreater(bounds[key], 0)
+            # 2 sigma bounds, checked at 3 sigma to keep the test stable
+            self.assertLessEqual(abs(result[key] - expected[key]), 1.5 * bounds[key], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import unittest
+
+
+class ImportTimeTest(unittest.TestCase):
+    """
+    Guards the cold start of the async job runner. Every async job is a fresh
+    python process, so modules imported by the Impl are paid on every call.
+    """
+
+    # modules that must only be imported by the methods that use them
+    LAZY_MODULES = ['pysam', 'numpy', 'pyarrow', 'installed_clients.WorkspaceClient']
+
+    def import_times(self, module):
+        """
+        Imports module in a fresh interpreter with -X importtime and returns a
+        dict of imported module name -> cumulative import time in seconds
+        """
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               'import ' + module],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              env=os.environ.copy())
+        stderr = proc.stderr.decode()
+        self.assertEqual(proc.returncode, 0, stderr)
+
+        times = {}
+        for line in stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            times[fields[2].strip()] = int(fields[1].strip()) / 1e6
+        return times
+
+    def test_impl_import_is_lazy(self):
+        times = self.import_times('ReadsAlignmentUtils.ReadsAlignmentUtilsImpl')
+
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, times,
+                             '{} is imported when the Impl module loads'.format(module))
+
+    def test_server_import_is_lazy(self):
+        times = self.import_times('ReadsAlignmentUtils.ReadsAlignmentUtilsServer')
+
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, times,
+                             '{} is imported when the Server module loads'.format(module))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from ReadsAlignmentUtils.core.index_stats import (check_stats, merge_index_stats,
+                                                  read_index_stats)
+
+from alignment_fixtures import REFERENCES, random_paired_alignments
+from perf.synthetic_alignments import write_alignments
+
+
+class IndexStatsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def test_idxstats(self):
+        bam = os.path.join(self.tmp, 'sorted.bam')
+        write_alignments(bam, REFERENCES, random_paired_alignments(2000)[0], sort=True)
+        self.assertIsNone(read_index_stats(bam))
+        pysam.index(bam)
+
+        expected = []
+        for line in pysam.idxstats(bam).splitlines():
+            contig, length, mapped, unmapped = line.split('\t')
+            expected.append({'contig': contig, 'length': int(length),
+                             'mapped': int(mapped), 'unmapped': int(unmapped)})
+        self.assertEqual(read_index_stats(bam), expected)
+
+    def test_empty_contig(self):
+        bam = os.path.join(self.tmp, 'empty_contig.bam')
+        alignments = [a for a in random_paired_alignments(2000)[0] if a['reference_id'] != 1]
+        write_alignments(bam, REFERENCES, alignments, sort=True)
+        pysam.index(bam)
+
+        contig_stats = read_index_stats(bam)
+        self.assertIsNotNone(contig_stats)
+        self.assertEqual(contig_stats[1], {'contig': 'chr1', 'length': 1000000,
+                                           'mapped': 0, 'unmapped': 0})
+        self.assertEqual(sum(c['mapped'] + c['unmapped'] for c in contig_stats),
+                         len(alignments))
+
+    def test_accepted_hits(self):
+        # Picard names the index accepted_hits.bai
+        contig_stats = read_index_stats(os.path.join('data', 'accepted_hits.bam'))
+        self.assertEqual([c['contig'] for c in contig_stats][-1], '*')
+        self.assertEqual(sum(c['mapped'] for c in contig_stats), 19213)
+        self.assertEqual(sum(c['unmapped'] for c in contig_stats), 285)
+
+        stats = {'mapped_reads': 14969, 'unmapped_reads': 285}
+        self.assertEqual(check_stats(stats, contig_stats), [])
+        errors = check_stats({'mapped_reads': 20000, 'unmapped_reads': 280}, contig_stats)
+        self.assertEqual(len(errors), 2)
+
+    def test_merge(self):
+        a = [{'contig': 'chr1', 'length': 10, 'mapped': 3, 'unmapped': 1},
+             {'contig': '*', 'length': 0, 'mapped': 0, 'unmapped': 2}]
+        b = [{'contig': 'chr2', 'length': 20, 'mapped': 5, 'unmapped': 0},
+             {'contig': 'chr1', 'length': 10, 'mapped': 1, 'unmapped': 0},
+             {'contig': '*', 'length': 0, 'mapped': 0, 'unmapped': 4}]
+        self.assertEqual(merge_index_stats([a, b]),
+                         [{'contig': 'chr1', 'length': 10, 'mapped': 4, 'unmapped': 1},
+                          {'contig': 'chr2', 'length': 20, 'mapped': 5, 'unmapped': 0},
+                          {'contig': '*', 'length': 0, 'mapped': 0, 'unmapped': 6}])
+        self.assertEqual(a[0]['mapped'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import unittest
+from unittest import mock
+
+from jsonrpcbase import InvalidParamsError
+
+from ReadsAlignmentUtils.ReadsAlignmentUtilsServer import (QUEUED_METHODS, MethodContext,
+                                                           application)
+from ReadsAlignmentUtils.core.resource_queue import ResourceQueue
+
+UPLOAD = 'ReadsAlignmentUtils.upload_alignment'
+
+
+class JobQueueTest(unittest.TestCase):
+    """
+    The job queue of the server, as heavy methods are run through it
+    """
+
+    def setUp(self):
+        self.job_queue = application.job_queue
+        application.job_queue = ResourceQueue(cpu_slots=2, memory_mb=1000, name='methods')
+
+    def tearDown(self):
+        application.job_queue = self.job_queue
+
+    def call_method(self, req):
+        """
+        Calls the method of req through the job queue, and returns the queue
+        stats while it runs
+        """
+        running = []
+
+        def call(ctx, req):
+            running.append(application.job_queue.stats())
+            return json.dumps([{}])
+
+        ctx = MethodContext(application.userlog)
+        ctx['module'], ctx['method'] = req['method'].split('.')
+        with mock.patch.object(application.rpc_service, 'call', call):
+            application.call_method(ctx, dict(req, params=[{}], version='1.1', id='1'))
+        return running[0]
+
+    def test_get_job_resources(self):
+        self.assertEqual(application.get_job_resources({'method': UPLOAD}),
+                         QUEUED_METHODS[UPLOAD])
+        self.assertIsNone(application.get_job_resources(
+            {'method': 'ReadsAlignmentUtils.status'}))
+
+        # each resource given in the context overrides its default
+        self.assertEqual(application.get_job_resources(
+            {'method': UPLOAD, 'context': {'resources': {'cpu': '4', 'memory_mb': 8192}}}),
+            {'cpu': 4, 'memory_mb': 8192})
+        self.assertEqual(application.get_job_resources(
+            {'method': UPLOAD, 'context': {'resources': {'memory_mb': 512, 'gpu': 1}}}),
+            dict(QUEUED_METHODS[UPLOAD], memory_mb=512))
+        for context in (None, {'resources': None}, {'resources': [4, 8192]}):
+            self.assertEqual(application.get_job_resources({'method': UPLOAD,
+                                                            'context': context}),
+                             QUEUED_METHODS[UPLOAD])
+        for value in ('four', [4], -1):
+            with self.assertRaisesRegex(InvalidParamsError, 'resources cpu'):
+                application.get_job_resources(
+                    {'method': UPLOAD, 'context': {'resources': {'cpu': value}}})
+        # the defaults are not changed by an override
+        self.assertEqual(QUEUED_METHODS[UPLOAD], {'cpu': 2, 'memory_mb': 2048})
+
+    def test_call_method_resources(self):
+        stats = self.call_method({'method': UPLOAD,
+                                  'context': {'resources': {'cpu': 1, 'memory_mb': 300}}})
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['cpu_in_use'], 1)
+        self.assertEqual(stats['memory_in_use_mb'], 300)
+
+        stats = application.job_queue.stats()
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['cpu_in_use'], 0)
+
+    def test_call_method_oversized(self):
+        # a job larger than the queue is clamped to it rather than waiting forever
+        stats = self.call_method({'method': UPLOAD,
+                                  'context': {'resources': {'cpu': 64, 'memory_mb': 1000000}}})
+        self.assertEqual(stats['cpu_in_use'], 2)
+        self.assertEqual(stats['memory_in_use_mb'], 1000)
+        self.assertEqual(application.job_queue.stats()['completed'], 1)
+
+    def test_invalid_resources(self):
+        responses = []
+        body = json.dumps({'method': UPLOAD, 'params': [{}], 'version': '1.1', 'id': '1',
+                           'context': {'resources': {'memory_mb': '8G'}}}).encode()
+        with mock.patch.object(application, 'method_authentication', {}):
+            result = application({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                                  'wsgi.input': io.BytesIO(body)},
+                                 lambda status, headers: responses.append(status))
+        error = json.loads(b''.join(result).decode())['error']
+        self.assertEqual(error['code'], -32602)
+        self.assertIn("memory_mb must be a non-negative integer, not '8G'", error['message'])
+        self.assertEqual(application.job_queue.stats()['completed'], 0)
+
+    def test_unqueued_method(self):
+        stats = self.call_method({'method': 'ReadsAlignmentUtils.status'})
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(application.job_queue.stats()['completed'], 0)
+
+    def test_queue_endpoint(self):
+        self.call_method({'method': UPLOAD})
+        responses = []
+        body = application({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/queue/',
+                            'wsgi.input': io.BytesIO()},
+                           lambda status, headers: responses.append((status, dict(headers))))
+        status, headers = responses[0]
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['content-type'], 'application/json')
+
+        queues = json.loads(b''.join(body).decode())
+        self.assertEqual(sorted(queues), ['methods', 'tools'])
+        self.assertEqual(queues['methods']['name'], 'methods')
+        self.assertEqual(queues['methods']['cpu_slots'], 2)
+        self.assertEqual(queues['methods']['memory_mb'], 1000)
+        self.assertEqual(queues['methods']['completed'], 1)
+        self.assertEqual(queues['methods']['queued'], 0)
+        self.assertEqual(queues['tools']['name'], 'tools')
+        for queue in queues.values():
+            self.assertEqual(set(queue), {'name', 'queued', 'running', 'completed',
+                                          'cpu_slots', 'cpu_in_use', 'memory_mb',
+                                          'memory_in_use_mb', 'total_wait_time',
+                                          'max_wait_time', 'mean_wait_time'})
+
+
+if __name__ == '__main__':
+    unittest.main()
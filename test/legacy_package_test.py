@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from ReadsAlignmentUtils.core import legacy_package
+from ReadsAlignmentUtils.core.legacy_package import extract_alignment_files
+
+
+class LegacyPackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.contents = {'accepted_hits.bam': os.urandom(300000),
+                         'accepted_hits.bai': os.urandom(5000),
+                         'accepted_hits.sam': b'@HD\tVN:1.0\n' * 20000,
+                         'logs/accepted_hits.bam': os.urandom(1000),
+                         'align_summary.txt': b'Reads: 100\n'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write_package(self, name, compression=zipfile.ZIP_DEFLATED):
+        zip_path = os.path.join(self.tmp, name)
+        with zipfile.ZipFile(zip_path, 'w', compression) as package:
+            for member, data in self.contents.items():
+                package.writestr(member, data)
+        return zip_path
+
+    def check_extracted(self, zip_path):
+        extracted = extract_alignment_files(zip_path, self.tmp)
+        self.assertEqual(extracted, [os.path.join(self.tmp, 'accepted_hits.bai'),
+                                     os.path.join(self.tmp, 'accepted_hits.bam')])
+        for path in extracted:
+            with open(path, 'rb') as infile:
+                self.assertEqual(infile.read(), self.contents[os.path.basename(path)])
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['accepted_hits.bai',
+                                                        'accepted_hits.bam'])
+
+    def test_extract(self):
+        self.check_extracted(self.write_package('accepted_hits.zip'))
+
+    def test_extract_stored(self):
+        self.check_extracted(self.write_package('accepted_hits.zip', zipfile.ZIP_STORED))
+
+    def test_package_named_as_member(self):
+        self.check_extracted(self.write_package('accepted_hits.bam'))
+
+    def test_extract_peak_usage(self):
+        self.contents['accepted_hits.bam'] = os.urandom(8 << 20)
+        zip_path = self.write_package('accepted_hits.zip')
+        package_size = os.path.getsize(zip_path)
+
+        # space used by the package and the files extracted so far, after
+        # each block of the package is read
+        usage = []
+        punch_hole = legacy_package._punch_hole
+
+        def tracking_punch_hole(fd, offset, length):
+            punch_hole(fd, offset, length)
+            usage.append(sum(os.stat(os.path.join(self.tmp, f)).st_blocks * 512
+                             for f in os.listdir(self.tmp)))
+        legacy_package._punch_hole = tracking_punch_hole
+        try:
+            self.check_extracted(zip_path)
+        finally:
+            legacy_package._punch_hole = punch_hole
+        if not legacy_package._punch_holes:
+            self.skipTest('The file system does not support punching holes')
+        self.assertGreater(len(usage), 8)
+        self.assertLess(max(usage), package_size + 2 * legacy_package.COPY_BUFFER_SIZE)
+
+    def test_bad_crc(self):
+        zip_path = self.write_package('accepted_hits.zip', zipfile.ZIP_STORED)
+        with zipfile.ZipFile(zip_path) as package:
+            member = package.getinfo('accepted_hits.bai')
+        with open(zip_path, 'r+b') as package_file:
+            package_file.seek(member.header_offset + 100)
+            package_file.write(b'corrupt')
+        with self.assertRaisesRegex(zipfile.BadZipFile, 'Bad CRC-32'):
+            extract_alignment_files(zip_path, self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from ReadsAlignmentUtils.core import metrics
+from ReadsAlignmentUtils.core.resource_queue import ResourceQueue
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.MetricsRegistry()
+        requests = registry.register(metrics.Counter('test_requests_total', 'Requests',
+                                                     ['method']))
+        in_flight = registry.register(metrics.Gauge('test_in_flight', 'In flight', ['method']))
+        latency = registry.register(metrics.Histogram('test_latency_seconds', 'Latency',
+                                                      ['method'], buckets=(1, 10)))
+
+        requests.inc(method='upload')
+        requests.inc(2, method='upload')
+        in_flight.inc(method='upload')
+        in_flight.inc(method='upload')
+        in_flight.dec(method='upload')
+        latency.observe(0.5, method='upload')
+        latency.observe(5, method='upload')
+        latency.observe(50, method='upload')
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{method="upload"} 3', lines)
+        self.assertIn('test_in_flight{method="upload"} 1', lines)
+        self.assertIn('# TYPE test_latency_seconds histogram', lines)
+        self.assertIn('test_latency_seconds_bucket{method="upload",le="1"} 1', lines)
+        self.assertIn('test_latency_seconds_bucket{method="upload",le="10"} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{method="upload",le="+Inf"} 3', lines)
+        self.assertIn('test_latency_seconds_sum{method="upload"} 55.5', lines)
+        self.assertIn('test_latency_seconds_count{method="upload"} 3', lines)
+
+    def test_labels(self):
+        counter = metrics.Counter('test_total', 'Test', ['method'])
+        with self.assertRaises(ValueError):
+            counter.inc(tool='samtools')
+        with self.assertRaises(ValueError):
+            counter.inc(-1, method='upload')
+
+        counter.inc(method='a "quoted"\nname')
+        registry = metrics.MetricsRegistry()
+        registry.register(counter)
+        self.assertIn('test_total{method="a \\"quoted\\"\\nname"} 1',
+                      registry.render().splitlines())
+
+    def test_queue_collector(self):
+        registry = metrics.MetricsRegistry()
+        queue = ResourceQueue(cpu_slots=2, memory_mb=100, name='test')
+        registry.add_collector(metrics.queue_collector(queue))
+
+        with queue.slot(cpu=1, memory_mb=40):
+            lines = registry.render().splitlines()
+        self.assertIn('readsalignmentutils_queue_jobs_running{queue="test"} 1', lines)
+        self.assertIn('readsalignmentutils_queue_memory_in_use_mb{queue="test"} 40', lines)
+
+        lines = registry.render().splitlines()
+        self.assertIn('readsalignmentutils_queue_jobs_running{queue="test"} 0', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the core alignment operations on synthetic files.
+
+Times _get_aligner_stats, SamTools.convert_sam_to_sorted_bam,
+create_bai_from_bam, convert_bam_to_sam and validate on synthetic alignments
+of increasing size, and reports throughput and peak memory per operation and
+size as JSON.
+
+Each operation runs in a forked child process so that its peak memory,
+including the samtools and Picard processes it starts, is read exactly from
+the rusage of the child. Generated inputs are cached in the work directory
+and reused between runs with the same parameters.
+
+Run it in the module's test environment, e.g.
+    cd test && PYTHONPATH=../lib python perf/benchmark.py --sizes 1e5,1e6 \
+        --output /kb/module/work/tmp/benchmark.json
+
+usage: benchmark.py [-h] [--sizes SIZES] [--operations OPERATIONS] [--paired]
+                    [--multimap-rate RATE] [--unmapped-fraction FRACTION]
+                    [--contigs CONTIGS] [--seed SEED] [--repeat REPEAT]
+                    [--work-dir WORK_DIR] [--output OUTPUT]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+from subprocess import PIPE, STDOUT, Popen
+
+from synthetic_alignments import SyntheticAlignments, sam_to_bam
+
+DEFAULT_SIZES = '1e5,1e6,1e7,1e8'
+
+# operation name -> input file type
+OPERATIONS = {
+    'stats': 'bam',
+    'sort': 'sam',
+    'index': 'bam',
+    'to_sam': 'bam',
+    'validate': 'bam',
+}
+
+
+def load_config(work_dir):
+    """
+    Returns the ReadsAlignmentUtils config from KB_DEPLOYMENT_CONFIG, or a
+    minimal one for running outside of the test container
+    """
+    config_file = os.environ.get('KB_DEPLOYMENT_CONFIG')
+    if config_file:
+        config = ConfigParser()
+        config.read(config_file)
+        return dict(config.items('ReadsAlignmentUtils'))
+    # the benchmarked operations don't call any services
+    os.environ.setdefault('SDK_CALLBACK_URL', 'http://localhost:0')
+    return {'scratch': work_dir, 'workspace-url': ''}
+
+
+def prepare_inputs(work_dir, size, args):
+    """
+    Generates, or reuses, the synthetic SAM and sorted BAM of about size records
+
+    :returns a dict with the sam and bam paths and the number of records
+    """
+    alignments = SyntheticAlignments(1, paired=args.paired, multimap_rate=args.multimap_rate,
+                                     unmapped_fraction=args.unmapped_fraction,
+                                     contigs=args.contigs, seed=args.seed)
+    reads = max(int(round(size / alignments.expected_records_per_read())), 1)
+    alignments.reads = reads
+
+    name = 'synthetic_{0}_{1}_{2}_{3}_{4}_{5}'.format(
+        'pe' if args.paired else 'se', reads, args.multimap_rate, args.unmapped_fraction,
+        args.contigs, args.seed)
+    sam_path = os.path.join(work_dir, name + '.sam')
+    bam_path = os.path.join(work_dir, name + '.bam')
+    count_path = os.path.join(work_dir, name + '.records')
+
+    if not os.path.exists(count_path):
+        print('generating {0} reads in {1}'.format(reads, sam_path), file=sys.stderr)
+        records = alignments.write_sam(sam_path)
+        sam_to_bam(sam_path, bam_path, sort=True)
+        with open(count_path, 'w') as count_file:
+            count_file.write(str(records))
+    with open(count_path) as count_file:
+        records = int(count_file.read())
+    return {'sam': sam_path, 'bam': bam_path, 'records': records}
+
+
+def run_operation(operation, impl, input_path, out_dir):
+    samtools = impl.samtools
+    ipath, ifile = os.path.split(input_path)
+    if operation == 'stats':
+        return impl._get_aligner_stats(input_path)
+    if operation == 'sort':
+        return samtools.convert_sam_to_sorted_bam(ifile, ipath, opath=out_dir)
+    if operation == 'index':
+        return samtools.create_bai_from_bam(ifile, ipath, opath=out_dir)
+    if operation == 'to_sam':
+        return samtools.convert_bam_to_sam(ifile, ipath, opath=out_dir)
+    if operation == 'validate':
+        return samtools.validate(ifile, ipath)
+    raise ValueError('Unknown operation: ' + operation)
+
+
+def measure(operation, config, input_path, out_dir):
+    """
+    Runs one operation in a forked child process
+
+    :returns a dict with wall_time, cpu_time and peak_rss_mb, or error if the
+    operation failed
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            from ReadsAlignmentUtils.ReadsAlignmentUtilsImpl import ReadsAlignmentUtils
+            impl = ReadsAlignmentUtils(config)
+            start = time.time()
+            run_operation(operation, impl, input_path, out_dir)
+            message = {'wall_time': time.time() - start}
+        except Exception as ex:
+            message = {'error': '{0}: {1}'.format(type(ex).__name__, ex)}
+            status = 1
+        with os.fdopen(write_fd, 'w') as pipe:
+            json.dump(message, pipe)
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        message = json.loads(pipe.read() or '{}')
+    _, _, usage = os.wait4(pid, 0)
+    # the rusage of a reaped child includes the processes it waited for
+    message['cpu_time'] = usage.ru_utime + usage.ru_stime
+    message['peak_rss_mb'] = usage.ru_maxrss / 1024.0
+    return message
+
+
+def tool_versions():
+    """
+    Returns the versions of pysam, samtools and Picard, as regressions often
+    come with upgrades of these
+    """
+    versions = {}
+    try:
+        import pysam
+        versions['pysam'] = pysam.__version__
+    except ImportError:
+        versions['pysam'] = None
+    for name, command in (('samtools', 'samtools --version'),
+                          ('picard', 'java -jar /opt/picard/build/libs/picard.jar '
+                                     'ValidateSamFile --version')):
+        proc = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0].decode(errors='replace').strip().splitlines()
+        versions[name] = output[0] if proc.returncode in (0, 1) and output else None
+    return versions
+
+
+def benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='rau_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    config = load_config(work_dir)
+    operations = args.operations.split(',')
+    for operation in operations:
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation: {0}. Available operations: {1}'.format(
+                operation, ', '.join(OPERATIONS)))
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    results = []
+    for size in [float(s) for s in args.sizes.split(',')]:
+        inputs = prepare_inputs(work_dir, size, args)
+        for operation in operations:
+            input_path = inputs[OPERATIONS[operation]]
+            input_bytes = os.path.getsize(input_path)
+            for run in range(args.repeat):
+                out_dir = tempfile.mkdtemp(dir=work_dir)
+                try:
+                    measured = measure(operation, config, input_path, out_dir)
+                finally:
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                result = {
+                    'operation': operation,
+                    'size': size,
+                    'paired': args.paired,
+                    'records': inputs['records'],
+                    'input_bytes': input_bytes,
+                    'run': run,
+                }
+                result.update(measured)
+                wall_time = measured.get('wall_time')
+                if wall_time:
+                    result['records_per_sec'] = inputs['records'] / wall_time
+                    result['mb_per_sec'] = input_bytes / 1048576.0 / wall_time
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+
+    return {
+        'started': started,
+        'host': os.uname().nodename,
+        'cpu_count': os.cpu_count(),
+        'versions': tool_versions(),
+        'parameters': {
+            'paired': args.paired,
+            'multimap_rate': args.multimap_rate,
+            'unmapped_fraction': args.unmapped_fraction,
+            'contigs': args.contigs,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark core alignment operations')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated approximate record counts, default ' +
+                        DEFAULT_SIZES)
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma separated operations, default all of ' +
+                        ','.join(OPERATIONS))
+    parser.add_argument('--paired', action='store_true', help='use paired-end reads')
+    parser.add_argument('--multimap-rate', type=float, default=0.1)
+    parser.add_argument('--unmapped-fraction', type=float, default=0.05)
+    parser.add_argument('--contigs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per operation and size')
+    parser.add_argument('--work-dir', help='directory for generated inputs, kept for reuse')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    report = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
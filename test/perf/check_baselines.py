@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Compares benchmark results with the stored baselines in baselines.json.
+
+Fails, with exit code 1, when the throughput of an operation drops, or its
+peak memory grows, by more than the tolerance, and when an operation in the
+baselines has no recorded value for a metric or no result. Either reads a report written
+by benchmark.py or runs the benchmark with the parameters of the baselines.
+Run with --update on the reference machine to store new baselines after an
+intended change; the baselines of the operations that were not run are kept.
+--operations limits the run, the check and the update to some operations.
+
+    cd test && PYTHONPATH=../lib python perf/check_baselines.py --tolerance 0.2
+
+usage: check_baselines.py [-h] [--report REPORT] [--baselines BASELINES]
+                          [--operations OPERATIONS] [--tolerance FRACTION]
+                          [--memory-tolerance FRACTION] [--repeat REPEAT]
+                          [--work-dir WORK_DIR] [--update]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+
+import benchmark
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# metrics that regress when they go down, and when they go up
+THROUGHPUT_METRICS = ('records_per_sec', 'mb_per_sec')
+MEMORY_METRICS = ('peak_rss_mb',)
+
+
+def _key(result):
+    return '{0}@{1}{2}'.format(result['operation'], int(float(result['size'])),
+                               '_pe' if result.get('paired') else '')
+
+
+def summarize(report):
+    """
+    Returns the median of each metric over the runs of each operation and size,
+    keyed by operation@size
+    """
+    runs = {}
+    for result in report['results']:
+        if 'error' in result:
+            raise RuntimeError('{0} failed: {1}'.format(_key(result), result['error']))
+        runs.setdefault(_key(result), []).append(result)
+    summary = {}
+    for key, results in sorted(runs.items()):
+        summary[key] = {metric: statistics.median(r[metric] for r in results)
+                        for metric in THROUGHPUT_METRICS + MEMORY_METRICS}
+    return summary
+
+
+def compare(baselines, summary, tolerance, memory_tolerance):
+    """
+    Compares a benchmark summary with the baselines
+
+    :returns a list of (key, metric, baseline, current, change, regressed) rows
+    """
+    rows = []
+    for key, expected in sorted(baselines.items()):
+        if key not in summary:
+            continue
+        for metric, baseline in sorted(expected.items()):
+            current = summary[key].get(metric)
+            if current is None or not baseline:
+                continue
+            change = (current - baseline) / baseline
+            if metric in THROUGHPUT_METRICS:
+                regressed = change < -tolerance
+            else:
+                regressed = change > memory_tolerance
+            rows.append((key, metric, baseline, current, change, regressed))
+    return rows
+
+
+def missing_baselines(baselines, summary):
+    """
+    Returns the operation@size keys of the baselines that can't be checked,
+    as a metric has no recorded value or the summary has no result for them
+    """
+    return [key for key, expected in sorted(baselines.items())
+            if key not in summary
+            or any(not expected.get(metric) for metric in THROUGHPUT_METRICS + MEMORY_METRICS)]
+
+
+def select_operations(baselines, operations):
+    """
+    Returns the baselines of the given operations, all if operations is None
+    """
+    if operations is None:
+        return dict(baselines)
+    return {key: expected for key, expected in baselines.items()
+            if key.split('@')[0] in operations}
+
+
+def run_benchmark(baselines, parameters, args):
+    """
+    Runs the benchmark for the operations and sizes of baselines, a dict of
+    the stored baselines by operation@size, with the generator parameters
+    """
+    sizes = sorted({key.split('@')[1].replace('_pe', '') for key in baselines}, key=float)
+    operations = sorted({key.split('@')[0] for key in baselines})
+    if args.operations:
+        operations = args.operations
+    bench_args = benchmark.build_parser().parse_args([])
+    bench_args.sizes = ','.join(sizes) or '1e6'
+    bench_args.operations = ','.join(operations) or ','.join(benchmark.OPERATIONS)
+    bench_args.repeat = args.repeat
+    bench_args.work_dir = args.work_dir
+    for name, value in parameters.items():
+        setattr(bench_args, name, value)
+    return benchmark.benchmark(bench_args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check benchmark results against baselines')
+    parser.add_argument('--report', help='report written by benchmark.py, run the benchmark '
+                                         'if not given')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--operations', type=lambda value: value.split(','),
+                        help='comma separated operations to run and check, default all of '
+                             'the baselines')
+    parser.add_argument('--tolerance', type=float,
+                        help='allowed fractional throughput drop, default from the baselines')
+    parser.add_argument('--memory-tolerance', type=float,
+                        help='allowed fractional peak memory growth, default from the baselines')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per operation and size')
+    parser.add_argument('--work-dir', help='directory for generated inputs, kept for reuse')
+    parser.add_argument('--update', action='store_true',
+                        help='store the results as the new baselines instead of comparing')
+    args = parser.parse_args()
+
+    with open(args.baselines) as baselines_file:
+        baselines = json.load(baselines_file)
+
+    selected = select_operations(baselines['operations'], args.operations)
+    if args.report:
+        with open(args.report) as report_file:
+            report = json.load(report_file)
+    else:
+        report = run_benchmark(selected, baselines.get('parameters', {}), args)
+    summary = select_operations(summarize(report), args.operations)
+
+    if args.update:
+        baselines['operations'].update(summary)
+        baselines['recorded'] = {'started': report.get('started'),
+                                 'host': report.get('host'),
+                                 'cpu_count': report.get('cpu_count'),
+                                 'versions': report.get('versions')}
+        with open(args.baselines, 'w') as baselines_file:
+            json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write('\n')
+        print('stored baselines for {0} in {1}'.format(', '.join(summary), args.baselines))
+        return 0
+
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = baselines.get('tolerance', 0.2)
+    memory_tolerance = args.memory_tolerance
+    if memory_tolerance is None:
+        memory_tolerance = baselines.get('memory_tolerance', 0.2)
+
+    rows = compare(selected, summary, tolerance, memory_tolerance)
+    if rows:
+        print('{0:<20} {1:<16} {2:>14} {3:>14} {4:>8}'.format(
+            'operation', 'metric', 'baseline', 'current', 'change'))
+    for key, metric, baseline, current, change, regressed in rows:
+        print('{0:<20} {1:<16} {2:>14.2f} {3:>14.2f} {4:>+7.1%}{5}'.format(
+            key, metric, baseline, current, change, '  REGRESSION' if regressed else ''))
+
+    recorded = (baselines.get('recorded') or {}).get('versions') or {}
+    current_versions = report.get('versions') or {}
+    for tool in sorted(set(recorded) | set(current_versions)):
+        if recorded.get(tool) != current_versions.get(tool):
+            print('{0} changed from {1} to {2}'.format(
+                tool, recorded.get(tool), current_versions.get(tool)))
+
+    status = 0
+    missing = missing_baselines(selected, summary)
+    if missing:
+        print('no baseline or result to compare for {0}, record the baselines with --update '
+              'on the reference machine'.format(', '.join(missing)), file=sys.stderr)
+        status = 1
+    regressions = [row for row in rows if row[5]]
+    if regressions:
+        print('{0} regression(s) beyond a tolerance of {1:.0%} throughput / {2:.0%} memory'
+              .format(len(regressions), tolerance, memory_tolerance), file=sys.stderr)
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Times upload_alignment, download_alignment and export_alignment end to end
+against the fake callback server, without any KBase services.
+
+A synthetic BAM is uploaded to a local workspace, then downloaded with a
+BAI and exported. The per-stage timings the methods return with
+report_timings are included in the JSON report.
+
+Run it in the module's test environment, e.g.
+    cd test && PYTHONPATH=../lib python perf/end_to_end.py --reads 1e6 \
+        --latency 0.05 --bandwidth 50
+
+usage: end_to_end.py [-h] [--reads READS] [--paired] [--latency SECONDS]
+                     [--bandwidth MB_PER_SEC] [--repeat REPEAT]
+                     [--work-dir WORK_DIR] [--output OUTPUT]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+
+from fake_callback_server import run_server
+from synthetic_alignments import generate
+
+WORKSPACE = 'perf_alignments'
+
+
+def load_config(work_dir, url):
+    config = {}
+    config_file = os.environ.get('KB_DEPLOYMENT_CONFIG')
+    if config_file:
+        parser = ConfigParser()
+        parser.read(config_file)
+        config.update(parser.items('ReadsAlignmentUtils'))
+    config.setdefault('scratch', work_dir)
+    config['workspace-url'] = url
+    return config
+
+
+def seed_objects(store, paired):
+    """
+    Saves the reads library and genome objects an alignment refers to
+
+    :returns the references of the reads library and genome
+    """
+    ws_id = store.ws_name_to_id(WORKSPACE)
+    lib_type = 'KBaseFile.PairedEndLibrary-2.2' if paired else 'KBaseFile.SingleEndLibrary-2.2'
+    reads = store.save_object(ws_id, {'type': lib_type, 'name': 'reads', 'data': {}})
+    genome = store.save_object(ws_id, {'type': 'KBaseGenomes.Genome-17.0', 'name': 'genome',
+                                       'data': {}})
+    return ('{0}/{1}/{2}'.format(ws_id, reads[0], reads[4]),
+            '{0}/{1}/{2}'.format(ws_id, genome[0], genome[4]))
+
+
+def timed(name, func, *args):
+    start = time.time()
+    result = func(*args)[0]
+    return {'method': name,
+            'wall_time': time.time() - start,
+            'timings': result.get('timings', [])}, result
+
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='rau_end_to_end_')
+    os.makedirs(work_dir, exist_ok=True)
+    bam_path = os.path.join(work_dir, 'synthetic.bam')
+    records = generate(bam_path, bam=True, sort=True, reads=int(args.reads),
+                       paired=args.paired)
+
+    results = []
+    with run_server(os.path.join(work_dir, 'fake_kbase'), latency=args.latency,
+                    bandwidth=args.bandwidth) as server:
+        os.environ['SDK_CALLBACK_URL'] = server.url
+        from ReadsAlignmentUtils.ReadsAlignmentUtilsImpl import ReadsAlignmentUtils
+        impl = ReadsAlignmentUtils(load_config(work_dir, server.url))
+        reads_ref, genome_ref = seed_objects(server.store, args.paired)
+        ctx = {}
+
+        for run_index in range(args.repeat):
+            upload, uploaded = timed('upload_alignment', impl.upload_alignment, ctx, {
+                'destination_ref': '{0}/alignment_{1}'.format(WORKSPACE, run_index),
+                'file_path': bam_path,
+                'read_library_ref': reads_ref,
+                'assembly_or_genome_ref': genome_ref,
+                'condition': 'perf',
+                'report_timings': 1})
+            download, _ = timed('download_alignment', impl.download_alignment, ctx, {
+                'source_ref': uploaded['obj_ref'],
+                'downloadBAI': 1,
+                'report_timings': 1})
+            export, _ = timed('export_alignment', impl.export_alignment, ctx, {
+                'source_ref': uploaded['obj_ref'],
+                'exportSAM': 1,
+                'report_timings': 1})
+            for result in (upload, download, export):
+                result['run'] = run_index
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+
+    return {
+        'records': records,
+        'input_bytes': os.path.getsize(bam_path),
+        'paired': args.paired,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time upload, download and export against '
+                                                 'the fake callback server')
+    parser.add_argument('--reads', type=float, default=1e5,
+                        help='number of reads (read pairs with --paired)')
+    parser.add_argument('--paired', action='store_true', help='use paired-end reads')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every service call')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Shock transfer rate in MB/s, unlimited by default')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--work-dir', help='directory for the generated input and fake data')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
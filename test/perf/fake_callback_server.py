@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+Offline stand-in for the DataFileUtil, Workspace and Shock services.
+
+Serves the DataFileUtil methods used by ReadsAlignmentUtils (file_to_shock,
+shock_to_file, save_objects, get_objects, ws_name_to_id and
+package_for_download) through the SDK callback job protocol, and
+Workspace.get_object_info_new as a plain JSON-RPC call, all backed by a local
+directory. Point both SDK_CALLBACK_URL and workspace-url at the server.
+
+Every call is delayed by the injected latency, and file transfers to and
+from the fake Shock are throttled to the injected bandwidth, so that end to
+end performance can be measured on a laptop under network conditions close
+to those of a KBase deployment.
+
+usage: fake_callback_server.py [-h] [--root ROOT] [--host HOST] [--port PORT]
+                               [--latency SECONDS] [--bandwidth MB_PER_SEC] [--clear]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class ServiceError(Exception):
+
+    def __init__(self, message, code=-32000, name='JSONRPCError'):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.name = name
+
+
+class LocalKBaseStore:
+    """
+    Shock nodes and workspace objects kept in a local directory.
+
+    Shock nodes are stored as <root>/shock/<node id>/<file name> and
+    workspace objects, with their info, as
+    <root>/workspace/<ws id>/<obj id>/<version>.json.
+    """
+
+    def __init__(self, root, bandwidth=None, user='perf_user'):
+        """
+        :param root: directory holding the store, created if missing
+        :param bandwidth: transfer rate to and from Shock in MB/s, None for unlimited
+        :param user: the user recorded as the owner of saved objects
+        """
+        self.root = os.path.abspath(root)
+        self.bandwidth = bandwidth
+        self.user = user
+        self._lock = threading.RLock()
+        self._workspaces_path = os.path.join(self.root, 'workspaces.json')
+        os.makedirs(os.path.join(self.root, 'shock'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'workspace'), exist_ok=True)
+        if os.path.exists(self._workspaces_path):
+            with open(self._workspaces_path) as workspaces:
+                self._workspaces = json.load(workspaces)
+        else:
+            self._workspaces = {}
+
+    # Shock
+
+    def _copy(self, src, dst):
+        """
+        Copies src to dst no faster than the configured bandwidth
+
+        :returns the md5 of the file
+        """
+        md5 = hashlib.md5()
+        start = time.time()
+        copied = 0
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            while True:
+                chunk = fin.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fout.write(chunk)
+                md5.update(chunk)
+                copied += len(chunk)
+                if self.bandwidth:
+                    delay = copied / (self.bandwidth * 1048576.0) - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+        return md5.hexdigest()
+
+    def _node_file(self, shock_id):
+        node_dir = os.path.join(self.root, 'shock', os.path.basename(shock_id))
+        if not os.path.isdir(node_dir) or not os.listdir(node_dir):
+            raise ServiceError('Shock node {0} does not exist'.format(shock_id))
+        return os.path.join(node_dir, os.listdir(node_dir)[0])
+
+    def _add_node(self, file_path, file_name=None):
+        shock_id = str(uuid.uuid4())
+        node_dir = os.path.join(self.root, 'shock', shock_id)
+        os.makedirs(node_dir)
+        node_file = os.path.join(node_dir, file_name or os.path.basename(file_path))
+        md5 = self._copy(file_path, node_file)
+        return shock_id, node_file, md5
+
+    def _zip_dir(self, dir_path, zip_path):
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            for dirpath, _, filenames in os.walk(dir_path):
+                for filename in filenames:
+                    full_path = os.path.join(dirpath, filename)
+                    z.write(full_path, os.path.relpath(full_path, dir_path))
+
+    def file_to_shock(self, params):
+        file_path = params.get('file_path')
+        if not file_path or not os.path.exists(file_path):
+            raise ServiceError('File does not exist: {0}'.format(file_path))
+        pack = params.get('pack')
+        if os.path.isdir(file_path) or pack == 'zip':
+            zip_path = os.path.join(self.root, str(uuid.uuid4()) + '.zip')
+            try:
+                if os.path.isdir(file_path):
+                    self._zip_dir(file_path, zip_path)
+                else:
+                    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED,
+                                         allowZip64=True) as z:
+                        z.write(file_path, os.path.basename(file_path))
+                shock_id, node_file, md5 = self._add_node(
+                    zip_path, os.path.basename(file_path.rstrip('/')) + '.zip')
+            finally:
+                os.remove(zip_path)
+        else:
+            shock_id, node_file, md5 = self._add_node(file_path)
+
+        ret = {'shock_id': shock_id,
+               'node_file_name': os.path.basename(node_file),
+               'size': os.path.getsize(node_file)}
+        if params.get('make_handle'):
+            ret['handle'] = {'hid': 'KBH_' + shock_id[:8],
+                             'file_name': ret['node_file_name'],
+                             'id': shock_id,
+                             'url': 'file://' + os.path.dirname(node_file),
+                             'type': 'shock',
+                             'remote_md5': md5}
+        return ret
+
+    def shock_to_file(self, params):
+        node_file = self._node_file(params.get('shock_id') or params.get('handle_id') or '')
+        file_path = params.get('file_path')
+        if not file_path:
+            raise ServiceError('file_path is required')
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, os.path.basename(node_file))
+        self._copy(node_file, file_path)
+        return {'node_file_name': os.path.basename(node_file),
+                'attributes': {},
+                'file_path': file_path,
+                'size': os.path.getsize(file_path)}
+
+    def package_for_download(self, params):
+        dir_path = params.get('file_path')
+        if not dir_path or not os.path.isdir(dir_path):
+            raise ServiceError('Directory does not exist: {0}'.format(dir_path))
+        # the real method adds provenance of ws_refs to the zip, which isn't needed here
+        zip_path = os.path.join(self.root, str(uuid.uuid4()) + '.zip')
+        try:
+            self._zip_dir(dir_path, zip_path)
+            shock_id, node_file, _ = self._add_node(
+                zip_path, os.path.basename(dir_path.rstrip('/')) + '.zip')
+        finally:
+            os.remove(zip_path)
+        return {'shock_id': shock_id,
+                'node_file_name': os.path.basename(node_file),
+                'size': os.path.getsize(node_file)}
+
+    # Workspace
+
+    def _save_workspaces(self):
+        with open(self._workspaces_path, 'w') as workspaces:
+            json.dump(self._workspaces, workspaces)
+
+    def ws_name_to_id(self, name):
+        """
+        Returns the id of the workspace with the given name, creating it if needed
+        """
+        with self._lock:
+            if name not in self._workspaces:
+                self._workspaces[name] = len(self._workspaces) + 1
+                self._save_workspaces()
+            return self._workspaces[name]
+
+    def _ws_name(self, ws_id):
+        for name, id_ in self._workspaces.items():
+            if id_ == ws_id:
+                return name
+        raise ServiceError('No workspace with id {0} exists'.format(ws_id))
+
+    def _resolve_ws(self, ws_name_or_id):
+        if str(ws_name_or_id).isdigit():
+            ws_id = int(ws_name_or_id)
+            self._ws_name(ws_id)
+            return ws_id
+        if ws_name_or_id not in self._workspaces:
+            raise ServiceError('No workspace with name {0} exists'.format(ws_name_or_id))
+        return self._workspaces[ws_name_or_id]
+
+    def _object_dir(self, ws_id, obj_id):
+        return os.path.join(self.root, 'workspace', str(ws_id), str(obj_id))
+
+    def _object_ids(self, ws_id):
+        ws_dir = os.path.join(self.root, 'workspace', str(ws_id))
+        if not os.path.isdir(ws_dir):
+            return []
+        return sorted(int(obj_id) for obj_id in os.listdir(ws_dir))
+
+    def _latest_version(self, ws_id, obj_id):
+        versions = [int(f.split('.')[0]) for f in os.listdir(self._object_dir(ws_id, obj_id))]
+        return max(versions)
+
+    def _load(self, ws_id, obj_id, version):
+        path = os.path.join(self._object_dir(ws_id, obj_id), '{0}.json'.format(version))
+        if not os.path.exists(path):
+            raise ServiceError('No object {0}/{1}/{2} exists'.format(ws_id, obj_id, version))
+        with open(path) as obj:
+            return json.load(obj)
+
+    def _find_object_id(self, ws_id, obj_name_or_id):
+        if str(obj_name_or_id).isdigit():
+            return int(obj_name_or_id)
+        for obj_id in self._object_ids(ws_id):
+            info = self._load(ws_id, obj_id, self._latest_version(ws_id, obj_id))['info']
+            if info[1] == obj_name_or_id:
+                return obj_id
+        return None
+
+    def _resolve_ref(self, ref):
+        """
+        Returns the (ws id, obj id, version) of an object reference
+        ws_name_or_id/obj_name_or_id[/version]
+        """
+        parts = str(ref).split('/')
+        if len(parts) not in (2, 3):
+            raise ServiceError('Illegal object reference: {0}'.format(ref))
+        with self._lock:
+            ws_id = self._resolve_ws(parts[0])
+            obj_id = self._find_object_id(ws_id, parts[1])
+            if obj_id is None or not os.path.isdir(self._object_dir(ws_id, obj_id)):
+                raise ServiceError('No object with reference {0} exists'.format(ref))
+            version = int(parts[2]) if len(parts) == 3 else self._latest_version(ws_id, obj_id)
+        return ws_id, obj_id, version
+
+    def save_object(self, ws_id, obj):
+        """
+        Saves one object, given as in the save_objects params, and returns its info
+        """
+        if 'type' not in obj or 'data' not in obj:
+            raise ServiceError('Objects require a type and data')
+        with self._lock:
+            ws_name = self._ws_name(ws_id)
+            obj_id = obj.get('objid')
+            if obj_id is None and obj.get('name'):
+                obj_id = self._find_object_id(ws_id, obj['name'])
+            if obj_id is None:
+                obj_id = (self._object_ids(ws_id) or [0])[-1] + 1
+            obj_dir = self._object_dir(ws_id, obj_id)
+            os.makedirs(obj_dir, exist_ok=True)
+            version = len(os.listdir(obj_dir)) + 1
+
+            data = json.dumps(obj['data'], sort_keys=True)
+            info = [obj_id, obj.get('name') or str(obj_id), obj['type'],
+                    time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime()), version,
+                    self.user, ws_id, ws_name, hashlib.md5(data.encode()).hexdigest(),
+                    len(data), obj.get('meta') or {}]
+            with open(os.path.join(obj_dir, '{0}.json'.format(version)), 'w') as out:
+                json.dump({'data': obj['data'], 'info': info}, out)
+        return info
+
+    def save_objects(self, params):
+        if params.get('id') is not None:
+            ws_id = self._resolve_ws(params['id'])
+        elif params.get('workspace'):
+            ws_id = self._resolve_ws(params['workspace'])
+        else:
+            raise ServiceError('Either id or workspace is required')
+        return [self.save_object(ws_id, obj) for obj in params.get('objects', [])]
+
+    def get_objects(self, params):
+        data = []
+        for ref in params.get('object_refs', []):
+            ws_id, obj_id, version = self._resolve_ref(ref)
+            obj = self._load(ws_id, obj_id, version)
+            data.append({'data': obj['data'], 'info': obj['info']})
+        return {'data': data}
+
+    def get_object_info_new(self, params):
+        infos = []
+        for obj in params.get('objects', []):
+            ref = obj.get('ref')
+            if not ref:
+                ref = '{0}/{1}'.format(obj.get('wsid') or obj.get('workspace'),
+                                       obj.get('objid') or obj.get('name'))
+                if obj.get('ver'):
+                    ref += '/{0}'.format(obj['ver'])
+            ws_id, obj_id, version = self._resolve_ref(ref)
+            infos.append(self._load(ws_id, obj_id, version)['info'])
+        return infos
+
+
+class FakeCallbackServer(ThreadingHTTPServer):
+    """
+    JSON-RPC server for a LocalKBaseStore.
+
+    DataFileUtil methods run as callback jobs: DataFileUtil._<method>_submit
+    starts the method and returns a job id, and DataFileUtil._check_job
+    reports whether it has finished.
+    """
+
+    daemon_threads = True
+
+    DFU_METHODS = ('file_to_shock', 'shock_to_file', 'save_objects', 'get_objects',
+                   'ws_name_to_id', 'package_for_download')
+
+    def __init__(self, store, address=('localhost', 0), latency=0.0, workers=8):
+        """
+        :param store: the LocalKBaseStore to serve
+        :param address: (host, port) to listen on, port 0 picks a free port
+        :param latency: seconds added to every call
+        :param workers: number of DataFileUtil jobs run at once
+        """
+        super().__init__(address, _RequestHandler)
+        self.store = store
+        self.latency = latency
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, method, params):
+        job_id = str(uuid.uuid4())
+        with self._jobs_lock:
+            self._jobs[job_id] = self._executor.submit(getattr(self.store, method), *params)
+        return job_id
+
+    def _check_job(self, job_id):
+        with self._jobs_lock:
+            future = self._jobs.get(job_id)
+            if future is None:
+                raise ServiceError('No job with id {0}'.format(job_id))
+            if not future.done():
+                return {'finished': 0}
+            del self._jobs[job_id]
+        error = future.exception()
+        if error is not None:
+            raise error
+        return {'finished': 1, 'result': [future.result()]}
+
+    def dispatch(self, method, params):
+        """
+        Runs a JSON-RPC call and returns its result list
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        service, _, name = method.partition('.')
+        if service == 'DataFileUtil':
+            if name == '_check_job':
+                return [self._check_job(*params)]
+            if name.startswith('_') and name.endswith('_submit'):
+                dfu_method = name[1:-len('_submit')]
+                if dfu_method in self.DFU_METHODS:
+                    return [self._submit(dfu_method, params)]
+            elif name in self.DFU_METHODS:
+                return [getattr(self.store, name)(*params)]
+        elif service == 'Workspace' and name == 'get_object_info_new':
+            return [self.store.get_object_info_new(*params)]
+        raise ServiceError('Method {0} not found'.format(method), code=-32601)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, code, body):
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = {}
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            result = self.server.dispatch(request['method'], request.get('params', []))
+            self._respond(200, {'version': '1.1', 'id': request.get('id'), 'result': result})
+        except Exception as ex:
+            error = {'name': getattr(ex, 'name', 'JSONRPCError'),
+                     'code': getattr(ex, 'code', -32000),
+                     'message': str(ex),
+                     'error': traceback.format_exc()}
+            self._respond(500, {'version': '1.1', 'id': request.get('id'), 'error': error})
+
+
+@contextmanager
+def run_server(root, latency=0.0, bandwidth=None, host='localhost', port=0):
+    """
+    Runs a fake callback server in a background thread
+
+    :returns the server, whose url is used for both SDK_CALLBACK_URL and workspace-url
+    """
+    server = FakeCallbackServer(LocalKBaseStore(root, bandwidth=bandwidth), (host, port),
+                                latency=latency)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake DataFileUtil, Workspace and '
+                                                 'Shock services from a local directory')
+    parser.add_argument('--root', default='fake_kbase', help='directory holding the data')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every call')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Shock transfer rate in MB/s, unlimited by default')
+    parser.add_argument('--clear', action='store_true', help='remove existing data first')
+    args = parser.parse_args()
+
+    if args.clear and os.path.isdir(args.root):
+        shutil.rmtree(args.root)
+    with run_server(args.root, latency=args.latency, bandwidth=args.bandwidth,
+                    host=args.host, port=args.port) as server:
+        print('serving {0} at {1}'.format(os.path.abspath(args.root), server.url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
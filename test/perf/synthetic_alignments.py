@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded generator of synthetic SAM/BAM files for benchmarks.
+
+Generates single-end or paired-end alignments of random reads against random
+contigs, with a controlled read count, multimapping rate, unmapped fraction
+and contig count. The same arguments and seed always produce the same file.
+
+The unit tests write the records they need with write_alignments, from
+their own seeded random fields.
+
+usage: synthetic_alignments.py [-h] --reads READS [--paired] [--multimap-rate RATE]
+                               [--unmapped-fraction FRACTION] [--contigs CONTIGS]
+                               [--contig-length LENGTH] [--read-length LENGTH]
+                               [--seed SEED] [--bam] [--sorted] output
+"""
+import argparse
+import os
+import random
+
+READ_NAME_FORMAT = 'read{0:010d}'
+
+# random sequences are drawn from a small pool to keep generation fast
+SEQUENCE_POOL_SIZE = 1024
+
+
+class SyntheticAlignments:
+    """
+    Writes synthetic alignments in SAM format.
+
+    Every read is unmapped with probability unmapped_fraction (each mate
+    independently for paired-end reads). A mapped read is a multimapper with
+    probability multimap_rate, in which case it has one primary and one to
+    three secondary alignments.
+    """
+
+    def __init__(self, reads, paired=False, multimap_rate=0.1, unmapped_fraction=0.05,
+                 contigs=10, contig_length=1000000, read_length=100, insert_size=300,
+                 seed=1):
+        if reads < 1:
+            raise ValueError('reads must be at least 1')
+        if not 0 <= multimap_rate <= 1 or not 0 <= unmapped_fraction <= 1:
+            raise ValueError('multimap_rate and unmapped_fraction must be between 0 and 1')
+        if contig_length < insert_size + read_length:
+            raise ValueError('contig_length must be larger than insert_size + read_length')
+        self.reads = int(reads)
+        self.paired = paired
+        self.multimap_rate = multimap_rate
+        self.unmapped_fraction = unmapped_fraction
+        self.contig_names = ['contig{0}'.format(i + 1) for i in range(int(contigs))]
+        self.contig_length = int(contig_length)
+        self.read_length = int(read_length)
+        self.insert_size = int(insert_size)
+        self.seed = seed
+
+        rng = random.Random(seed)
+        self._sequences = [''.join(rng.choice('ACGT') for _ in range(self.read_length))
+                           for _ in range(SEQUENCE_POOL_SIZE)]
+        self._qual = 'I' * self.read_length
+        self._cigar = '{0}M'.format(self.read_length)
+
+    def expected_records_per_read(self):
+        """
+        Returns the mean number of SAM records written per read (per read pair
+        when paired), used to size files by record count
+        """
+        # multimappers have 2 to 4 alignments, 3 on average
+        hits = 1 + 2 * self.multimap_rate
+        u = self.unmapped_fraction
+        if not self.paired:
+            return u + (1 - u) * hits
+        both_unmapped = u * u
+        one_unmapped = 2 * u * (1 - u)
+        return (2 * both_unmapped + one_unmapped * (1 + hits) +
+                (1 - both_unmapped - one_unmapped) * 2 * hits)
+
+    def header(self, sort_order='unsorted'):
+        lines = ['@HD\tVN:1.4\tSO:{0}'.format(sort_order)]
+        for name in self.contig_names:
+            lines.append('@SQ\tSN:{0}\tLN:{1}'.format(name, self.contig_length))
+        lines.append('@PG\tID:synthetic_alignments\tPN:synthetic_alignments\tVN:1\t'
+                     'CL:seed={0}'.format(self.seed))
+        return '\n'.join(lines) + '\n'
+
+    def _position(self, rng):
+        return (rng.choice(self.contig_names),
+                rng.randint(1, self.contig_length - self.insert_size - self.read_length))
+
+    def _record(self, name, flag, contig, pos, mapq, mate_contig, mate_pos, tlen, seq, tags):
+        if flag & 0x4:
+            cigar = '*'
+        else:
+            cigar = self._cigar
+        if mate_contig is None:
+            rnext = '*'
+        elif mate_contig == contig:
+            rnext = '='
+        else:
+            rnext = mate_contig
+        return '\t'.join([name, str(flag), contig or '*', str(pos), str(mapq), cigar, rnext,
+                          str(mate_pos), str(tlen), seq, self._qual] + tags) + '\n'
+
+    def _single_end(self, rng, name, seq):
+        if rng.random() < self.unmapped_fraction:
+            return [self._record(name, 0x4, None, 0, 0, None, 0, 0, seq, [])]
+        hits = rng.randint(2, 4) if rng.random() < self.multimap_rate else 1
+        mapq = 60 if hits == 1 else 1
+        records = []
+        for hit in range(hits):
+            contig, pos = self._position(rng)
+            flag = (0x100 if hit else 0) | (0x10 if rng.random() < 0.5 else 0)
+            records.append(self._record(name, flag, contig, pos, mapq, None, 0, 0, seq,
+                                        ['NM:i:{0}'.format(rng.randint(0, 3)),
+                                         'NH:i:{0}'.format(hits)]))
+        return records
+
+    def _paired_end(self, rng, name, seq1, seq2):
+        unmapped1 = rng.random() < self.unmapped_fraction
+        unmapped2 = rng.random() < self.unmapped_fraction
+        if unmapped1 and unmapped2:
+            return [self._record(name, 0x1 | 0x4 | 0x8 | 0x40, None, 0, 0, None, 0, 0,
+                                 seq1, []),
+                    self._record(name, 0x1 | 0x4 | 0x8 | 0x80, None, 0, 0, None, 0, 0,
+                                 seq2, [])]
+
+        hits = rng.randint(2, 4) if rng.random() < self.multimap_rate else 1
+        mapq = 60 if hits == 1 else 1
+        records = []
+        for hit in range(hits):
+            contig, pos1 = self._position(rng)
+            pos2 = pos1 + self.insert_size - self.read_length
+            secondary = 0x100 if hit else 0
+            tags = ['NM:i:{0}'.format(rng.randint(0, 3)), 'NH:i:{0}'.format(hits)]
+            if unmapped1 or unmapped2:
+                # the unmapped mate is placed at the position of the mapped one
+                mapped_pos = pos2 if unmapped1 else pos1
+                flag1 = 0x1 | 0x40 | secondary | (0x4 if unmapped1 else 0x8)
+                flag2 = 0x1 | 0x80 | secondary | (0x4 if unmapped2 else 0x8)
+                if not unmapped1 or not hit:
+                    records.append(self._record(name, flag1, contig, mapped_pos,
+                                                0 if unmapped1 else mapq, contig, mapped_pos,
+                                                0, seq1, [] if unmapped1 else tags))
+                if not unmapped2 or not hit:
+                    records.append(self._record(name, flag2, contig, mapped_pos,
+                                                0 if unmapped2 else mapq, contig, mapped_pos,
+                                                0, seq2, [] if unmapped2 else tags))
+            else:
+                tlen = self.insert_size
+                records.append(self._record(name, 0x1 | 0x2 | 0x20 | 0x40 | secondary, contig,
+                                            pos1, mapq, contig, pos2, tlen, seq1, tags))
+                records.append(self._record(name, 0x1 | 0x2 | 0x10 | 0x80 | secondary, contig,
+                                            pos2, mapq, contig, pos1, -tlen, seq2, tags))
+        return records
+
+    def write_sam(self, path):
+        """
+        Writes the alignments to path in SAM format and returns the number of
+        records written
+        """
+        rng = random.Random(self.seed)
+        sequences = self._sequences
+        records = 0
+        with open(path, 'w') as out:
+            out.write(self.header())
+            batch = []
+            for i in range(self.reads):
+                name = READ_NAME_FORMAT.format(i)
+                if self.paired:
+                    batch.extend(self._paired_end(rng, name, rng.choice(sequences),
+                                                  rng.choice(sequences)))
+                else:
+                    batch.extend(self._single_end(rng, name, rng.choice(sequences)))
+                if len(batch) >= 10000:
+                    records += len(batch)
+                    out.write(''.join(batch))
+                    batch = []
+            records += len(batch)
+            out.write(''.join(batch))
+        return records
+
+
+def sam_to_bam(sam_path, bam_path, sort=False):
+    """
+    Converts a SAM file to BAM with pysam, optionally sorting it by coordinate
+    """
+    import pysam
+
+    if sort:
+        pysam.sort('-o', bam_path, '-O', 'BAM', sam_path, catch_stdout=False)
+    else:
+        pysam.view('-b', '-o', bam_path, sam_path, catch_stdout=False)
+    return bam_path
+
+
+def write_alignments(path, references, alignments, sort=False, mode='wb'):
+    """
+    Writes alignments to a BAM file, or a SAM file with mode 'w', with pysam
+
+    :param references: (name, length) of each reference
+    :param alignments: dicts of the pysam AlignedSegment attributes of each
+    record, set in order, and its tags in 'tags'
+    :param sort: sort the alignments by coordinate, the unplaced ones last,
+    and mark the file coordinate sorted
+    :returns the records written, in file order
+    """
+    import pysam
+
+    header = {'HD': {'VN': '1.6'},
+              'SQ': [{'SN': name, 'LN': length} for name, length in references]}
+    if sort:
+        header['HD']['SO'] = 'coordinate'
+        alignments = sorted(alignments, key=lambda a: (a.get('reference_id', -1) < 0,
+                                                       a.get('reference_id', -1),
+                                                       a.get('reference_start', -1)))
+    records = []
+    with pysam.AlignmentFile(path, mode, header=header) as out:
+        for alignment in alignments:
+            record = pysam.AlignedSegment(out.header)
+            for name, value in alignment.items():
+                if name == 'tags':
+                    for tag, tag_value in value.items():
+                        record.set_tag(tag, tag_value)
+                else:
+                    setattr(record, name, value)
+            out.write(record)
+            records.append(record)
+    return records
+
+
+def generate(output, bam=False, sort=False, **kwargs):
+    """
+    Writes a synthetic SAM file, or BAM if bam is True, to output and returns
+    the number of records
+    """
+    alignments = SyntheticAlignments(**kwargs)
+    if not bam:
+        return alignments.write_sam(output)
+    sam_path = os.path.splitext(output)[0] + '.tmp.sam'
+    try:
+        records = alignments.write_sam(sam_path)
+        sam_to_bam(sam_path, output, sort=sort)
+    finally:
+        if os.path.exists(sam_path):
+            os.remove(sam_path)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic SAM/BAM file')
+    parser.add_argument('output', help='output file path')
+    parser.add_argument('--reads', type=float, required=True,
+                        help='number of reads (read pairs with --paired), e.g. 1e6')
+    parser.add_argument('--paired', action='store_true', help='generate paired-end reads')
+    parser.add_argument('--multimap-rate', type=float, default=0.1)
+    parser.add_argument('--unmapped-fraction', type=float, default=0.05)
+    parser.add_argument('--contigs', type=int, default=10)
+    parser.add_argument('--contig-length', type=int, default=1000000)
+    parser.add_argument('--read-length', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--bam', action='store_true', help='write BAM instead of SAM')
+    parser.add_argument('--sorted', action='store_true', help='sort the BAM by coordinate')
+    args = parser.parse_args()
+
+    records = generate(args.output, bam=args.bam, sort=args.sorted, reads=int(args.reads),
+                       paired=args.paired, multimap_rate=args.multimap_rate,
+                       unmapped_fraction=args.unmapped_fraction, contigs=args.contigs,
+                       contig_length=args.contig_length, read_length=args.read_length,
+                       seed=args.seed)
+    print('wrote {0} records to {1}'.format(records, args.output))
+
+
+if __name__ == '__main__':
+    main()
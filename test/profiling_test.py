@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ReadsAlignmentUtils.core import profiling
+
+
+def inner(n):
+    return sum(i * i for i in range(n))
+
+
+def outer(n):
+    return inner(n) + inner(n // 2)
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_profiling_requested(self):
+        with mock.patch.dict(os.environ, {profiling.PROFILE_ENV: ''}):
+            self.assertFalse(profiling.profiling_requested(None))
+            self.assertFalse(profiling.profiling_requested({'profile': False}))
+            self.assertTrue(profiling.profiling_requested({'profile': True}))
+        with mock.patch.dict(os.environ, {profiling.PROFILE_ENV: 'true'}):
+            self.assertTrue(profiling.profiling_requested(None))
+
+    def test_profile_call(self):
+        result, pstats_path = profiling.profile_call(self.output_dir, 'call/1', outer, 200000)
+
+        self.assertEqual(result, outer(200000))
+        self.assertTrue(os.path.basename(pstats_path).startswith('call_1_'))
+        stats = pstats.Stats(pstats_path)
+        self.assertTrue(any(func[2] == 'inner' for func in stats.stats))
+
+        collapsed_path = pstats_path[:-len('.pstats')] + '.collapsed'
+        with open(collapsed_path) as collapsed:
+            lines = collapsed.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, microseconds = line.rsplit(' ', 1)
+            self.assertGreater(int(microseconds), 0)
+        self.assertTrue(any('outer (profiling_test.py' in line and 'inner (profiling_test.py'
+                            in line for line in lines))
+
+    def test_collapsed_stacks_bounded(self):
+        # 40 layers of 2 functions each calling both functions of the next layer,
+        # so 2 ** 40 stacks; each function spends 1 ms itself, and half its
+        # cumulative time under each of its callers
+        layers = [[('layer.py', i, 'f{0}_{1}'.format(i, j)) for j in range(2)]
+                  for i in range(40)]
+        stats = mock.Mock(stats={})
+        for i, layer in enumerate(layers):
+            for func in layer:
+                ct = 0.001 * (len(layers) - i)
+                callers = {caller: (1, 1, 0.0005, ct / 2) for caller in layers[i - 1]} if i else {}
+                stats.stats[func] = (1, 1, 0.001, ct, callers)
+        path = os.path.join(self.output_dir, 'layers.collapsed')
+        with mock.patch.object(profiling, 'MAX_STACKS', 1000):
+            profiling.write_collapsed_stacks(stats, path)
+
+        with open(path) as collapsed:
+            lines = collapsed.read().splitlines()
+        self.assertLessEqual(len(lines), 4000)
+        total = sum(int(line.rsplit(' ', 1)[1]) for line in lines)
+        expected = sum(stats.stats[func][3] for func in layers[0]) * 1e6
+        self.assertAlmostEqual(total / expected, 1, delta=0.01)
+
+    def test_profile_call_exception(self):
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            profiling.profile_call(self.output_dir, 'fail', fail)
+        self.assertEqual(len([f for f in os.listdir(self.output_dir)
+                              if f.endswith('.pstats')]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
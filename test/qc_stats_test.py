@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+import pysam
+
+from ReadsAlignmentUtils.core import qc_stats
+from ReadsAlignmentUtils.core.qc_stats import QCStatsAccumulator
+
+from perf.synthetic_alignments import write_alignments
+
+
+def random_alignments(count, seed=1):
+    """
+    Returns (flag, mapq, tlen, nm, soft_clipped, query_length) of random records
+    """
+    rng = random.Random(seed)
+    records = []
+    for _ in range(count):
+        flag = rng.choice((0x1 | 0x2 | 0x40, 0x1 | 0x2 | 0x80, 0x1 | 0x40, 0x0, 0x4,
+                           0x1 | 0x2 | 0x40 | 0x100, 0x800))
+        records.append((flag, rng.randrange(256), rng.randrange(-20000, 20000),
+                        rng.choice((None, rng.randrange(100))), rng.randrange(10), 100))
+    return records
+
+
+def reference_histograms(records):
+    mapq, insert_size, nm = Counter(), Counter(), Counter()
+    clipped = bases = 0
+    for flag, q, tlen, n, soft_clipped, length in records:
+        if flag & 0x4 or flag & 0x900:
+            continue
+        mapq[q] += 1
+        if flag & 0x1 and flag & 0x2 and flag & 0x40:
+            insert_size[min(abs(tlen), 10000)] += 1
+        if n is not None:
+            nm[min(n, 64)] += 1
+        clipped += soft_clipped
+        bases += length
+    return mapq, insert_size, nm, clipped, bases
+
+
+class QCStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.flush_size = qc_stats.FLUSH_SIZE
+
+    def tearDown(self):
+        qc_stats.FLUSH_SIZE = self.flush_size
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def assertHistogram(self, histogram, counter, size):
+        self.assertEqual(histogram.size, size)
+        self.assertEqual({i: int(c) for i, c in enumerate(histogram) if c}, dict(counter))
+
+    def test_histograms(self):
+        records = random_alignments(5000)
+        # flushes several times during the pass
+        qc_stats.FLUSH_SIZE = 777
+        qc = QCStatsAccumulator()
+        for record in records:
+            qc.add(*record)
+        mapq, insert_size, nm, clipped, bases = reference_histograms(records)
+        histograms = qc.histograms()
+        self.assertHistogram(histograms['mapq'], mapq, 256)
+        self.assertHistogram(histograms['insert_size'], insert_size, 10001)
+        self.assertHistogram(histograms['nm'], nm, 65)
+        self.assertAlmostEqual(qc.soft_clip_fraction, float(clipped) / bases)
+
+        path = qc.save(os.path.join(self.tmp, 'qc_stats.npz'))
+        loaded = QCStatsAccumulator.load(path)
+        self.assertEqual(loaded.summary(), qc.summary())
+        for name, histogram in loaded.histograms().items():
+            self.assertEqual(list(histogram), list(histograms[name]))
+
+    def test_summary(self):
+        qc = QCStatsAccumulator()
+        self.assertEqual(qc.summary(), {'mean_mapq': 0.0, 'median_insert_size': 0,
+                                        'mean_nm': 0.0, 'soft_clip_fraction': 0.0})
+        for mapq, tlen, nm in ((60, 300, 0), (60, -310, 2), (0, 500, 4)):
+            qc.add(0x1 | 0x2 | 0x40, mapq, tlen, nm, 10, 100)
+        self.assertEqual(qc.summary(), {'mean_mapq': 40.0, 'median_insert_size': 310,
+                                        'mean_nm': 2.0, 'soft_clip_fraction': 0.1})
+
+    def test_alignments(self):
+        bam_path = os.path.join(self.tmp, 'test.bam')
+        rng = random.Random(2)
+        alignments = []
+        expected = []
+        for i in range(500):
+            clip = rng.randrange(20)
+            alignment = {
+                'query_name': 'read{0}'.format(i),
+                'flag': rng.choice((0x1 | 0x2 | 0x40, 0x1 | 0x2 | 0x80, 0x100, 0x4)),
+                'reference_id': 0,
+                'reference_start': rng.randrange(90000),
+                'mapping_quality': rng.randrange(61),
+                'query_sequence': 'A' * 100,
+                'cigarstring': '{0}S{1}M'.format(clip, 100 - clip) if clip else '100M',
+                'template_length': rng.randrange(-1000, 1000)}
+            nm = rng.choice((None, rng.randrange(10)))
+            if nm is not None:
+                alignment['tags'] = {'NM': nm}
+            alignments.append(alignment)
+            expected.append((alignment['flag'], alignment['mapping_quality'],
+                             alignment['template_length'], nm, clip, 100))
+        write_alignments(bam_path, [('chr1', 100000)], alignments)
+
+        qc = QCStatsAccumulator()
+        with pysam.AlignmentFile(bam_path) as bam:
+            for alignment in bam:
+                qc.add_alignment(alignment)
+        mapq, insert_size, nm, clipped, bases = reference_histograms(expected)
+        histograms = qc.histograms()
+        self.assertHistogram(histograms['mapq'], mapq, 256)
+        self.assertHistogram(histograms['insert_size'], insert_size, 10001)
+        self.assertHistogram(histograms['nm'], nm, 65)
+        self.assertEqual((qc.soft_clipped_bases, qc.query_bases), (clipped, bases))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ReadsAlignmentUtils.core import record_chunks
+from ReadsAlignmentUtils.core.alignment_stats import read_id_hash, read_id_hashes
+from ReadsAlignmentUtils.core.record_chunks import RECORD_DTYPE, iter_chunks
+
+from perf.synthetic_alignments import write_alignments
+
+
+def random_alignments(count, seed=1):
+    """
+    Returns the fields of count records with read names of random lengths
+    """
+    rng = random.Random(seed)
+    alignments = []
+    for i in range(count):
+        sequence = 'ACGT' * rng.randrange(1, 40)
+        alignment = {'query_name': 'r{0}_{1}'.format(i // 2, 'x' * rng.randrange(40)),
+                     'query_sequence': sequence}
+        if rng.random() < 0.1:
+            alignment.update(flag=0x4, reference_id=-1, reference_start=-1)
+        else:
+            alignment.update(
+                flag=rng.choice((0x1 | 0x2 | 0x40, 0x1 | 0x80 | 0x10, 0x100, 0x40)),
+                reference_id=rng.randrange(2),
+                reference_start=rng.randrange(4000),
+                mapping_quality=rng.randrange(256),
+                cigarstring='{0}M'.format(len(sequence)),
+                next_reference_id=rng.randrange(-1, 2),
+                next_reference_start=rng.randrange(-1, 4000),
+                template_length=rng.randrange(-500, 500))
+        alignments.append(alignment)
+    return alignments
+
+
+def write_records(path, count, mode='wb'):
+    """
+    Writes random records and returns their fields as given by pysam
+    """
+    records = write_alignments(path, [('chr1', 100000), ('chr2', 5000)],
+                               random_alignments(count), mode=mode)
+    return [(r.flag, r.reference_id, r.reference_start, r.mapping_quality,
+             r.next_reference_id, r.next_reference_start, r.template_length,
+             read_id_hash(r.query_name), bool(r.flag & 0x1 and r.flag & 0x40),
+             bool(r.flag & 0x1 and r.flag & 0x80)) for r in records]
+
+
+class RecordChunksTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.bam = os.path.join(cls.tmp, 'test.bam')
+        cls.sam = os.path.join(cls.tmp, 'test.sam')
+        cls.expected = write_records(cls.bam, 5000)
+        write_records(cls.sam, 5000, mode='w')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def check_chunks(self, path, chunk_size):
+        chunks = list(iter_chunks(path, chunk_size=chunk_size))
+        self.assertEqual([len(chunk) for chunk in chunks[:-1]], [chunk_size] * (len(chunks) - 1))
+        self.assertLessEqual(len(chunks[-1]), chunk_size)
+        records = np.concatenate(chunks)
+        self.assertEqual(records.dtype, RECORD_DTYPE)
+        self.assertEqual([tuple(record) for record in records.tolist()], self.expected)
+
+    def test_bam(self):
+        self.check_chunks(self.bam, 1000)
+        self.check_chunks(self.bam, 1 << 16)
+
+    def test_bam_buffers(self):
+        # records spanning buffers of blocks
+        buffer_size = record_chunks.BUFFER_SIZE
+        record_chunks.BUFFER_SIZE = 10000
+        try:
+            self.check_chunks(self.bam, 777)
+        finally:
+            record_chunks.BUFFER_SIZE = buffer_size
+
+    def test_sam(self):
+        self.check_chunks(self.sam, 1234)
+
+    def test_read_id_hashes(self):
+        names = [b'', b'a', b'read1', b'SRR000001.1234/1', b'x' * 300]
+        data = np.frombuffer(b''.join(names), dtype=np.uint8)
+        lengths = [len(name) for name in names]
+        starts = np.cumsum([0] + lengths[:-1])
+        self.assertEqual(list(read_id_hashes(data, starts, lengths)),
+                         [read_id_hash(name) for name in names])
+        self.assertEqual(len(read_id_hashes(data, [], [])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
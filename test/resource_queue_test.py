@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from ReadsAlignmentUtils.core.resource_queue import ResourceQueue
+
+
+class ResourceQueueTest(unittest.TestCase):
+
+    def run_jobs(self, queue, jobs, duration=0.05):
+        """
+        Runs each (cpu, memory_mb) job in its own thread and returns the
+        highest cpu and memory use seen while they ran and their start order
+        """
+        lock = threading.Lock()
+        state = {'cpu': 0, 'memory': 0, 'max_cpu': 0, 'max_memory': 0, 'order': []}
+
+        def job(index, cpu, memory_mb):
+            with queue.slot(cpu=cpu, memory_mb=memory_mb):
+                with lock:
+                    state['cpu'] += cpu
+                    state['memory'] += memory_mb
+                    state['max_cpu'] = max(state['max_cpu'], state['cpu'])
+                    state['max_memory'] = max(state['max_memory'], state['memory'])
+                    state['order'].append(index)
+                time.sleep(duration)
+                with lock:
+                    state['cpu'] -= cpu
+                    state['memory'] -= memory_mb
+
+        threads = []
+        for index, (cpu, memory_mb) in enumerate(jobs):
+            thread = threading.Thread(target=job, args=(index, cpu, memory_mb))
+            thread.start()
+            threads.append(thread)
+            # make the arrival order deterministic
+            time.sleep(0.005)
+        for thread in threads:
+            thread.join()
+        return state
+
+    def test_cpu_limit(self):
+        queue = ResourceQueue(cpu_slots=2)
+        state = self.run_jobs(queue, [(1, 0)] * 6)
+
+        self.assertEqual(state['max_cpu'], 2)
+        stats = queue.stats()
+        self.assertEqual(stats['completed'], 6)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['queued'], 0)
+        self.assertGreater(stats['max_wait_time'], 0)
+
+    def test_memory_limit(self):
+        queue = ResourceQueue(cpu_slots=8, memory_mb=1000)
+        state = self.run_jobs(queue, [(1, 600)] * 4)
+
+        self.assertEqual(state['max_memory'], 600)
+
+    def test_oversized_job_runs_alone(self):
+        queue = ResourceQueue(cpu_slots=2, memory_mb=1000)
+        state = self.run_jobs(queue, [(1, 100), (8, 5000), (1, 100)])
+
+        # the oversized job is clamped to the queue capacity, so nothing runs beside it
+        self.assertEqual(state['max_cpu'], 8)
+        self.assertEqual(state['max_memory'], 5000)
+        self.assertEqual(queue.stats()['completed'], 3)
+
+    def test_fifo_order(self):
+        queue = ResourceQueue(cpu_slots=2)
+        # the 2 cpu job must not be overtaken by the 1 cpu jobs behind it
+        state = self.run_jobs(queue, [(1, 0), (2, 0), (1, 0), (1, 0)])
+
+        self.assertEqual(state['order'], [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
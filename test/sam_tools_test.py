@@ -13,7 +13,7 @@ from installed_clients.WorkspaceClient import Workspace as workspaceService
 from ReadsAlignmentUtils.ReadsAlignmentUtilsImpl import ReadsAlignmentUtils
 from ReadsAlignmentUtils.ReadsAlignmentUtilsServer import MethodContext
 from ReadsAlignmentUtils.authclient import KBaseAuth as _KBaseAuth
-from ReadsAlignmentUtils.core.sam_tools import SamTools
+from ReadsAlignmentUtils.core.sam_tools import SamTools, get_tool_queue
 
 
 class SamToolsTest(unittest.TestCase):
@@ -175,6 +175,63 @@ class SamToolsTest(unittest.TestCase):
         self.assertEqual(stats['singletons'], 0)
         self.assertEqual(stats['total_reads'], 19498)
 
+    def test_sort_and_merge_bams(self):
+        opath = '/kb/module/work/'
+
+        samt = SamTools(self.__class__.cfg, self.__class__.__LOGGER)
+
+        result = samt.sort_bam(ifile='accepted_hits.sam',
+                               ipath='/kb/module/test/data/samtools',
+                               ofile='accepted_hits_sort_test_output.bam',
+                               opath=opath)
+        self.assertEqual(result, 0)
+
+        ofile = opath + 'accepted_hits_merge_test_output.bam'
+        result = samt.merge_bams([opath + 'accepted_hits_sort_test_output.bam',
+                                  '/kb/module/test/data/samtools/accepted_hits_sorted.bam'],
+                                 ofile)
+        self.assertEqual(result, 0)
+        self.assertTrue(os.path.exists(ofile))
+
+        stats = samt.get_stats(ifile='accepted_hits_merge_test_output.bam', ipath=opath)
+        self.assertEqual(stats['mapped_reads'], 2 * 19213)
+        self.assertEqual(stats['total_reads'], 2 * 19498)
+
+        result = samt.merge_bams(['/kb/module/test/data/samtools/accepted_hits_invalid.bam'],
+                                 ofile)
+        self.assertEqual(result, 1)
+
+    def test_sort_options(self):
+        samt = SamTools({'samtools_sort_threads': '4', 'samtools_sort_memory_mb': '512'},
+                        self.__class__.__LOGGER)
+        self.assertEqual(samt._sort_options(), '-m 512M -@ 3')
+
+        samt = SamTools({}, self.__class__.__LOGGER)
+        self.assertEqual(samt._sort_options(), '-m 768M')
+
+    def test_java_options(self):
+        samt = SamTools({'picard_memory_mb': '4096'}, self.__class__.__LOGGER)
+        self.assertEqual(samt._java_options(), '-Xmx4096m')
+
+        # without picard_memory_mb the JVM keeps its default heap
+        for config in ({}, {'picard_memory_mb': ''}):
+            samt = SamTools(config, self.__class__.__LOGGER)
+            self.assertEqual(samt._java_options(), '')
+
+    def test_tool_queue(self):
+        queue = get_tool_queue()
+        completed = queue.stats()['completed']
+
+        samt = SamTools(self.__class__.cfg, self.__class__.__LOGGER)
+        samt.create_bai_from_bam(ifile='accepted_hits_sorted.bam',
+                                 ipath='/kb/module/test/data/samtools',
+                                 ofile='accepted_hits_queue_test_output.bai',
+                                 opath='/kb/module/work/')
+
+        stats = queue.stats()
+        self.assertEqual(stats['completed'], completed + 1)
+        self.assertEqual(stats['running'], 0)
+
     def test__is_valid(self):
         result = '\n' + \
                  ' \n' + \
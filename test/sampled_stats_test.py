@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from ReadsAlignmentUtils.core.bgzf import (BaiIndex, BamHeader, BgzfReader, find_record_start,
+                                           split_virtual_offset)
+from ReadsAlignmentUtils.core.sampled_stats import estimate_alignment_stats
+
+from alignment_fixtures import REFERENCES, random_paired_alignments
+from perf.synthetic_alignments import write_alignments
+
+
+class SampledStatsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.bam = os.path.join(cls.tmp, 'sorted.bam')
+        alignments, cls.alignment_rate, cls.properly_paired = random_paired_alignments(60000)
+        write_alignments(cls.bam, REFERENCES, alignments, sort=True)
+        cls.unindexed = os.path.join(cls.tmp, 'unindexed.bam')
+        shutil.copy(cls.bam, cls.unindexed)
+        pysam.index(cls.bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def test_header_and_blocks(self):
+        with pysam.AlignmentFile(self.bam) as bam:
+            names = list(bam.references)
+            first_record = bam.tell()
+            starts = set()
+            for _ in bam:
+                starts.add(bam.tell())
+        with BgzfReader(self.bam) as bgzf:
+            self.assertTrue(bgzf.has_eof_marker)
+            header = BamHeader.read(bgzf)
+            self.assertEqual(header.names, names)
+            self.assertEqual(header.lengths, [1000000] * 3)
+            self.assertEqual(header.first_record, first_record)
+
+            block_offsets = [offset for offset, _, _ in bgzf.blocks()]
+            rng = random.Random(2)
+            for _ in range(50):
+                offset = rng.randrange(bgzf.data_end)
+                expected = max(b for b in block_offsets if b <= offset)
+                self.assertEqual(bgzf.find_block(offset), expected)
+
+            # record starts found by scanning agree with the ones pysam reports
+            for coffset in block_offsets[5:10]:
+                data, _ = bgzf.read_block(coffset)
+                uoffset = find_record_start(data, len(names))
+                self.assertIn((coffset << 16) | uoffset, starts)
+
+    def test_index_counts(self):
+        index = BaiIndex.read(self.bam + '.bai')
+        self.assertTrue(index.has_counts)
+        with pysam.AlignmentFile(self.bam) as bam:
+            for ref, stats in zip(index.references, bam.get_index_statistics()):
+                self.assertEqual((ref.mapped, ref.unmapped), (stats.mapped, stats.unmapped))
+            self.assertEqual(index.no_coordinate, bam.nocoordinate)
+        for voffset in index.references[0].linear_offsets[:3]:
+            self.assertGreater(split_virtual_offset(voffset)[0], 0)
+
+    def test_census(self):
+        # small files are read in full and give the exact stats
+        result = estimate_alignment_stats(os.path.join('data', 'accepted_hits.bam'))
+        self.assertTrue(result['exact'])
+        self.assertEqual(result['alignment_rate'], round(14969 * 100.0 / 15254, 3))
+        self.assertEqual(result['alignment_rate_ci'], [result['alignment_rate']] * 2)
+        self.assertEqual(result['properly_paired'], 0)
+        self.assertEqual(result['estimated_records'], 19498)
+
+        result = estimate_alignment_stats(self.bam, sample_blocks=100000)
+        self.assertTrue(result['exact'])
+        self.assertEqual(result['alignment_rate'], self.alignment_rate)
+        self.assertEqual(result['properly_paired'], self.properly_paired)
+
+    def test_sampled_empty_contig(self):
+        # the exact record count of the index is used with an empty reference too
+        bam = os.path.join(self.tmp, 'empty_contig.bam')
+        alignments = [a for a in random_paired_alignments(30000, seed=2)[0]
+                      if a['reference_id'] != 1]
+        write_alignments(bam, REFERENCES, alignments, sort=True)
+        pysam.index(bam)
+        self.assertTrue(BaiIndex.read(bam + '.bai').has_counts)
+
+        result = estimate_alignment_stats(bam, sample_blocks=20, seed=3)
+        self.assertFalse(result['exact'])
+        self.assertEqual(result['estimated_records'], len(alignments))
+        self.assertEqual(result['estimated_records_ci'], [len(alignments)] * 2)
+
+    def test_sampled(self):
+        for path, used_index in ((self.bam, True), (self.unindexed, False)):
+            result = estimate_alignment_stats(path, sample_blocks=40, seed=3)
+            self.assertFalse(result['exact'])
+            self.assertEqual(result['used_index'], used_index)
+            self.assertEqual(result['sampled_blocks'], 40)
+            self.assertEqual(result, estimate_alignment_stats(path, sample_blocks=40, seed=3))
+
+            low, high = result['alignment_rate_ci']
+            self.assertLess(low, high)
+            # 95% intervals, checked at twice their width to keep the test stable
+            self.assertLess(abs(result['alignment_rate'] - self.alignment_rate), high - low)
+            low, high = result['properly_paired_ci']
+            self.assertLess(abs(result['properly_paired'] - self.properly_paired), high - low)
+
+    def test_confidence(self):
+        with self.assertRaises(ValueError):
+            estimate_alignment_stats(self.bam, confidence=1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from ReadsAlignmentUtils.core.stage_timer import StageTimer, current_timer, track_process
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class StageTimerTest(unittest.TestCase):
+
+    def test_stages(self):
+        logger = logging.getLogger('StageTimer_test')
+        logger.setLevel(logging.INFO)
+        handler = ListHandler()
+        logger.addHandler(handler)
+
+        timer = StageTimer('test_method', logger)
+        self.assertIsNone(current_timer())
+        with timer.stage('sleep'):
+            self.assertIs(current_timer(), timer)
+            time.sleep(0.05)
+        with timer.stage('child'):
+            with track_process('python'):
+                subprocess.run([sys.executable, '-c', 'sum(range(2000000))'])
+        self.assertIsNone(current_timer())
+
+        stages = timer.report()
+        self.assertEqual([s['stage'] for s in stages], ['sleep', 'child'])
+        self.assertGreaterEqual(stages[0]['wall_time'], 0.05)
+        self.assertEqual(stages[0]['processes'], [])
+        self.assertEqual(len(stages[1]['processes']), 1)
+        process = stages[1]['processes'][0]
+        self.assertEqual(process['name'], 'python')
+        self.assertGreater(process['cpu_time'], 0)
+        self.assertGreater(stages[1]['child_cpu_time'], 0)
+        # the peak RSS of this process is known even if no child raised it
+        for stage in stages:
+            self.assertGreater(stage['peak_rss_kb'], 0)
+
+        records = [json.loads(m) for m in handler.messages]
+        self.assertEqual([r['type'] for r in records],
+                         ['stage_timing', 'process_timing', 'stage_timing'])
+        self.assertTrue(all(r['method'] == 'test_method' for r in records))
+        logger.removeHandler(handler)
+
+    def test_nested_stages(self):
+        timer = StageTimer('test_method')
+        with timer.stage('outer'):
+            with timer.stage('inner'):
+                with track_process('true'):
+                    subprocess.run(['true'])
+
+        stages = timer.report()
+        self.assertEqual([s['stage'] for s in stages], ['inner', 'outer'])
+        self.assertEqual(len(stages[0]['processes']), 1)
+        self.assertEqual(stages[1]['processes'], [])
+
+    def test_concurrent_stages(self):
+        timer = StageTimer('test_method')
+
+        def run(name, seconds):
+            with timer.stage(name):
+                with track_process(name):
+                    subprocess.run(['sleep', str(seconds)])
+
+        # the first process finishes while the second stage is open
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(run,) + args)
+                   for args in (('first', 0.05), ('second', 0.3))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stages = timer.report()
+        self.assertEqual([s['stage'] for s in stages], ['first', 'second'])
+        for stage in stages:
+            self.assertEqual([p['name'] for p in stage['processes']], [stage['stage']])
+
+    def test_thread_cpu_time(self):
+        timer = StageTimer('test_method')
+        busy = threading.Event()
+
+        def spin():
+            with timer.stage('spin'):
+                busy.set()
+                end = time.time() + 0.3
+                while time.time() < end:
+                    pass
+
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(spin,))
+        thread.start()
+        busy.wait()
+        with timer.stage('sleep'):
+            time.sleep(0.2)
+        thread.join()
+
+        stages = {stage['stage']: stage for stage in timer.report()}
+        # the CPU of the spinning thread is only counted in its own stage
+        self.assertLess(stages['sleep']['cpu_time'], 0.05)
+        self.assertGreater(stages['sleep']['process_cpu_time'], 0.1)
+        self.assertGreater(stages['spin']['cpu_time'], 0.1)
+
+    def test_no_timer(self):
+        with track_process('true'):
+            subprocess.run(['true'])
+
+
+if __name__ == '__main__':
+    unittest.main()